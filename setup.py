@@ -16,12 +16,20 @@ install_requires = [
     'jsonpickle'
 ]
 
+# indexed_gzip gives cheap random access to volumes of .nii.gz files (see
+# spynoza.utils.load_nifti_indexed); without it, reading volume k inflates
+# all preceding volumes
+extras_require = {
+    'indexed_gzip': ['indexed_gzip'],
+}
+
 setup(
     name='spynoza',
     version=VERSION,
     description='Python package for fMRI data processing',
     long_description=readme(),
     requires=install_requires,
+    extras_require=extras_require,
     classifiers=[
         'Development Status :: 1 - Planning',
         'Intended Audience :: Science/Research',
@@ -8,7 +8,9 @@ from . import filtering
 from . import glm
 from . import ica_fix
 from . import masking
+from . import qc
 from . import registration
+from . import resampling
 from . import uniformization
 from . import unwarping
 
@@ -18,4 +20,4 @@ test_data_path = op.join(root_dir, 'data', 'test_data')
 __all__ = ['unwarping', 'uniformization', 'registration',
            'retroicor', 'masking', 'ica_fix', 'glm',
            'filtering', 'test_data_path', 'root_dir',
-           'conversion']
+           'conversion', 'resampling', 'qc']
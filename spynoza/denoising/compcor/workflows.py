@@ -12,7 +12,7 @@ from nipype.interfaces.utility import IdentityInterface, Merge, Rename
 from nipype.algorithms.confounds import TCompCor, ACompCor
 from nipype.interfaces import fsl
 from .nodes import Erode_mask, Combine_component_files
-from ...utils import Extract_task
+from ...utils import Extract_task, Pack_regressors
 
 
 def pick_wm(files):
@@ -28,10 +28,19 @@ def extract_basename(files):
 
 
 def create_compcor_workflow(name='compcor'):
-    """ Creates A/T compcor workflow. """
+    """ Creates A/T compcor workflow.
+
+    The runs (inputspec.in_file) are expected in the EPI space of
+    inputspec.mean_file and inputspec.mask_file, e.g. the EPI_space_file
+    and mask_EPI_space_file outputs of the motion correction workflow, so
+    that the brain mask is computed once per session and shared with the
+    other workflows.
+    """
 
     input_node = pe.Node(interface=IdentityInterface(fields=[
         'in_file',
+        'mean_file',
+        'mask_file',
         'fast_files',
         'highres2epi_mat',
         'n_comp_tcompcor',
@@ -43,7 +52,9 @@ def create_compcor_workflow(name='compcor'):
     output_node = pe.Node(interface=IdentityInterface(fields=[
         'tcompcor_file',
         'acompcor_file',
-        'epi_mask'
+        'epi_mask',
+        'mean_file',
+        'regressor_file'
     ]), name='outputspec')
 
     extract_task = pe.MapNode(interface=Extract_task,
@@ -53,47 +64,38 @@ def create_compcor_workflow(name='compcor'):
                                                   keepext=True),
                                  iterfield=['task', 'in_file'], name='rename_acompcor')
 
+    # the aCompCor components as packed regressor files, for fit_nuisances
+    pack_acompcor = pe.MapNode(Pack_regressors, iterfield=['vol_regressors'],
+                               name='pack_acompcor')
+
     datasink = pe.Node(DataSink(), name='sinker')
     datasink.inputs.parameterization = False
 
-    average_func = pe.MapNode(interface=fsl.maths.MeanImage(dimension='T'),
-                        name='average_func', iterfield=['in_file'])
-
-    epi_mask = pe.MapNode(interface=fsl.BET(frac=.3, mask=True, no_output=True,
-                                            robust=True),
-                          iterfield=['in_file'], name='epi_mask')
-
-    wm2epi = pe.MapNode(fsl.ApplyXFM(interp='nearestneighbour'),
-                          iterfield=['reference'],
-                          name='wm2epi')
+    # WM and CSF masks, once for the session (EPI) space
+    wm2epi = pe.Node(fsl.ApplyXFM(interp='nearestneighbour'), name='wm2epi')
 
-    csf2epi = pe.MapNode(fsl.ApplyXFM(interp='nearestneighbour'),
-                        iterfield=['reference'],
-                        name='csf2epi')
+    csf2epi = pe.Node(fsl.ApplyXFM(interp='nearestneighbour'), name='csf2epi')
 
-    erode_csf = pe.MapNode(interface=Erode_mask, name='erode_csf',
-                           iterfield=['epi_mask', 'in_file'])
+    erode_csf = pe.Node(interface=Erode_mask, name='erode_csf')
     erode_csf.inputs.erosion_mm = 0
     erode_csf.inputs.epi_mask_erosion_mm = 30
 
-    erode_wm = pe.MapNode(interface=Erode_mask, name='erode_wm',
-                          iterfield=['epi_mask', 'in_file'])
+    erode_wm = pe.Node(interface=Erode_mask, name='erode_wm')
 
     erode_wm.inputs.erosion_mm = 6
     erode_wm.inputs.epi_mask_erosion_mm = 10
 
-    merge_wm_and_csf_masks = pe.MapNode(Merge(2), name='merge_wm_and_csf_masks',
-                                        iterfield=['in1', 'in2'])
+    merge_wm_and_csf_masks = pe.Node(Merge(2), name='merge_wm_and_csf_masks')
 
     # This should be fit on the 30mm eroded mask from CSF
     tcompcor = pe.MapNode(TCompCor(components_file='tcomcor_comps.txt'),
-                          iterfield=['realigned_file', 'mask_files'],
+                          iterfield=['realigned_file'],
                           name='tcompcor')
 
     # WM + CSF mask
     acompcor = pe.MapNode(ACompCor(components_file='acompcor_comps.txt',
                                    merge_method='union'),
-                          iterfield=['realigned_file', 'mask_files'],
+                          iterfield=['realigned_file'],
                           name='acompcor')
 
     compcor_wf = pe.Workflow(name=name)
@@ -106,20 +108,18 @@ def create_compcor_workflow(name='compcor'):
                        'base_directory')
 
     compcor_wf.connect(input_node, ('fast_files', pick_wm), wm2epi, 'in_file')
-    compcor_wf.connect(epi_mask, 'mask_file', wm2epi, 'reference')
+    compcor_wf.connect(input_node, 'mask_file', wm2epi, 'reference')
     compcor_wf.connect(input_node, 'highres2epi_mat', wm2epi, 'in_matrix_file')
 
     compcor_wf.connect(input_node, ('fast_files', pick_csf), csf2epi, 'in_file')
-    compcor_wf.connect(epi_mask, 'mask_file', csf2epi, 'reference')
+    compcor_wf.connect(input_node, 'mask_file', csf2epi, 'reference')
     compcor_wf.connect(input_node, 'highres2epi_mat', csf2epi, 'in_matrix_file')
 
     compcor_wf.connect(input_node, 'n_comp_tcompcor', tcompcor, 'num_components')
     compcor_wf.connect(input_node, 'n_comp_acompcor', acompcor, 'num_components')
 
-    compcor_wf.connect(input_node, 'in_file', average_func, 'in_file')
-    compcor_wf.connect(average_func, 'out_file', epi_mask, 'in_file')
-    compcor_wf.connect(epi_mask, 'mask_file', erode_csf, 'epi_mask')
-    compcor_wf.connect(epi_mask, 'mask_file', erode_wm, 'epi_mask')
+    compcor_wf.connect(input_node, 'mask_file', erode_csf, 'epi_mask')
+    compcor_wf.connect(input_node, 'mask_file', erode_wm, 'epi_mask')
 
     compcor_wf.connect(wm2epi, 'out_file', erode_wm, 'in_file')
     compcor_wf.connect(csf2epi, 'out_file', erode_csf, 'in_file')
@@ -134,8 +134,11 @@ def create_compcor_workflow(name='compcor'):
 
     #compcor_wf.connect(tcompcor, 'components_file', output_node, 'acompcor_file')
     #compcor_wf.connect(acompcor, 'components_file', output_node, 'tcompcor_file')
-    compcor_wf.connect(epi_mask, 'mask_file', output_node, 'epi_mask')
+    compcor_wf.connect(input_node, 'mask_file', output_node, 'epi_mask')
+    compcor_wf.connect(input_node, 'mean_file', output_node, 'mean_file')
 
+    compcor_wf.connect(rename_acompcor, 'out_file', pack_acompcor, 'vol_regressors')
+    compcor_wf.connect(pack_acompcor, 'out_file', output_node, 'regressor_file')
     compcor_wf.connect(rename_acompcor, 'out_file', datasink, 'acompcor_file')
 
     #compcor_wf.connect(tcompcor, 'components_file', combine_files, 'tcomp')
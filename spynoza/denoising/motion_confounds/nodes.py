@@ -1,38 +1,84 @@
 from nipype.interfaces.utility import Function
 
 
-def extend_motion_parameters(par_file, order=2):
-    """ Extends the motion parameters """
+def extend_motion_parameters(par_file, order=2, lags=0, squares=True):
+    """ Extends the motion parameters with a Volterra expansion.
+
+    Builds, for each run, the derivatives (up to `order`), lagged versions
+    (up to `lags` volumes) and, optionally, the squares of all of these into a
+    single preallocated matrix. With order=1 (or lags=1, order=0) and
+    squares=True this yields the Friston-24 expansion; order=2 gives 36
+    regressors.
+
+    Parameters
+    ----------
+    par_file : str or list
+        Path(s) to (MCFLIRT) .par file(s). If a list is given, all runs are
+        processed in one call.
+    order : int (default: 2)
+        Number of temporal derivatives (backward differences, zero-padded).
+    lags : int (default: 0)
+        Number of lagged (shifted by one volume each, zero-padded) copies.
+    squares : bool (default: True)
+        Whether to add the squares of all (derived/lagged) parameters.
+
+    Returns
+    -------
+    out_ext : str or list
+        Absolute path(s) to tsv-file(s) with extended motion parameters. For
+        a list of runs, the run index is added to the names, so that runs
+        with the same filename (e.g., in different directories) are kept
+        apart.
+    """
     import numpy as np
     import os.path as op
     import pandas as pd
-    from copy import copy
 
-    moco_pars = np.loadtxt(par_file)
+    par_files = par_file if isinstance(par_file, list) else [par_file]
     col_names = ['X', 'Y', 'Z', 'Rot_X', 'Rot_Y', 'Rot_Z']
-    df_orig = pd.DataFrame(moco_pars, columns=col_names)
-    fn_orig = op.abspath('original_motion_pars.tsv')
-    df_orig.to_csv(fn_orig, sep=str('\t'), index=False)
 
-    current_names = copy(col_names)
-    current_pars = copy(moco_pars)
-    suffix = 'dt'
+    # column names: original, derivatives (dt, ddt, ...), lags, and squares
+    suffixes = [''] + ['_%sdt' % ('d' * i) for i in range(order)]
+    suffixes += ['_lag%i' % (i + 1) for i in range(lags)]
+    n_blocks = len(suffixes)
+    names = [s + suf for suf in suffixes for s in col_names]
+    if squares:
+        names += [n + '_sq' for n in names]
+
+    out_files = []
+    for i_run, f in enumerate(par_files):
+        moco_pars = np.loadtxt(f, ndmin=2)
+        n_vols, n_pars = moco_pars.shape
+        ext = np.zeros((n_vols, n_blocks * n_pars * (2 if squares else 1)))
+
+        ext[:, :n_pars] = moco_pars
+        for i in range(order):
+            src = ext[:, i * n_pars:(i + 1) * n_pars]
+            ext[1:, (i + 1) * n_pars:(i + 2) * n_pars] = np.diff(src, axis=0)
+
+        for i in range(lags):
+            lag_idx = (1 + order + i) * n_pars
+            ext[i + 1:, lag_idx:lag_idx + n_pars] = moco_pars[:n_vols - i - 1]
+
+        if squares:
+            n_lin = n_blocks * n_pars
+            np.square(ext[:, :n_lin], out=ext[:, n_lin:])
+
+        base = op.basename(f).split('.')[0]
+        if isinstance(par_file, list):
+            base = '%s_%i' % (base, i_run)
+        fn_ext = op.abspath(base + '_extended_motion_pars.tsv')
+        pd.DataFrame(ext, columns=names).to_csv(fn_ext, sep=str('\t'),
+                                                index=False)
+        out_files.append(fn_ext)
 
-    for i in range(order):
-        tmp_d = np.diff(np.vstack((np.ones((1, 6)), current_pars)), axis=0)
-        tmp_amp = tmp_d ** 2
-        current_pars = tmp_d
-        moco_pars = np.hstack((moco_pars, tmp_d, tmp_amp))
-        current_names.extend([s + '_%s' % suffix for s in col_names])
-        current_names.extend([s + '_%s_sq' % suffix for s in col_names])
-        suffix = 'd' + suffix
+    if not isinstance(par_file, list):
+        return out_files[0]
 
-    df_ext = pd.DataFrame(moco_pars, columns=current_names)
-    fn_ext = op.abspath('extended_motion_pars.tsv')
-    df_ext.to_csv(fn_ext, sep=str('\t'), index=False)
-    return fn_ext
+    return out_files
 
 
 Extend_motion_parameters = Function(function=extend_motion_parameters,
-                                    input_names=['par_file', 'order'],
+                                    input_names=['par_file', 'order', 'lags',
+                                                 'squares'],
                                     output_names=['out_ext'])
@@ -18,5 +18,44 @@ def test_create_motion_confound_workflow():
     datasink = op.join(motion_confound_wf.inputs.inputspec.output_directory,
                       motion_confound_wf.inputs.inputspec.sub_id, 'confounds')
 
-    assert op.isfile(op.join(datasink, 'extended_motion_pars.tsv'))
+    for f in motion_confound_wf.inputs.inputspec.par_file:
+        assert op.isfile(op.join(datasink, op.basename(f).replace(
+            '.par', '_extended_motion_pars.tsv')))
     assert op.isfile(op.join(datasink, 'fd_power_2012.txt'))
+
+
+@pytest.mark.motion_confound
+def test_extend_motion_parameters(tmpdir):
+    import numpy as np
+    import pandas as pd
+    from ..nodes import extend_motion_parameters
+
+    tmpdir.chdir()
+    pars = np.random.RandomState(0).randn(10, 6)
+    par_files = [op.abspath('run-%i_mcf.par' % i) for i in (1, 2)]
+    for f in par_files:
+        np.savetxt(f, pars)
+
+    out = extend_motion_parameters(par_files, order=1, squares=True)
+    assert len(out) == 2
+    df = pd.read_csv(out[0], sep='\t')
+    assert df.shape == (10, 24)  # Friston-24
+    np.testing.assert_allclose(df['X_dt'].values,
+                               np.r_[0, np.diff(pars[:, 0])])
+    np.testing.assert_allclose(df['Rot_Z_dt_sq'].values,
+                               df['Rot_Z_dt'].values ** 2)
+
+    df = pd.read_csv(extend_motion_parameters(par_files[0], order=0, lags=1),
+                     sep='\t')
+    assert df.shape == (10, 24)
+    np.testing.assert_allclose(df['Y_lag1'].values, np.r_[0, pars[:-1, 1]])
+
+    # runs with the same filename in different directories
+    same_name = [op.join(str(tmpdir.mkdir(ses)), 'run_mcf.par')
+                 for ses in ('ses-1', 'ses-2')]
+    for f, p in zip(same_name, (pars, 2 * pars)):
+        np.savetxt(f, p)
+    out = extend_motion_parameters(same_name, order=0, squares=False)
+    assert len(set(out)) == 2
+    for f, p in zip(out, (pars, 2 * pars)):
+        np.testing.assert_allclose(pd.read_csv(f, sep='\t').values, p)
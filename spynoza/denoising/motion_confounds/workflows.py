@@ -5,10 +5,11 @@ from ..nodes import Concat_confound_files
 from nipype.algorithms.confounds import FramewiseDisplacement
 
 from .nodes import Extend_motion_parameters
+from ...utils import Pack_regressors
 
 
-def create_motion_confound_workflow(order=2, fd_cutoff=.2,
-                                    name='motion_confound'):
+def create_motion_confound_workflow(order=2, lags=0, squares=True,
+                                    fd_cutoff=.2, name='motion_confound'):
 
     input_node = pe.Node(interface=IdentityInterface(fields=[
         'par_file',
@@ -18,16 +19,24 @@ def create_motion_confound_workflow(order=2, fd_cutoff=.2,
 
     output_node = pe.Node(interface=IdentityInterface(fields=[
         'out_fd',
-        'out_ext_moco'
+        'out_ext_moco',
+        'regressor_file'
     ]), name='outputspec')
 
     datasink = pe.Node(DataSink(), name='sinker')
     datasink.inputs.parameterization = False
 
-    extend_motion_parameters = pe.MapNode(Extend_motion_parameters,
-                                          iterfield=['par_file'],
-                                          name='extend_motion_parameters')
+    # handles all runs in one call, so no MapNode needed
+    extend_motion_parameters = pe.Node(Extend_motion_parameters,
+                                       name='extend_motion_parameters')
     extend_motion_parameters.inputs.order = order
+    extend_motion_parameters.inputs.lags = lags
+    extend_motion_parameters.inputs.squares = squares
+
+    # the extended parameters as packed regressor files, for fit_nuisances
+    pack_motion_pars = pe.MapNode(Pack_regressors,
+                                  iterfield=['vol_regressors'],
+                                  name='pack_motion_pars')
 
     framewise_disp = pe.MapNode(FramewiseDisplacement(parameter_source='FSL'),
                                 iterfield=['in_file'], name='framewise_disp')
@@ -39,6 +48,9 @@ def create_motion_confound_workflow(order=2, fd_cutoff=.2,
     mcf_wf.connect(input_node, 'par_file', framewise_disp, 'in_file')
     mcf_wf.connect(extend_motion_parameters, 'out_ext',
                    output_node, 'out_ext_moco')
+    mcf_wf.connect(extend_motion_parameters, 'out_ext',
+                   pack_motion_pars, 'vol_regressors')
+    mcf_wf.connect(pack_motion_pars, 'out_file', output_node, 'regressor_file')
     mcf_wf.connect(framewise_disp, 'out_file', output_node, 'out_fd')
     mcf_wf.connect(extend_motion_parameters, 'out_ext',
                    datasink, 'confounds')
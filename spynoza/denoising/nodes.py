@@ -1,20 +1,227 @@
 from nipype.interfaces.utility import Function
 
 
-def confound_to_outlier(in_file, threshold, col_name=None, **kwargs):
+def confound_to_outlier(in_file, threshold, col_name=None, n_before=0,
+                        n_after=0):
     """ Converts a confound array to outliers, given a threshold.
 
+    Thresholds are applied to all requested columns at once; a volume is
+    flagged as outlier if any of the columns exceeds its threshold. The
+    resulting censor mask can be dilated to also flag volumes before/after
+    each outlier. For every run, a one-hot spike regressor matrix (one column
+    per censored volume) and a censor vector are written.
+
+    Parameters
+    ----------
+    in_file : str or list
+        Path(s) to csv/tsv file(s) that can be imported using pandas. If a
+        list is given, all runs are processed in one call.
+    threshold : float, list or dict
+        Threshold(s) to apply to the confound(s). A list should match
+        col_name; a dict maps column-names to thresholds (and is used to
+        infer col_name if that is not given).
+    col_name : str or list
+        Specific column-name(s) to apply threshold to. If None, the threshold
+        is applied to all columns.
+    n_before : int (default: 0)
+        Number of volumes before each outlier to censor as well.
+    n_after : int (default: 0)
+        Number of volumes after each outlier to censor as well.
+
+    Returns
+    -------
+    spike_file : str or list
+        Absolute path(s) to tsv-file(s) with spike regressors. For a list of
+        runs, the run index is added to the names, so that runs with the
+        same filename (e.g., in different directories) are kept apart.
+    censor_file : str or list
+        Absolute path(s) to tsv-file(s) with the censor vector (1 = keep,
+        0 = censored).
+    """
+    import os.path as op
+    import numpy as np
+    import pandas as pd
+
+    in_files = in_file if isinstance(in_file, list) else [in_file]
+
+    if isinstance(threshold, dict):
+        if col_name is None:
+            col_name = list(threshold.keys())
+        col_name = [col_name] if isinstance(col_name, str) else col_name
+        threshold = [threshold[col] for col in col_name]
+    elif isinstance(col_name, str):
+        col_name = [col_name]
+
+    spike_files, censor_files = [], []
+    for i_run, f in enumerate(in_files):
+        sep = str(',') if f.endswith('.csv') else str('\t')
+        df = pd.read_csv(f, sep=sep)
+        cols = list(df.columns) if col_name is None else col_name
+
+        # NaNs (e.g. first FD value) are never flagged
+        values = df[cols].values.astype(float)
+        thresholds = np.broadcast_to(np.asarray(threshold, dtype=float),
+                                     (len(cols),))
+        with np.errstate(invalid='ignore'):
+            outliers = (values > thresholds).any(axis=1)
+
+        # dilate censor mask with n_before/n_after volumes
+        n_vols = outliers.size
+        idx = np.flatnonzero(outliers)
+        offsets = np.arange(-n_before, n_after + 1)
+        idx = np.unique(np.clip((idx[:, np.newaxis] + offsets).ravel(),
+                                0, n_vols - 1))
+        censored = np.zeros(n_vols, dtype=bool)
+        censored[idx] = True
+
+        # one-hot spike regressors: one column per censored volume
+        spikes = np.zeros((n_vols, idx.size), dtype=int)
+        spikes[idx, np.arange(idx.size)] = 1
+
+        base = op.basename(f).split('.')[0]
+        if isinstance(in_file, list):
+            base = '%s_%i' % (base, i_run)
+        spike_fn = op.abspath(base + '_spikes.tsv')
+        pd.DataFrame(spikes, columns=['spike_%03d' % i for i in idx]).to_csv(
+            spike_fn, sep=str('\t'), index=False)
+
+        censor_fn = op.abspath(base + '_censor.tsv')
+        pd.DataFrame({'censor': (~censored).astype(int)}).to_csv(
+            censor_fn, sep=str('\t'), index=False)
+
+        spike_files.append(spike_fn)
+        censor_files.append(censor_fn)
+
+    if not isinstance(in_file, list):
+        return spike_files[0], censor_files[0]
+
+    return spike_files, censor_files
+
+
+Confound_to_outlier = Function(function=confound_to_outlier,
+                               input_names=['in_file', 'threshold',
+                                            'col_name', 'n_before',
+                                            'n_after'],
+                               output_names=['spike_file', 'censor_file'])
+
+
+def regress_and_filter(in_file, confounds=None, columns=None, tr=None,
+                       basis='dct', high_pass=128.0, polyorder=3,
+                       window_length=120, block_size=20000):
+    """ Removes confounds and low-frequency drifts with a single projection.
+
+    Builds one (time x time) residual-forming operator from the confound
+    columns plus a high-pass basis, and applies it to the data in one blocked
+    matrix multiplication. Only the cleaned output is written. Contrary to
+    filtering and regressing in separate passes, the combined projection does
+    not reintroduce filtered-out frequencies through the regression step.
+
     Parameters
     ----------
     in_file : str
-        Path to csv/tsv file that can be imported using pandas.
-    threshold : float
-        Threshold to apply to confound.
-    col_name : str
-        Specific column-name to apply threshold to.
+        Absolute path to (4D) nifti-file.
+    confounds : str
+        Absolute path to tsv-file with confounds (optional).
+    columns : list
+        Confound columns to use; if None, all columns are used.
+    tr : float
+        Repetition time in seconds; if None, it's read from the header.
+    basis : str ['dct', 'savgol'] (default: 'dct')
+        High-pass basis: a discrete cosine set with cutoff high_pass, or the
+        linear operator equivalent to spynoza's savitsky-golay filter.
+    high_pass : float (default: 128.0)
+        Cutoff period (in seconds) of the DCT basis.
+    polyorder : int (default: 3)
+        Order of polynomials of the savitsky-golay filter.
+    window_length : int (default: 120)
+        Window length in seconds of the savitsky-golay filter.
+    block_size : int (default: 20000)
+        Number of voxels processed per block.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to cleaned nifti-file (temporal mean is preserved).
     """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import pandas as pd
+    from scipy.signal import savgol_filter
+
+    img = nib.load(in_file)
+    n_vols = img.shape[-1]
+
+    if tr is None:  # if TR is not set
+        tr = float(img.header['pixdim'][4])
+
+    # TR must be in seconds
+    if tr < 0.01:
+        tr = np.round(tr * 1000, decimals=3)
+    if tr > 20:
+        tr = tr / 1000.0
+
+    if confounds is not None:
+        conf = pd.read_csv(confounds, sep=str('\t'))
+        if columns is not None:
+            conf = conf[columns]
+        conf = conf.bfill().fillna(0).values.astype(np.float64)
+        conf -= conf.mean(axis=0)
+    else:
+        conf = np.zeros((n_vols, 0))
+
+    if basis == 'dct':
+        n_basis = int(np.floor(2 * n_vols * tr / high_pass))
+        t = np.arange(n_vols)[:, np.newaxis]
+        k = np.arange(1, n_basis + 1)[np.newaxis, :]
+        dct = np.cos(np.pi * (2 * t + 1) * k / (2. * n_vols))
+        design = np.hstack((np.ones((n_vols, 1)), dct, conf))
+        filt = np.eye(n_vols)
+    elif basis == 'savgol':
+        window = int(window_length / tr)
+        if window % 2 == 0:  # window must be odd
+            window += 1
+        # the filter is linear, so filtering the identity gives its operator
+        smoother = savgol_filter(np.eye(n_vols), window_length=window,
+                                 polyorder=polyorder, axis=0, mode='nearest')
+        filt = np.eye(n_vols) - smoother
+        design = filt.dot(conf)
+    else:
+        raise ValueError("basis should be 'dct' or 'savgol', not %r" % basis)
+
+    # orthonormal basis of the (filtered) design, robust to rank deficiency
+    if design.shape[1] > 0:
+        u, sv, _ = np.linalg.svd(design, full_matrices=False)
+        u = u[:, sv > sv.max() * n_vols * np.finfo(np.float64).eps]
+        operator = filt - u.dot(u.T.dot(filt))
+    else:
+        operator = filt
+    # remove the temporal mean (added back below), also for the savgol basis
+    operator -= operator.mean(axis=0)
+    operator = operator.T.astype(np.float32)
+
+    data = np.array(img.dataobj, dtype=np.float32).reshape((-1, n_vols))
+    for start in range(0, data.shape[0], block_size):
+        block = data[start:start + block_size]
+        mean = block.mean(axis=1, keepdims=True)
+        block[:] = block.dot(operator) + mean
+
+    hdr = img.header.copy()
+    hdr.set_data_dtype(np.float32)
+    out_img = nib.Nifti1Image(data.reshape(img.shape), img.affine, hdr)
+    out_file = os.path.abspath(
+        os.path.basename(in_file).split('.')[0] + '_clean.nii.gz')
+    nib.save(out_img, out_file)
+
+    return out_file
+
 
-    pass
+Regress_and_filter = Function(function=regress_and_filter,
+                              input_names=['in_file', 'confounds', 'columns',
+                                           'tr', 'basis', 'high_pass',
+                                           'polyorder', 'window_length',
+                                           'block_size'],
+                              output_names=['out_file'])
 
 
 def concat_confound_files(ext_par_file, fd_file, dvars_file, acompcor_file):
@@ -0,0 +1,273 @@
+def detect_peaks(signal, sample_rate, min_interval=0.3, smooth=0.1):
+    """ Detects peaks (e.g., heart beats or inspirations) in a physiological
+    trace.
+
+    Parameters
+    ----------
+    signal : np.ndarray
+        1D physiological recording.
+    sample_rate : float
+        Sampling rate in Hz.
+    min_interval : float (default: 0.3)
+        Minimal time between peaks in seconds.
+    smooth : float (default: 0.1)
+        Standard deviation (in seconds) of the Gaussian smoothing applied
+        before peak detection.
+
+    Returns
+    -------
+    peaks : np.ndarray
+        Sample indices of the peaks.
+    """
+    import numpy as np
+    import scipy.ndimage as nd
+    from scipy.signal import find_peaks
+
+    signal = np.asarray(signal, dtype=np.float64)
+    if smooth:
+        signal = nd.gaussian_filter1d(signal, smooth * sample_rate)
+    signal = (signal - signal.mean()) / signal.std()
+    peaks, _ = find_peaks(signal, distance=max(int(min_interval * sample_rate), 1),
+                          prominence=.5)
+    return peaks
+
+
+def cardiac_phase(times, peak_times):
+    """ Cardiac phase (Glover et al., 2000): rises linearly from 0 to 2 pi
+    between successive heart beats.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Times (s) to compute the phase at, of any shape.
+    peak_times : np.ndarray
+        Sorted times (s) of the heart beats.
+
+    Returns
+    -------
+    phase : np.ndarray
+        Cardiac phase in radians, with the shape of times.
+    """
+    import numpy as np
+
+    peak_times = np.asarray(peak_times, dtype=np.float64)
+    k = np.clip(np.searchsorted(peak_times, times, side='right') - 1, 0,
+                len(peak_times) - 2)
+    phase = 2 * np.pi * (times - peak_times[k]) / \
+        (peak_times[k + 1] - peak_times[k])
+    return np.mod(phase, 2 * np.pi)
+
+
+def respiratory_phase(resp, sample_rate, smooth=0.1, n_bins=100):
+    """ Respiratory phase (Glover et al., 2000), from the histogram-equalised
+    amplitude and the direction (inspiration/expiration) of breathing.
+
+    Parameters
+    ----------
+    resp : np.ndarray
+        1D respiratory recording.
+    sample_rate : float
+        Sampling rate in Hz.
+    smooth : float (default: 0.1)
+        Standard deviation (in seconds) of the Gaussian smoothing.
+    n_bins : int (default: 100)
+        Number of histogram bins.
+
+    Returns
+    -------
+    phase : np.ndarray
+        Respiratory phase in radians, in [-pi, pi], per sample.
+    """
+    import numpy as np
+    import scipy.ndimage as nd
+
+    resp = nd.gaussian_filter1d(np.asarray(resp, dtype=np.float64),
+                                smooth * sample_rate)
+    resp = (resp - resp.min()) / (resp.max() - resp.min())
+    hist, edges = np.histogram(resp, bins=n_bins, range=(0, 1))
+    cdf = np.cumsum(hist) / float(hist.sum())
+    amplitude = cdf[np.clip(np.digitize(resp, edges[1:-1]), 0, n_bins - 1)]
+
+    # direction of breathing, from the slope over ~1 s
+    slope = np.gradient(nd.gaussian_filter1d(resp, sample_rate / 2.))
+    return np.pi * amplitude * np.where(slope >= 0, 1, -1)
+
+
+def slice_onsets(n_slices, tr, slice_timing=None, slice_order='up',
+                 MB_factor=1):
+    """ Acquisition time (s) of each slice relative to the volume onset.
+
+    Parameters
+    ----------
+    n_slices : int
+        Number of slices.
+    tr : float
+        Repetition time in seconds.
+    slice_timing : list
+        Slice times in seconds (overrides slice_order).
+    slice_order : str ['up', 'down', 'interleaved_up', 'interleaved_down']
+        Slice order, as for pnm_evs.
+    MB_factor : int (default: 1)
+        Multiband factor; slices n_slices / MB_factor apart are acquired
+        simultaneously.
+
+    Returns
+    -------
+    onsets : np.ndarray
+        Array of shape (n_slices,).
+    """
+    import numpy as np
+
+    if slice_timing is not None:
+        onsets = np.asarray(slice_timing, dtype=np.float64)
+        if onsets.shape != (n_slices,):
+            raise ValueError('Got %i slice times for %i slices' %
+                             (onsets.size, n_slices))
+        return onsets
+
+    n_shots = n_slices // MB_factor
+    if slice_order in ('up', 'down'):
+        order = np.arange(n_shots)
+    elif slice_order in ('interleaved_up', 'interleaved_down'):
+        order = np.r_[np.arange(0, n_shots, 2), np.arange(1, n_shots, 2)]
+    else:
+        raise ValueError('Unknown slice order %s' % slice_order)
+    if slice_order.endswith('down'):
+        order = order[::-1]
+
+    # position of each slice in the acquisition sequence
+    shot = np.empty(n_shots)
+    shot[order] = np.arange(n_shots)
+    return np.tile(shot, MB_factor) * tr / n_shots
+
+
+def retroicor_regressors(in_file, phys_file, tr=None, sample_rate=496,
+                         slice_timing=None, slice_order='up',
+                         slice_direction='z', MB_factor=1, order_cardiac=4,
+                         order_resp=4, order_cardiac_interact=2,
+                         order_resp_interact=2, hr_rvt=True, resp_index=0,
+                         cardiac_index=1, trigger_index=3):
+    """ Computes per-slice RETROICOR regressors from physiological
+    recordings, as a native alternative to popp + pnm_evs.
+
+    Heart beats and respiratory phase are detected once; the cardiac,
+    respiratory and interaction Fourier regressors (and heart rate and
+    respiratory volume per time) are then evaluated at the acquisition time
+    of every slice of every volume at once, and written to a single packed
+    array of shape (slices, regressors, time), in the order of pnm_evs.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 4D EPI nifti-file.
+    phys_file : str
+        Absolute path to physiology text file (e.g., the output of
+        _distill_slice_times_from_gradients), one column per signal.
+    tr : float
+        Repetition time in seconds; defaults to the nifti header.
+    sample_rate : float (default: 496)
+        Sampling rate of the physiology in Hz.
+    slice_timing : list
+        Slice times (s) relative to the volume onset (overrides slice_order).
+    slice_order : str (default: 'up')
+        'up', 'down', 'interleaved_up' or 'interleaved_down'.
+    slice_direction : str (default: 'z')
+        Slice direction: 'x', 'y' or 'z'.
+    MB_factor : int (default: 1)
+        Multiband factor.
+    order_cardiac : int (default: 4)
+        Number of cardiac Fourier pairs.
+    order_resp : int (default: 4)
+        Number of respiratory Fourier pairs.
+    order_cardiac_interact : int (default: 2)
+        Cardiac order of the interaction regressors.
+    order_resp_interact : int (default: 2)
+        Respiratory order of the interaction regressors.
+    hr_rvt : bool (default: True)
+        Whether to add heart rate (bpm) and RVT regressors.
+    resp_index : int (default: 0)
+        Column of the respiratory trace.
+    cardiac_index : int (default: 1)
+        Column of the cardiac trace.
+    trigger_index : int (default: 3)
+        Column marking the onset of every volume (non-zero samples).
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to packed regressor file (see
+        spynoza.utils.save_regressors).
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.denoising.retroicor.nodes.retroicor import (
+        detect_peaks, cardiac_phase, respiratory_phase, slice_onsets)
+    from spynoza.denoising.retroicor.nodes.utils import _load_phys_log
+    from spynoza.utils import save_regressors
+
+    img = nib.load(in_file)
+    n_vols = img.shape[3]
+    n_slices = img.shape['xyz'.index(slice_direction)]
+    if tr is None:
+        tr = float(img.header.get_zooms()[3])
+    # TR must be in seconds
+    if tr > 20:
+        tr = tr / 1000.0
+
+    phys = _load_phys_log(phys_file)
+    resp, card = phys[:, resp_index], phys[:, cardiac_index]
+    triggers = np.flatnonzero(phys[:, trigger_index] > .5)
+    if triggers.size < n_vols:
+        raise ValueError('Found %i volume triggers for %i volumes in %s' %
+                         (triggers.size, n_vols, phys_file))
+    # the last n_vols triggers belong to the scan
+    volume_times = triggers[-n_vols:] / float(sample_rate)
+    times = volume_times[np.newaxis, :] + \
+        slice_onsets(n_slices, tr, slice_timing, slice_order,
+                     MB_factor)[:, np.newaxis]
+    samples = np.clip(np.round(times * sample_rate).astype(int), 0,
+                      len(resp) - 1)
+
+    beats = detect_peaks(card, sample_rate, min_interval=.3) / \
+        float(sample_rate)
+    phase_c = cardiac_phase(times, beats)
+    phase_r = respiratory_phase(resp, sample_rate)[samples]
+
+    names, regressors = [], []
+    for phase, order, label in ((phase_c, order_cardiac, 'card'),
+                                (phase_r, order_resp, 'resp')):
+        for m in range(1, order + 1):
+            regressors += [np.cos(m * phase), np.sin(m * phase)]
+            names += ['%s_cos%i' % (label, m), '%s_sin%i' % (label, m)]
+    for m in range(1, order_cardiac_interact + 1):
+        for n in range(1, order_resp_interact + 1):
+            for sign, op in ((1, '+'), (-1, '-')):
+                combined = m * phase_c + sign * n * phase_r
+                regressors += [np.cos(combined), np.sin(combined)]
+                names += ['card%i%sresp%i_cos' % (m, op, n),
+                          'card%i%sresp%i_sin' % (m, op, n)]
+
+    if hr_rvt:
+        # heart rate (bpm) from the beat intervals
+        intervals = np.diff(beats)
+        hr = np.interp(times, beats[1:] - intervals / 2., 60. / intervals)
+        # respiratory volume per time: breath amplitude over breath period
+        breaths = detect_peaks(resp, sample_rate, min_interval=1.5, smooth=.5)
+        troughs = detect_peaks(-resp, sample_rate, min_interval=1.5,
+                               smooth=.5)
+        trough_values = np.interp(breaths, troughs, resp[troughs])
+        rvt = (resp[breaths[:-1]] - trough_values[:-1]) / \
+            (np.diff(breaths) / float(sample_rate))
+        rvt = np.interp(times, breaths[:-1] / float(sample_rate), rvt)
+        regressors += [hr, rvt]
+        names += ['hr', 'rvt']
+
+    base = os.path.basename(in_file).split('.')[0]
+    out_file = save_regressors(base + '_retroicor.npz',
+                               np.stack(regressors, axis=1), names,
+                               producer='retroicor', tr=tr,
+                               sample_rate=sample_rate,
+                               slice_direction=slice_direction)
+
+    return out_file
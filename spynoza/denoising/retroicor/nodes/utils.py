@@ -18,12 +18,57 @@ def _preprocess_nii_files_to_pnm_evs_prefix(filename):
 
     return out_string
 
-def _distill_slice_times_from_gradients(in_file, phys_file, nr_dummies, MB_factor=1, sample_rate=496):
+def _load_phys_log(phys_file, skiprows=0, cache=True, chunksize=1000000,
+                   cache_dir=None):
+    """ Reads a whitespace-delimited physiology log into a float array with
+    pandas' C parser, in chunks, and caches the parsed columns as a binary
+    .npy under cache_dir (defaults to $SPYNOZA_CACHE_DIR or
+    ~/.cache/spynoza), keyed on the log's path, size and modification time
+    and on skiprows, as load_nifti_indexed caches its indices.
+    """
     import os
+    import hashlib
     import numpy as np
     import pandas as pd
+
+    if cache:
+        if cache_dir is None:
+            cache_dir = os.environ.get('SPYNOZA_CACHE_DIR', os.path.join(
+                os.path.expanduser('~'), '.cache', 'spynoza'))
+        cache_dir = os.path.join(cache_dir, 'phys_log')
+        stat = os.stat(phys_file)
+        key = hashlib.sha1(('%s:%i:%i:%i' % (os.path.abspath(phys_file),
+                                             stat.st_size, stat.st_mtime_ns,
+                                             skiprows)).encode())
+        cache_file = os.path.join(cache_dir, key.hexdigest() + '.npy')
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
+
+    reader = pd.read_csv(phys_file, sep=r'\s+', header=None, comment='#',
+                         skiprows=skiprows, engine='c', chunksize=chunksize,
+                         dtype=np.float64)
+    phys = np.concatenate([chunk.values for chunk in reader])
+
+    if cache:
+        tmp_file = '%s.%i.tmp.npy' % (cache_file[:-4], os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            np.save(tmp_file, phys)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # read-only location; parse again next time
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return phys
+
+
+def _distill_slice_times_from_gradients(in_file, phys_file, nr_dummies, MB_factor=1, sample_rate=496):
+    import os
+    import numpy as np
     import nibabel as nib
-    import matplotlib.pyplot as plt
+    from spynoza.denoising.retroicor.nodes.utils import _load_phys_log
+    from spynoza.qc.nodes import write_qc_data
     
     # output:
     name, fext = os.path.splitext(os.path.basename(in_file))
@@ -37,26 +82,29 @@ def _distill_slice_times_from_gradients(in_file, phys_file, nr_dummies, MB_facto
     tr = float(nifti.header['pixdim'][4])
     
     # load physio data:
-    phys = np.loadtxt(phys_file, skiprows=5)
+    phys = _load_phys_log(phys_file, skiprows=5)
     
     # compute gradient signal as sum x y z, and z-score:
     gradients = [6,7,8]
-    gradient_signal = np.array([phys[:,g] for g in gradients]).sum(axis=0)
+    gradient_signal = phys[:,gradients].sum(axis=1)
     gradient_signal = (gradient_signal-gradient_signal.mean()) / gradient_signal.std()
     
-    # threshold:
+    # threshold: the highest of 4.9, 4.8, ... that more than 12.5 samples
+    # per slice exceed in a 10 TR window, from a single sort of that window
     time_window_start = int(gradient_signal.shape[0]/2.0)
     time_window_end = int(time_window_start + (10 * tr * sample_rate))
-    threshold = 5
-    loop = True
-    while loop:
-        threshold -= 0.1
-        if (gradient_signal[time_window_start:time_window_end]>threshold).sum() > (10 * nr_slices * 1.25):
-            loop = False
+    window = np.sort(gradient_signal[time_window_start:time_window_end])
+    if window.shape[0] <= 10 * nr_slices * 1.25:
+        raise ValueError('Too few gradient samples in %s' % phys_file)
+    nr_steps = int(max(5 - window[0], 0) / 0.1) + 2
+    thresholds = np.subtract.accumulate(np.r_[5, np.full(nr_steps, 0.1)])[1:]
+    nr_above = window.shape[0] - np.searchsorted(window, thresholds, side='right')
+    threshold = thresholds[np.argmax(nr_above > (10 * nr_slices * 1.25))]
     
-    # slice time indexes:
+    # slice time indexes, from the rising edges of the thresholded signal:
     x = np.arange(gradient_signal.shape[0])
-    slice_times = x[np.r_[False, np.array(np.diff(np.array(gradient_signal>threshold, dtype=int))==1, dtype=bool)]]
+    above = gradient_signal > threshold
+    slice_times = np.flatnonzero(above[1:] & ~above[:-1]) + 1
     
     # check if we had a double (due to shape gradient signal):
     if slice_times.shape[0] > (nr_volumes*nr_slices*2):
@@ -84,24 +132,21 @@ def _distill_slice_times_from_gradients(in_file, phys_file, nr_dummies, MB_facto
     dummies_volumes_timecourse[slice_times[dummy_volumes]] = 1    
     
     # output new physio file:
-    phys_new = np.hstack((np.asmatrix(phys[:,4]).T, np.asmatrix(phys[:,5]).T, np.asmatrix(scan_slices_timecourse).T, np.asmatrix(scan_volumes_timecourse).T))
+    phys_new = np.column_stack((phys[:,4], phys[:,5], scan_slices_timecourse, scan_volumes_timecourse))
     np.savetxt(out_file, phys_new, fmt=str('%3.2f'), delimiter='\t')
     
-    # generate a list of figures:
+    # QC data of the figures (rendered later by render_qc):
     plot_timewindow = [np.arange(0, slice_times[dummy_volumes[-1]]+(4*sample_rate)),
                        np.arange(x.shape[0]-(8*sample_rate), x.shape[0]),]
-    f = plt.figure(figsize = (15,6))                
+    arrays = {}
     for i, times in enumerate(plot_timewindow):
-        s = f.add_subplot(2,1,i+1)
-        plt.plot(x[times], gradient_signal[times], label='summed gradient signal (x, y, z)')
-        plt.plot(x[times], dummies_volumes_timecourse[times]*threshold*1.5, 'k', lw=3, label='dummies')
-        plt.plot(x[times], scan_volumes_timecourse[times]*threshold*1.5, 'g', lw=3, label='triggers')
-        plt.axhline(threshold, color='r', ls='--', label='threshold')
-        s.set_title('summed gradient signal (x, y, z) -- nr volumes = {}'.format(sum(scan_volumes_timecourse)))
-        s.set_xlabel('samples, {}Hz'.format(sample_rate))
-        plt.ylim((0,threshold*1.5))
-        plt.legend(loc=2)
-    plt.tight_layout()
-    f.savefig(fig_file)
+        arrays['samples_%i' % i] = x[times]
+        arrays['gradient_%i' % i] = gradient_signal[times]
+        arrays['dummies_%i' % i] = dummies_volumes_timecourse[times]
+        arrays['triggers_%i' % i] = scan_volumes_timecourse[times]
+    qc_file = write_qc_data('gradients', fig_file, arrays,
+                            threshold=float(threshold),
+                            sample_rate=sample_rate,
+                            nr_volumes=float(scan_volumes_timecourse.sum()))
     
-    return out_file, fig_file
+    return out_file, qc_file
@@ -0,0 +1,77 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes.utils import _load_phys_log, _distill_slice_times_from_gradients
+
+
+def _write_log(fn, sample_rate, tr, n_slices, n_dummies, n_vols):
+    # shimming, a pause, then dummies and scans with one gradient blip
+    # (3 samples) per slice
+    slice_gap = int(tr * sample_rate / n_slices)
+    shims = np.arange(50, 50 + 20 * slice_gap, slice_gap)
+    scan = shims[-1] + 20 * sample_rate + \
+        np.arange((n_dummies + n_vols) * n_slices) * slice_gap
+    n_samples = scan[-1] + 10 * sample_rate
+    phys = np.zeros((n_samples, 10))
+    phys[:, 4] = np.sin(np.arange(n_samples) / 100.)
+    phys[:, 5] = np.cos(np.arange(n_samples) / 30.)
+    for onset in np.r_[shims, scan]:
+        phys[onset:onset + 3, 6:9] = 100.
+    with open(fn, 'w') as f:
+        f.write('## Philips physiology log\n' * 5)
+        np.savetxt(f, phys, fmt='%i')
+        f.write('# == END ==\n')
+    return scan
+
+
+@pytest.mark.retroicor
+def test_load_phys_log(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    cache_dir = tmpdir.mkdir('cache')
+    monkeypatch.setenv('SPYNOZA_CACHE_DIR', str(cache_dir))
+    fn = op.abspath('SCANPHYSLOG.log')
+    _write_log(fn, 100, 2., 10, 2, 20)
+    phys = _load_phys_log(fn, skiprows=5)
+    np.testing.assert_array_equal(phys, np.loadtxt(fn, skiprows=5))
+    # the cache lives in the cache dir, not next to the log
+    assert not op.exists(fn + '.npy')
+    cache_files = cache_dir.join('phys_log').listdir()
+    assert len(cache_files) == 1
+
+    # the cache is used as long as the log is unchanged
+    np.save(str(cache_files[0]), phys[:10])
+    assert _load_phys_log(fn, skiprows=5).shape[0] == 10
+    # ... and is separate per skiprows
+    assert _load_phys_log(fn, skiprows=6).shape[0] == phys.shape[0] - 1
+    os.utime(fn, (op.getmtime(fn) + 10,) * 2)
+    assert _load_phys_log(fn, skiprows=5).shape == phys.shape
+
+
+@pytest.mark.retroicor
+def test_distill_slice_times_from_gradients(tmpdir):
+    tmpdir.chdir()
+    sample_rate, tr, n_slices, n_dummies, n_vols = 100, 2., 10, 2, 20
+    fn = op.abspath('SCANPHYSLOG.log')
+    scan = _write_log(fn, sample_rate, tr, n_slices, n_dummies, n_vols)
+    img = nib.Nifti1Image(np.zeros((2, 2, n_slices, n_vols), np.float32),
+                          np.eye(4))
+    img.header.set_zooms((1, 1, 1, tr))
+    in_file = op.abspath('run.nii')
+    nib.save(img, in_file)
+
+    out_file, qc_file = _distill_slice_times_from_gradients(
+        in_file, fn, n_dummies, sample_rate=sample_rate)
+    new_phys = np.loadtxt(out_file)
+    slices = np.flatnonzero(new_phys[:, 2])
+    volumes = np.flatnonzero(new_phys[:, 3])
+    # every slice blip of the scan is found, one trigger per TR
+    assert slices.shape[0] == n_vols * n_slices
+    assert np.isin(slices, scan).all()
+    assert volumes.shape[0] == n_vols
+    np.testing.assert_array_equal(np.diff(volumes), tr * sample_rate)
+    np.testing.assert_array_equal(volumes, slices[::n_slices])
+    # only the data of the QC figure is written
+    assert qc_file == op.abspath('run_fig.npz')
+    assert not op.exists('run_fig.png')
@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes.retroicor import retroicor_regressors, cardiac_phase
+from ..workflows import create_retroicor_workflow
+
+
+@pytest.mark.retroicor
+def test_retroicor_regressors(tmpdir):
+    tmpdir.chdir()
+    sample_rate, tr, n_vols, n_slices = 100., 2., 20, 10
+    t = np.arange(int((n_vols * tr + 30) * sample_rate)) / sample_rate
+
+    # 66 bpm pulse, 15 breaths per minute, scan starts after 10 s
+    beats = np.arange(.3, t[-1], 1 / 1.1)
+    card = np.exp(-(t[:, np.newaxis] - beats) ** 2 / (2 * .03 ** 2)).sum(1)
+    card += .05 * np.random.RandomState(0).randn(t.size)
+    resp = np.sin(2 * np.pi * .25 * t)
+    triggers = np.zeros(t.size)
+    triggers[(np.arange(n_vols) * tr * sample_rate + 10 * sample_rate).astype(int)] = 1
+    phys_file = op.abspath('phys_new.log')
+    np.savetxt(phys_file, np.c_[resp, card, np.zeros(t.size), triggers])
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, n_slices, n_vols), np.float32),
+                             np.eye(4)), in_file)
+
+    out_file = retroicor_regressors(in_file, phys_file, tr=tr,
+                                    sample_rate=sample_rate)
+    packed = np.load(out_file)
+    regressors, names = packed['regressors'], list(packed['names'])
+    # as many regressors as pnm_evs makes by default
+    assert regressors.shape == (n_slices, 34, n_vols)
+    assert names[:2] == ['card_cos1', 'card_sin1'] and names[-2:] == ['hr', 'rvt']
+
+    # ascending slices, one every tr / n_slices
+    times = (np.arange(n_vols) * tr + 10)[np.newaxis, :] + \
+        (np.arange(n_slices) * tr / n_slices)[:, np.newaxis]
+    phase = np.arctan2(regressors[:, 1], regressors[:, 0])
+    error = np.angle(np.exp(1j * (phase - cardiac_phase(times, beats))))
+    assert np.abs(error).max() < .1
+    np.testing.assert_allclose(regressors[:, -2], 66., atol=1.)
+    np.testing.assert_allclose(regressors[:, -1], .5, atol=.05)
+
+
+@pytest.mark.retroicor
+def test_create_retroicor_workflow_native():
+    wf = create_retroicor_workflow(method='native')
+    assert wf.get_node('retroicor_native').iterfield == ['in_file', 'phys_file']
+    assert wf.get_node('pnm_evs') is None
@@ -1,12 +1,16 @@
 import nipype.pipeline as pe
 from .nodes.pnm import PreparePNM, PNMtoEVs
+from .nodes.retroicor import retroicor_regressors
+from ...qc.nodes import Render_qc
+from ...utils import Pack_regressors
 from .nodes.utils import (_distill_slice_times_from_gradients,
                           _preprocess_nii_files_to_pnm_evs_prefix,
                           _slice_times_to_txt_file)
 import nipype.interfaces.utility as niu
 
 
-def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
+def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order', method = 'fsl',
+                              render_qc = False):
     
     """
     
@@ -19,6 +23,19 @@ def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
         inputnode.in_file - The .log file acquired together with EPI sequence
     Outputs::
         outputnode.regressor_files
+        outputnode.qc_files - QC data of the gradient/trigger figures
+        outputnode.fig_file - the rendered figures (if render_qc)
+
+    With method = 'fsl', the regressors are made by popp and pnm_evs (one
+    nifti-file per regressor); with method = 'native', all regressors of a
+    run are computed in python. Either way, outputnode.regressor_file holds
+    a single packed regressor file per run (slices x regressors x time),
+    which fit_nuisances memory-maps.
+
+    Unless render_qc = True, the QC figures are not rendered here, but left
+    (outputnode.qc_files) to a single, subject-level render_qc node
+    (spynoza.qc.nodes.Render_qc) that collects the QC data of all
+    workflows.
     """
     
     # Define nodes:
@@ -36,9 +53,12 @@ def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
 
     # the slice time preprocessing node before we go into popp (PreparePNM)
     slice_times_from_gradients = pe.MapNode(niu.Function(input_names=['in_file', 'phys_file', 'nr_dummies', 'MB_factor', 'sample_rate'], 
-                        output_names=['out_file', 'fig_file'], 
+                        output_names=['out_file', 'qc_file'], 
                         function=_distill_slice_times_from_gradients), name='slice_times_from_gradients', iterfield = ['in_file','phys_file'])
     
+    # renders the QC figures once all runs are done
+    qc_renderer = pe.Node(Render_qc, name='render_qc')
+
     slice_times_to_txt_file = pe.Node(niu.Function(input_names=['slice_times'], 
                         output_names=['out_file'], 
                         function=_slice_times_to_txt_file), name='slice_times_to_txt_file')
@@ -51,8 +71,14 @@ def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
 
     pnm_evs = pe.MapNode(PNMtoEVs(), name='pnm_evs', iterfield = ['functional_epi', 'cardiac', 'resp', 'hr', 'rvt', 'prefix'])
 
+    retroicor = pe.MapNode(niu.Function(input_names=['in_file', 'phys_file', 'tr', 'sample_rate', 'slice_timing', 'slice_order', 'slice_direction', 'MB_factor', 'hr_rvt'],
+                        output_names=['out_file'],
+                        function=retroicor_regressors), name='retroicor_native', iterfield = ['in_file', 'phys_file'])
+
+    pack_evs = pe.MapNode(Pack_regressors, name='pack_evs', iterfield = ['slice_regressor_list'])
+
     # Define output node
-    output_node = pe.Node(niu.IdentityInterface(fields=['new_phys', 'fig_file', 'evs']), name='outputspec')
+    output_node = pe.Node(niu.IdentityInterface(fields=['new_phys', 'fig_file', 'qc_files', 'evs', 'regressor_file']), name='outputspec')
 
     ########################################################################################
     # workflow
@@ -67,6 +93,28 @@ def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
     retroicor_workflow.connect(input_node, 'MB_factor', slice_times_from_gradients, 'MB_factor')
     retroicor_workflow.connect(input_node, 'phys_sample_rate', slice_times_from_gradients, 'sample_rate')
 
+    retroicor_workflow.connect(slice_times_from_gradients, 'out_file', output_node, 'new_phys')
+    retroicor_workflow.connect(slice_times_from_gradients, 'qc_file', output_node, 'qc_files')
+    if render_qc:
+        retroicor_workflow.connect(slice_times_from_gradients, 'qc_file', qc_renderer, 'qc_files')
+        retroicor_workflow.connect(qc_renderer, 'fig_files', output_node, 'fig_file')
+
+    if method == 'native':
+        retroicor_workflow.connect(input_node, 'in_files', retroicor, 'in_file')
+        retroicor_workflow.connect(slice_times_from_gradients, 'out_file', retroicor, 'phys_file')
+        retroicor_workflow.connect(input_node, 'tr', retroicor, 'tr')
+        retroicor_workflow.connect(input_node, 'phys_sample_rate', retroicor, 'sample_rate')
+        retroicor_workflow.connect(input_node, 'slice_direction', retroicor, 'slice_direction')
+        retroicor_workflow.connect(input_node, 'MB_factor', retroicor, 'MB_factor')
+        retroicor_workflow.connect(input_node, 'hr_rvt', retroicor, 'hr_rvt')
+        if order_or_timing == 'timing':
+            retroicor_workflow.connect(input_node, 'slice_timing', retroicor, 'slice_timing')
+        elif order_or_timing == 'order':
+            retroicor_workflow.connect(input_node, 'slice_order', retroicor, 'slice_order')
+        retroicor_workflow.connect(retroicor, 'out_file', output_node, 'evs')
+        retroicor_workflow.connect(retroicor, 'out_file', output_node, 'regressor_file')
+        return retroicor_workflow
+
     # conditional here, for the creation of a separate slice timing file if order_or_timing is 'timing'
     # order_or_timing can also be 'order'
     if order_or_timing == 'timing':
@@ -93,8 +141,8 @@ def create_retroicor_workflow(name = 'retroicor', order_or_timing = 'order'):
     retroicor_workflow.connect(prepare_pnm, 'hr', pnm_evs, 'hr')
     retroicor_workflow.connect(prepare_pnm, 'rvt', pnm_evs, 'rvt')
 
-    retroicor_workflow.connect(slice_times_from_gradients, 'out_file', output_node, 'new_phys')
-    retroicor_workflow.connect(slice_times_from_gradients, 'fig_file', output_node, 'fig_file')
     retroicor_workflow.connect(pnm_evs, 'evs', output_node, 'evs')
+    retroicor_workflow.connect(pnm_evs, 'evs', pack_evs, 'slice_regressor_list')
+    retroicor_workflow.connect(pack_evs, 'out_file', output_node, 'regressor_file')
 
     return retroicor_workflow
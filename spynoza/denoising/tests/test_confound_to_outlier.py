@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+import pandas as pd
+import os.path as op
+from ..nodes import confound_to_outlier
+
+
+@pytest.mark.confound_to_outlier
+def test_confound_to_outlier(tmpdir):
+    tmpdir.chdir()
+    fd = np.zeros(20)
+    fd[[5, 12]] = 1.
+    dvars = np.zeros(20)
+    dvars[18] = 3.
+    df = pd.DataFrame({'FramewiseDisplacement': fd, 'std_dvars': dvars})
+    df.loc[0, 'FramewiseDisplacement'] = np.nan
+    in_files = [op.abspath('run-%i_confounds.tsv' % i) for i in (1, 2)]
+    for f in in_files:
+        df.to_csv(f, sep='\t', index=False)
+
+    spike_files, censor_files = confound_to_outlier(
+        in_files, threshold={'FramewiseDisplacement': .5, 'std_dvars': 2.},
+        n_before=1, n_after=2)
+
+    assert len(spike_files) == len(censor_files) == 2
+    assert len(set(spike_files + censor_files)) == 4
+    spikes = pd.read_csv(spike_files[0], sep='\t').values
+    censor = pd.read_csv(censor_files[0], sep='\t')['censor'].values
+
+    expected = [4, 5, 6, 7, 11, 12, 13, 14, 17, 18, 19]
+    np.testing.assert_array_equal(np.flatnonzero(censor == 0), expected)
+    assert spikes.shape == (20, len(expected))
+    np.testing.assert_array_equal(spikes.sum(axis=0), 1)
+    np.testing.assert_array_equal(np.flatnonzero(spikes.sum(axis=1)), expected)
+
+    spike_file, censor_file = confound_to_outlier(
+        in_files[0], threshold=.5, col_name='FramewiseDisplacement')
+    censor = pd.read_csv(censor_file, sep='\t')['censor'].values
+    np.testing.assert_array_equal(np.flatnonzero(censor == 0), [5, 12])
+
+    # runs with the same filename in different directories
+    df.loc[12, 'FramewiseDisplacement'] = 0.
+    same_name = [op.join(str(tmpdir.mkdir(ses)), 'confounds.tsv')
+                 for ses in ('ses-1', 'ses-2')]
+    df.to_csv(same_name[0], sep='\t', index=False)
+    df.assign(FramewiseDisplacement=0.).to_csv(same_name[1], sep='\t',
+                                               index=False)
+    spike_files, censor_files = confound_to_outlier(
+        same_name, threshold=.5, col_name='FramewiseDisplacement')
+    assert len(set(censor_files)) == 2
+    censors = [pd.read_csv(f, sep='\t')['censor'].values
+               for f in censor_files]
+    np.testing.assert_array_equal(np.flatnonzero(censors[0] == 0), [5])
+    assert censors[1].all()
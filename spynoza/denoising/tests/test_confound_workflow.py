@@ -1,16 +1,21 @@
 import pytest
 import os.path as op
 from ..workflows import create_confound_workflow
+from ...masking.nodes import compute_epi_mask
 from ... import test_data_path
 
 test_data_path = op.join(test_data_path, 'sub-0020')
 
 @pytest.mark.confound
-def test_create_confound_workflow():
+def test_create_confound_workflow(tmpdir):
+    tmpdir.chdir()
     confound_wf = create_confound_workflow()
     confound_wf.base_dir = '/tmp/spynoza/workingdir'
     confound_wf.inputs.inputspec.in_file = [op.join(test_data_path, 'func', 'sub-0020_task-harriri_bold_cut_mcf.nii.gz'),
                                             op.join(test_data_path, 'func', 'sub-0020_task-wm_bold_cut_mcf.nii.gz')]
+    mean_file = op.join(test_data_path, 'func', 'sub-0020_task-harriri_meanbold.nii.gz')
+    confound_wf.inputs.inputspec.mean_file = mean_file
+    confound_wf.inputs.inputspec.mask_file = compute_epi_mask(mean_file)
     confound_wf.inputs.inputspec.fast_files = [op.join(test_data_path, 'anat', 'sub-0020_T1w_prob_0.nii.gz'),
                                              op.join(test_data_path, 'anat', 'sub-0020_T1w_prob_1.nii.gz'),
                                              op.join(test_data_path, 'anat', 'sub-0020_T1w_prob_2.nii.gz')]
@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import os.path as op
+from ..nodes import regress_and_filter
+
+
+@pytest.mark.parametrize('basis', ['dct', 'savgol'])
+@pytest.mark.regress_and_filter
+def test_regress_and_filter(tmpdir, basis):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    n_vols, tr = 200, 2.
+    t = np.arange(n_vols) * tr
+    conf = rs.randn(n_vols, 2)
+    drift = np.cos(2 * np.pi * t / 600.)
+    signal = np.sin(2 * np.pi * t / 20.)
+
+    data = (rs.randn(4, 4, 3, n_vols) * .1 + 100 + signal * 2 + drift * 5 +
+            conf.dot([3., -2.]))
+    hdr = nib.Nifti1Header()
+    hdr['pixdim'][4] = tr
+    in_file = op.abspath('bold.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4), hdr), in_file)
+    conf_file = op.abspath('confounds.tsv')
+    pd.DataFrame(conf, columns=['a', 'b']).to_csv(conf_file, sep='\t',
+                                                  index=False)
+
+    out = regress_and_filter(in_file, confounds=conf_file, basis=basis)
+    clean = nib.load(out).get_fdata().reshape((-1, n_vols))
+
+    np.testing.assert_allclose(clean.mean(axis=1),
+                               data.reshape((-1, n_vols)).mean(axis=1),
+                               rtol=1e-4)
+    clean -= clean.mean(axis=1, keepdims=True)
+    # confounds and drift are gone, the signal of interest is preserved
+    for regressor in (conf[:, 0], conf[:, 1], drift):
+        corr = [np.corrcoef(c, regressor)[0, 1] for c in clean]
+        assert np.max(np.abs(corr)) < .1
+    corr = [np.corrcoef(c, signal)[0, 1] for c in clean]
+    assert np.min(corr) > .9
+
+    # a TR stored in ms in the header gives the same result
+    hdr['pixdim'][4] = tr * 1000
+    ms_file = op.abspath('bold_ms.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4), hdr), ms_file)
+    np.testing.assert_allclose(
+        nib.load(regress_and_filter(ms_file, confounds=conf_file,
+                                    basis=basis)).get_fdata(),
+        nib.load(out).get_fdata(), rtol=1e-5)
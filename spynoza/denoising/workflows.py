@@ -11,6 +11,8 @@ def create_confound_workflow(name='confound'):
 
     input_node = pe.Node(interface=IdentityInterface(fields=[
         'in_file',
+        'mean_file',
+        'mask_file',
         'par_file',
         'fast_files',
         'highres2epi_mat',
@@ -28,7 +30,7 @@ def create_confound_workflow(name='confound'):
     datasink.inputs.parameterization = False
 
     compute_DVARS = pe.MapNode(ComputeDVARS(save_all=True, remove_zerovariance=True),
-                               iterfield=['in_file', 'in_mask'], name='compute_DVARS')
+                               iterfield=['in_file'], name='compute_DVARS')
 
     motion_wf = create_motion_confound_workflow(order=2)
 
@@ -43,6 +45,10 @@ def create_confound_workflow(name='confound'):
     compcor_wf = create_compcor_workflow()
     confound_wf.connect(input_node, 'in_file',
                         compcor_wf, 'inputspec.in_file')
+    confound_wf.connect(input_node, 'mean_file',
+                        compcor_wf, 'inputspec.mean_file')
+    confound_wf.connect(input_node, 'mask_file',
+                        compcor_wf, 'inputspec.mask_file')
     confound_wf.connect(input_node, 'fast_files',
                         compcor_wf, 'inputspec.fast_files')
     confound_wf.connect(input_node, 'highres2epi_mat',
@@ -56,8 +62,7 @@ def create_confound_workflow(name='confound'):
     confound_wf.connect(input_node, 'output_directory',
                         compcor_wf, 'inputspec.output_directory')
 
-    confound_wf.connect(compcor_wf, 'outputspec.epi_mask', compute_DVARS,
-                        'in_mask')
+    confound_wf.connect(input_node, 'mask_file', compute_DVARS, 'in_mask')
     confound_wf.connect(input_node, 'in_file', compute_DVARS, 'in_file')
 
     concat = pe.MapNode(Concat_confound_files, iterfield=['ext_par_file',
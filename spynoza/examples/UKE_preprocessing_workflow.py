@@ -18,6 +18,7 @@ def create_preprocessing_workflow(analysis_params, name='yesno_3T'):
     from spynoza.denoising.retroicor.workflows import create_retroicor_workflow
     from spynoza.masking.workflows import create_masks_from_surface_workflow
     from spynoza.glm.nodes import fit_nuisances
+    from spynoza.qc.nodes import Render_qc
 
     ########################################################################################
     # nodes
@@ -176,6 +177,15 @@ def create_preprocessing_workflow(analysis_params, name='yesno_3T'):
     preprocessing_workflow.connect(sgfilter, 'out_file', psc, 'in_file')
     preprocessing_workflow.connect(psc, 'out_file', datasink, 'psc')
 
+    # QC figures of all sub-workflows are rendered by a single node, once the
+    # heavy processing is done: it waits for the final (psc) outputs (AFNI
+    # motion correction makes no plots)
+    if analysis_params['moco_method'] != 'AFNI':
+        render_qc = pe.Node(interface=Render_qc, name='render_qc')
+        preprocessing_workflow.connect(motion_proc, 'outputspec.qc_files', render_qc, 'qc_files')
+        preprocessing_workflow.connect(psc, 'out_file', render_qc, 'wait_for')
+        preprocessing_workflow.connect(render_qc, 'fig_files', datasink, 'qc')
+
     # # retroicor functionality
     # if analysis_params['perform_physio'] == 1:
     #     retr = create_retroicor_workflow(name = 'retroicor', order_or_timing = analysis_params['retroicor_order_or_timing'])
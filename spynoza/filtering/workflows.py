@@ -42,10 +42,15 @@ tolist = lambda x: [x]
 
 
 def create_extended_susan_workflow(name='extended_susan', separate_masks=True):
+    """ SUSAN smoothing of (motion corrected) runs within the session brain
+    mask, inputspec.mask_file, e.g. the mask_EPI_space_file output of the
+    motion correction workflow, which is shared with compcor instead of
+    being recomputed here.
+    """
 
     input_node = pe.Node(IdentityInterface(fields=['in_file',
                                                    'fwhm',
-                                                   'EPI_session_space',
+                                                   'mask_file',
                                                    'output_directory',
                                                    'sub_id']), name='inputspec')
 
@@ -63,13 +68,6 @@ def create_extended_susan_workflow(name='extended_susan', separate_masks=True):
     esw.connect(input_node, 'output_directory', datasink, 'base_directory')
     esw.connect(input_node, 'sub_id', datasink, 'container')
 
-    meanfuncmask = pe.Node(interface=fsl.BET(mask=True,
-                                             no_output=True,
-                                             frac=0.3),
-                           name='meanfuncmask')
-
-    esw.connect(input_node, 'EPI_session_space', meanfuncmask, 'in_file')
-
     """
     Mask the functional runs with the extracted mask
     """
@@ -80,7 +78,7 @@ def create_extended_susan_workflow(name='extended_susan', separate_masks=True):
                           name='maskfunc')
 
     esw.connect(input_node, 'in_file', maskfunc, 'in_file')
-    esw.connect(meanfuncmask, 'mask_file', maskfunc, 'in_file2')
+    esw.connect(input_node, 'mask_file', maskfunc, 'in_file2')
 
     """
     Determine the 2nd and 98th percentile intensities of each functional run
@@ -223,7 +221,7 @@ if __name__ == '__main__':
     smooth_wf = create_extended_susan_workflow(separate_masks=True)
     smooth_wf.base_dir = '/tmp/spynoza/workingdir'
     smooth_wf.inputs.inputspec.in_file = [op.join(test_data_path, 'sub-0020_gstroop_cut.nii.gz')]
-    smooth_wf.inputs.inputspec.EPI_session_space = op.join(test_data_path, 'sub-0020_gstroop_meanbold.nii.gz')
+    smooth_wf.inputs.inputspec.mask_file = op.join(test_data_path, 'sub-0020_gstroop_meanbold_mask.nii.gz')
     smooth_wf.inputs.inputspec.output_directory = '/tmp/spynoza'
     smooth_wf.inputs.inputspec.sub_id = 'sub-0020'
     smooth_wf.inputs.inputspec.fwhm = 5
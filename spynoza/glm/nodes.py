@@ -14,8 +14,10 @@ def fit_nuisances(in_file, slice_regressor_list=[], vol_regressors='',
     ----------
     in_file : str
         Absolute path to nifti-file.
-    slice_regressor_list : list
-        list of absolute paths to per-slice regressor nifti files
+    slice_regressor_list : list or str
+        list of absolute paths to per-slice regressor nifti files and/or
+        packed regressor files (see spynoza.utils.save_regressors), which
+        are memory-mapped; a single packed file may be given as a str
     vol_regressor_list : str
         absolute path to per-TR regressor text file
 
@@ -34,28 +36,32 @@ def fit_nuisances(in_file, slice_regressor_list=[], vol_regressors='',
     import numpy as np
     import numpy.linalg as LA
     import os
-    from sklearn import decomposition
+    from spynoza.utils import load_regressors
 
     func_nii = nib.load(in_file)
     dims = func_nii.shape
     affine = func_nii.affine
 
     # import data and convert nans to numbers
-    func_data = np.nan_to_num(func_nii.get_data())
+    func_data = np.nan_to_num(np.asanyarray(func_nii.dataobj))
 
-    all_slice_reg = np.zeros(
-        (len(slice_regressor_list) + 1, dims[-2], dims[-1]))
-    # intercept
-    all_slice_reg[0, :, :] = 1
-    # fill the regressor array from files
-    for i in range(len(slice_regressor_list)):
-        all_slice_reg[i + 1] = nib.load(
-            slice_regressor_list[i]).get_data().squeeze()
+    if isinstance(slice_regressor_list, str):
+        slice_regressor_list = [slice_regressor_list]
+
+    # blocks of (slices, regressors, time), starting with the intercept;
+    # blocks with a single slice apply to all slices
+    slice_reg_blocks = [np.ones((1, 1, dims[-1]))]
+    for f in slice_regressor_list:
+        if f.endswith('.npz'):
+            slice_reg_blocks.append(load_regressors(f)[0])
+        else:
+            slice_reg_blocks.append(np.asanyarray(
+                nib.load(f).dataobj).squeeze()[:, np.newaxis, :])
+    nr_slice_regs = sum(b.shape[1] for b in slice_reg_blocks) - 1
 
     if vol_regressors != '':
         all_TR_reg = np.loadtxt(vol_regressors)
-        if all_TR_reg.shape[-1] != all_slice_reg.shape[
-            -1]:  # check for the right format
+        if all_TR_reg.shape[-1] != dims[-1]:  # check for the right format
             all_TR_reg = all_TR_reg.T
 
     # data containers
@@ -64,22 +70,24 @@ def fit_nuisances(in_file, slice_regressor_list=[], vol_regressors='',
     if num_components == 0:
         if vol_regressors != '':
             beta_data = np.zeros(list(dims[:-1]) + [
-                1 + len(slice_regressor_list) + all_TR_reg.shape[0]])
+                1 + nr_slice_regs + all_TR_reg.shape[0]])
         else:
             beta_data = np.zeros(
-                list(dims[:-1]) + [1 + len(slice_regressor_list)])
+                list(dims[:-1]) + [1 + nr_slice_regs])
     else:
         beta_data = np.zeros(list(dims[:-1]) + [num_components])
 
     # loop over slices
     for x in range(dims[-2]):
         slice_data = func_data[:, :, x, :].reshape((-1, dims[-1]))
-        all_regressors = all_slice_reg[:, x, :]
+        all_regressors = np.vstack(
+            [b[min(x, b.shape[0] - 1)] for b in slice_reg_blocks])
         if vol_regressors != '':
             all_regressors = np.vstack((all_regressors, all_TR_reg))
         all_regressors = np.nan_to_num(all_regressors)
 
         if num_components != 0:
+            from sklearn import decomposition
             if method == 'PCA':
                 pca = decomposition.PCA(n_components=num_components,
                                         whiten=True)
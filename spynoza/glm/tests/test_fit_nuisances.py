@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes import fit_nuisances
+from ...utils import save_regressors, load_regressors, pack_regressors
+
+
+def _make_data(n_slices=3, n_vols=60, seed=0):
+    rs = np.random.RandomState(seed)
+    slice_regs = rs.randn(2, n_slices, n_vols)
+    vol_regs = rs.randn(n_vols, 2)
+    betas = rs.randn(4, 4, n_slices, 4)
+    data = 100 + np.einsum('xysr,rst->xyst', betas[..., :2], slice_regs) + \
+        np.einsum('xysr,tr->xyst', betas[..., 2:], vol_regs) + \
+        .01 * rs.randn(4, 4, n_slices, n_vols)
+    return data, slice_regs, vol_regs
+
+
+@pytest.mark.glm
+def test_packed_regressors(tmpdir):
+    tmpdir.chdir()
+    regressors = np.random.RandomState(0).randn(3, 2, 60)
+    out_file = save_regressors('run_regressors.npz', regressors,
+                               ['card_cos1', 'card_sin1'], producer='test')
+    assert out_file == op.abspath('run_regressors.npz')
+
+    packed, names, metadata = load_regressors(out_file)
+    assert isinstance(packed, np.memmap)
+    np.testing.assert_allclose(packed, regressors, rtol=1e-6)
+    assert names == ['card_cos1', 'card_sin1']
+    assert metadata == {'producer': 'test'}
+
+    with pytest.raises(ValueError):
+        save_regressors('bad.npz', regressors, ['card_cos1'])
+
+
+@pytest.mark.glm
+def test_fit_nuisances_packed(tmpdir):
+    tmpdir.chdir()
+    data, slice_regs, vol_regs = _make_data()
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), in_file)
+
+    # one nifti-file per regressor, as PNMtoEVs writes them
+    ev_files = []
+    for i, reg in enumerate(slice_regs):
+        ev_files.append(op.abspath('run_ev%03i.nii.gz' % (i + 1)))
+        nib.save(nib.Nifti1Image(reg[np.newaxis, np.newaxis].astype(np.float32),
+                                 np.eye(4)), ev_files[-1])
+    vol_file = op.abspath('motion.txt')
+    np.savetxt(vol_file, vol_regs)
+
+    res_file, rsq_file, beta_file = fit_nuisances(
+        in_file, ev_files, vol_file, num_components=0)
+    betas = nib.load(beta_file).get_fdata()
+    assert betas.shape == (4, 4, 3, 5)
+    assert (nib.load(rsq_file).get_fdata() > .99).all()
+
+    # the same regressors from a single packed file give the same fit
+    packed = pack_regressors(ev_files, vol_file)
+    assert op.basename(packed) == 'run_ev001_packed.npz'
+    assert load_regressors(packed)[0].shape == (3, 4, 60)
+    _, _, packed_beta_file = fit_nuisances(in_file, packed,
+                                           num_components=0)
+    np.testing.assert_allclose(nib.load(packed_beta_file).get_fdata(),
+                               betas, atol=1e-4)
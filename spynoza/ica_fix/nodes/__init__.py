@@ -1,3 +1,4 @@
 from .melodic4fix import Melodic4fix
+from .melodic import Melodic_native
 
-__all__ = ['Melodic4fix']
+__all__ = ['Melodic4fix', 'Melodic_native']
@@ -0,0 +1,308 @@
+from nipype.interfaces.utility import Function
+
+
+def randomized_svd(data, n_components, n_oversamples=None, n_iter=4, seed=0):
+    """ Truncated SVD by random projection (Halko et al., 2011).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Matrix of shape (n, m), with n << m (e.g., time x voxels).
+    n_components : int
+        Number of singular values/vectors to compute.
+    n_oversamples : int
+        Additional random projections, for accuracy; defaults to
+        n_components, as the flat noise part of fMRI spectra is otherwise
+        underestimated.
+    n_iter : int (default: 4)
+        Number of power iterations.
+    seed : int (default: 0)
+        Seed of the random projection.
+
+    Returns
+    -------
+    U : np.ndarray
+        Left singular vectors, shape (n, n_components).
+    s : np.ndarray
+        Singular values, descending.
+    Vt : np.ndarray
+        Right singular vectors, shape (n_components, m).
+    """
+    import numpy as np
+
+    if n_oversamples is None:
+        n_oversamples = n_components
+    n_random = min(n_components + n_oversamples, data.shape[0])
+    omega = np.random.RandomState(seed).randn(data.shape[1], n_random)
+    Q = data.dot(omega.astype(data.dtype))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(Q)
+        Q = data.dot(data.T.dot(Q))
+    Q, _ = np.linalg.qr(Q)
+    Ub, s, Vt = np.linalg.svd(Q.T.dot(data).astype(np.float64),
+                              full_matrices=False)
+    U = Q.dot(Ub)
+    return U[:, :n_components], s[:n_components], Vt[:n_components]
+
+
+def estimate_dimension(eigenvalues, n_samples, n_features, total_variance,
+                       method='lap'):
+    """ Estimates the number of components of a PCA with Minka's (2000)
+    Laplace approximation of the model evidence or with BIC.
+
+    Only the leading eigenvalues need to be known: the remaining ones are
+    summarised by the total variance, and taken to be at the noise level.
+
+    Parameters
+    ----------
+    eigenvalues : np.ndarray
+        Leading eigenvalues of the covariance, descending.
+    n_samples : int
+        Number of observations (voxels for spatial ICA).
+    n_features : int
+        Dimensionality of the observations (time points).
+    total_variance : float
+        Sum of all eigenvalues (the trace of the covariance).
+    method : str ['lap', 'bic'] (default: 'lap')
+        Laplace approximation or the Bayesian information criterion.
+
+    Returns
+    -------
+    dim : int
+        Estimated number of components.
+    log_evidence : np.ndarray
+        Log evidence for 1 ... len(eigenvalues) - 1 components.
+    """
+    import numpy as np
+    from scipy.special import gammaln
+
+    lam = np.asarray(eigenvalues, dtype=np.float64)
+    N, d = float(n_samples), n_features
+    n_known = lam.shape[0]
+    log_evidence = np.full(n_known - 1, -np.inf)
+
+    for k in range(1, n_known):
+        # noise level: mean of the discarded eigenvalues
+        v = max((total_variance - lam[:k].sum()) / (d - k), 1e-12)
+        if v >= lam[k - 1]:
+            break
+        m = d * k - k * (k + 1) / 2.
+        pl = -N / 2. * np.log(lam[:k]).sum()
+        pv = -N * (d - k) / 2. * np.log(v)
+        if method == 'bic':
+            log_evidence[k - 1] = pl + pv - (m + k) / 2. * np.log(N)
+            continue
+        i = np.arange(1, k + 1)
+        pu = -k * np.log(2) + (gammaln((d - i + 1) / 2.) -
+                               np.log(np.pi) * (d - i + 1) / 2.).sum()
+        pp = np.log(2 * np.pi) * (m + k) / 2.
+        # pairs of eigenvalues (i, j > i); unknown ones are at the noise level
+        spectrum = np.r_[lam, np.full(d - n_known, v)]
+        spectrum_ = np.r_[lam[:k], np.full(d - k, v)]
+        pa = 0.
+        for ii in range(k):
+            pa += np.log(np.maximum(
+                (lam[ii] - spectrum[ii + 1:]) *
+                (1. / spectrum_[ii + 1:] - 1. / lam[ii]), 1e-300)).sum()
+        pa += k * (d - (k + 1) / 2.) * np.log(N)
+        log_evidence[k - 1] = pu + pl + pv + pp - pa / 2. - \
+            k * np.log(N) / 2.
+
+    return int(np.argmax(log_evidence)) + 1, log_evidence
+
+
+def fast_ica(data, max_iter=500, tol=1e-4, seed=0):
+    """ Symmetric FastICA (logcosh contrast) of whitened data.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Whitened data, shape (components, samples).
+    max_iter : int (default: 500)
+        Maximal number of iterations.
+    tol : float (default: 1e-4)
+        Convergence tolerance.
+    seed : int (default: 0)
+        Seed of the initial unmixing matrix.
+
+    Returns
+    -------
+    W : np.ndarray
+        Orthogonal unmixing matrix, shape (components, components).
+    """
+    import numpy as np
+
+    def _decorrelate(W):
+        s, u = np.linalg.eigh(W.dot(W.T))
+        return u.dot(np.diag(1. / np.sqrt(s))).dot(u.T).dot(W)
+
+    n = data.shape[1]
+    W = _decorrelate(np.random.RandomState(seed).randn(data.shape[0],
+                                                         data.shape[0]))
+    for _ in range(max_iter):
+        g = np.tanh(W.dot(data))
+        W_new = _decorrelate(g.dot(data.T) / n -
+                             np.diag((1 - g ** 2).mean(axis=1)).dot(W))
+        converged = np.abs(np.abs(np.diag(W_new.dot(W.T))) - 1).max() < tol
+        W = W_new
+        if converged:
+            break
+    return W
+
+
+def melodic_native(in_file, out_dir, varnorm=True, dim=None, dim_est='lap',
+                   max_dim=None, brain_thresh=10, max_iter=500, tol=1e-4,
+                   seed=0):
+    """ Spatial ICA of a run with the outputs FIX expects, as a native
+    alternative to running FEAT/MELODIC (melodic4fix).
+
+    The data are masked (FEAT's brain/background threshold on the mean),
+    demeaned and optionally variance-normalised; the dimensionality is
+    estimated from a randomized SVD with a Laplace (or BIC) approximation of
+    the PCA evidence, and FastICA is run on the whitened, reduced data.
+
+    Writes out_dir/filtered_func_data.nii.gz, mask.nii.gz and
+    mean_func.nii.gz, and out_dir/filtered_func_data.ica with melodic_IC
+    (z-scored maps), melodic_mix, melodic_FTmix, melodic_unmix,
+    melodic_ICstats, eigenvalues_percent, mask and mean. FIX additionally
+    needs the mc/ and reg/ directories of the preprocessing.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to (preprocessed) 4D functional nifti-file.
+    out_dir : str
+        Path to the output (.feat-like) directory.
+    varnorm : bool (default: True)
+        Whether to normalise the variance of each voxel.
+    dim : int
+        Number of components; estimated if None.
+    dim_est : str ['lap', 'bic'] (default: 'lap')
+        Dimensionality estimation method.
+    max_dim : int
+        Maximal number of components; defaults to a quarter of the number
+        of volumes.
+    brain_thresh : float (default: 10)
+        Brain/background threshold, in % of the robust range of the mean.
+    max_iter : int (default: 500)
+        Maximal number of FastICA iterations.
+    tol : float (default: 1e-4)
+        FastICA convergence tolerance.
+    seed : int (default: 0)
+        Seed of the random projections and FastICA initialisation.
+
+    Returns
+    -------
+    out_dir : str
+        Absolute path to output directory.
+    """
+    import os
+    import shutil
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import open_nifti_indexed
+    from spynoza.ica_fix.nodes.melodic import (randomized_svd,
+                                               estimate_dimension, fast_ica)
+
+    out_dir = os.path.abspath(out_dir)
+    ica_dir = os.path.join(out_dir, 'filtered_func_data.ica')
+    if not os.path.isdir(ica_dir):
+        os.makedirs(ica_dir)
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        shape, affine = img.shape[:3], img.affine
+        data = np.asanyarray(img.dataobj, dtype=np.float32)
+    n_vols = data.shape[-1]
+
+    mean = data.mean(axis=-1)
+    p2, p98 = np.percentile(mean, [2, 98])
+    mask = mean > p2 + (p98 - p2) * brain_thresh / 100.
+    Y = data[mask].T
+    del data
+    Y -= Y.mean(axis=0)
+    if varnorm:
+        std = Y.std(axis=0)
+        Y /= np.where(std > 0, std, 1)
+    n_voxels = Y.shape[1]
+
+    # PCA of the time x time covariance
+    if max_dim is None:
+        max_dim = max(n_vols // 4, 1)
+    n_known = min(n_vols - 1, (dim or max_dim) + 1)
+    U, s, Vt = randomized_svd(Y, n_known, seed=seed)
+    eigenvalues = s ** 2 / n_voxels
+    total_variance = float((Y.astype(np.float64) ** 2).sum()) / n_voxels
+    estimated = dim is None
+    if estimated:
+        dim, _ = estimate_dimension(eigenvalues, n_voxels, n_vols,
+                                    total_variance, method=dim_est)
+        dim = min(dim, max_dim)
+
+    # ICA on the whitened, reduced data (rows with unit variance)
+    white = Vt[:dim] * np.sqrt(n_voxels)
+    W = fast_ica(white, max_iter=max_iter, tol=tol, seed=seed)
+    sources = W.dot(white)
+    mix = (U[:, :dim] * s[:dim] / np.sqrt(n_voxels)).dot(W.T)
+
+    # maps from the regression of the data on the time courses, z-scored
+    # by the residual standard deviation
+    maps = np.linalg.pinv(mix).dot(Y)
+    resid_std = np.sqrt(((Y - mix.dot(maps)) ** 2).sum(axis=0) /
+                        max(n_vols - dim, 1))
+    zmaps = maps / np.where(resid_std > 0, resid_std, 1)
+
+    # sort by explained variance and make the maps' tails positive
+    explained = (mix ** 2).sum(axis=0) * (maps ** 2).sum(axis=1)
+    order = np.argsort(explained)[::-1]
+    signs = np.sign((sources[order] ** 3).sum(axis=1))
+    signs[signs == 0] = 1
+    mix, zmaps = mix[:, order] * signs, zmaps[order] * signs[:, np.newaxis]
+    explained = explained[order]
+    unmix = np.linalg.pinv(mix)
+
+    def _save(values, fn):
+        vol = np.zeros(shape + values.shape[1:], dtype=np.float32)
+        vol[mask] = values
+        nib.save(nib.Nifti1Image(vol, affine), fn)
+
+    _save(zmaps.T, os.path.join(ica_dir, 'melodic_IC.nii.gz'))
+    for d in (out_dir, ica_dir):
+        _save(np.ones(n_voxels), os.path.join(d, 'mask.nii.gz'))
+    _save(mean[mask], os.path.join(out_dir, 'mean_func.nii.gz'))
+    _save(mean[mask], os.path.join(ica_dir, 'mean.nii.gz'))
+
+    power = np.abs(np.fft.rfft(mix, axis=0)[1:n_vols // 2 + 1]) ** 2
+    np.savetxt(os.path.join(ica_dir, 'melodic_mix'), mix, fmt='%.8e')
+    np.savetxt(os.path.join(ica_dir, 'melodic_FTmix'), power, fmt='%.8e')
+    np.savetxt(os.path.join(ica_dir, 'melodic_unmix'), unmix, fmt='%.8e')
+    np.savetxt(os.path.join(ica_dir, 'melodic_ICstats'),
+               np.c_[100 * explained / explained.sum(),
+                     100 * explained / (total_variance * n_voxels)],
+               fmt='%.4f')
+    np.savetxt(os.path.join(ica_dir, 'eigenvalues_percent'),
+               np.cumsum(eigenvalues) / total_variance * 100, fmt='%.4f')
+    with open(os.path.join(ica_dir, 'log.txt'), 'w') as f:
+        f.write('melodic_native: %i voxels, %i volumes, %i components '
+                '(%s), varnorm=%s\n' % (n_voxels, n_vols, dim,
+                                        dim_est if estimated else 'fixed',
+                                        varnorm))
+
+    func_file = os.path.join(out_dir, 'filtered_func_data.nii.gz')
+    if os.path.lexists(func_file):
+        os.remove(func_file)
+    if in_file.endswith('.nii.gz'):
+        try:
+            os.symlink(os.path.abspath(in_file), func_file)
+        except OSError:
+            shutil.copy(in_file, func_file)
+    else:
+        nib.save(img, func_file)
+
+    return out_dir
+
+
+Melodic_native = Function(function=melodic_native,
+                          input_names=['in_file', 'out_dir', 'varnorm', 'dim',
+                                       'dim_est', 'max_dim', 'brain_thresh',
+                                       'max_iter', 'tol', 'seed'],
+                          output_names=['out_dir'])
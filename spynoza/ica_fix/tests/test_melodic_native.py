@@ -0,0 +1,78 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes.melodic import melodic_native, randomized_svd, estimate_dimension
+from ..workflows import create_melodic_workflow
+
+
+def _make_run(fn, n_sources=4, n_vols=120, seed=0):
+    rs = np.random.RandomState(seed)
+    shape = (16, 16, 12)
+    grid = np.indices(shape)
+    maps = np.array([np.exp(-((grid - rs.randint(3, 13, 3)[:, None, None, None]) ** 2).sum(0) / 8.)
+                     for _ in range(n_sources)])
+    data = 1000 + 30 * np.einsum('tk,kxyz->xyzt', rs.randn(n_vols, n_sources), maps) + \
+        5 * rs.randn(*(shape + (n_vols,)))
+    data[:2] = 0  # background
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), fn)
+    return maps
+
+
+@pytest.mark.ica_fix
+def test_estimate_dimension():
+    rs = np.random.RandomState(1)
+    noise = rs.randn(200, 20000).astype(np.float32)
+    noise -= noise.mean(axis=0)
+    U, s, Vt = randomized_svd(noise, 51)
+    eigenvalues = s ** 2 / noise.shape[1]
+    total = float((noise.astype(np.float64) ** 2).sum()) / noise.shape[1]
+    np.testing.assert_allclose(
+        s, np.linalg.svd(noise.astype(np.float64), compute_uv=False)[:51],
+        rtol=.05)
+    # white noise has no structure
+    for method in ('lap', 'bic'):
+        assert estimate_dimension(eigenvalues, noise.shape[1], 200, total,
+                                  method=method)[0] == 1
+
+
+@pytest.mark.ica_fix
+def test_melodic_native(tmpdir):
+    tmpdir.chdir()
+    in_file = op.abspath('sub-01_task-rest_bold.nii.gz')
+    maps = _make_run(in_file)
+
+    out_dir = melodic_native(in_file, 'rest')
+    assert out_dir == op.abspath('rest')
+    ica_dir = op.join(out_dir, 'filtered_func_data.ica')
+    for f in ('melodic_IC.nii.gz', 'melodic_mix', 'melodic_FTmix',
+              'melodic_unmix', 'melodic_ICstats', 'eigenvalues_percent',
+              'mask.nii.gz', 'mean.nii.gz'):
+        assert op.isfile(op.join(ica_dir, f))
+    for f in ('filtered_func_data.nii.gz', 'mask.nii.gz', 'mean_func.nii.gz'):
+        assert op.exists(op.join(out_dir, f))
+
+    ics = nib.load(op.join(ica_dir, 'melodic_IC.nii.gz')).get_fdata()
+    assert ics.shape == (16, 16, 12, 4)
+    assert np.loadtxt(op.join(ica_dir, 'melodic_mix')).shape == (120, 4)
+    assert np.loadtxt(op.join(ica_dir, 'melodic_FTmix')).shape == (60, 4)
+
+    # every source is recovered by one of the components
+    mask = nib.load(op.join(out_dir, 'mask.nii.gz')).get_fdata() > 0
+    corr = np.corrcoef(np.r_[maps[:, mask], ics[mask].T])[:4, 4:]
+    assert (np.abs(corr).max(axis=1) > .9).all()
+
+
+@pytest.mark.ica_fix
+def test_create_melodic_workflow_native(tmpdir):
+    in_file = str(tmpdir.join('sub-01_task-rest_bold.nii.gz'))
+    _make_run(in_file)
+    wf = create_melodic_workflow(method='native')
+    wf.base_dir = str(tmpdir.join('workingdir'))
+    wf.inputs.inputspec.in_file = [in_file]
+    res = wf.run()
+    node = [n for n in res.nodes() if n.name == 'melodic_native'][0]
+    out_dir = node.result.outputs.out_dir[0]
+    assert op.basename(out_dir) == 'rest'
+    assert op.isfile(op.join(out_dir, 'filtered_func_data.ica', 'melodic_IC.nii.gz'))
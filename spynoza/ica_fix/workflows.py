@@ -1,11 +1,26 @@
 import nipype.pipeline as pe
 import os.path as op
 from nipype.interfaces.utility import Function, IdentityInterface
-from .nodes import Melodic4fix
+from .nodes import Melodic4fix, Melodic_native
 from ..utils import extract_task
 
 
-def create_melodic_workflow(name='melodic', template=None, varnorm=True):
+def create_melodic_workflow(name='melodic', template=None, varnorm=True,
+                            method='fsl'):
+    """ Runs a spatial ICA per run, with outputs FIX can consume.
+
+    Parameters
+    ----------
+    name : str
+        name of workflow
+    template : str
+        melodic .fsf template (method 'fsl' only)
+    varnorm : bool
+        whether to variance-normalise the data
+    method : str ['fsl', 'native'] (default: 'fsl')
+        FEAT with the template, or the native MELODIC-like ICA
+        (melodic_native), which needs no FSL
+    """
 
     input_node = pe.Node(IdentityInterface(
         fields=['in_file']), name='inputspec')
@@ -17,13 +32,18 @@ def create_melodic_workflow(name='melodic', template=None, varnorm=True):
         template = op.join(op.dirname(op.dirname(op.abspath(__file__))),
                            'data', 'fsf_templates', 'melodic_template.fsf')
 
-    melodic4fix_node = pe.MapNode(interface=Melodic4fix,
-                                  iterfield=['in_file', 'out_dir'],
-                                  name='melodic4fix')
-
-    # Don't know if this works. Could also set these defaults inside the
-    # melodic4fix node definition...
-    melodic4fix_node.inputs.template = template
+    if method == 'native':
+        melodic4fix_node = pe.MapNode(interface=Melodic_native,
+                                      iterfield=['in_file', 'out_dir'],
+                                      name='melodic_native')
+    else:
+        melodic4fix_node = pe.MapNode(interface=Melodic4fix,
+                                      iterfield=['in_file', 'out_dir'],
+                                      name='melodic4fix')
+
+        # Don't know if this works. Could also set these defaults inside the
+        # melodic4fix node definition...
+        melodic4fix_node.inputs.template = template
     melodic4fix_node.inputs.varnorm = varnorm
 
     rename_ica = pe.MapNode(Function(input_names=['in_file'],
@@ -27,3 +27,122 @@ FS_LabelNode = Function(input_names=('freesurfer_subject_ID',
                                            'label_directory', 're'),
                               output_names='label_list',
                               function=FS_label_list_glob)
+
+
+def epi_mask_from_mean(mean_data, opening_iter=2):
+    """ Computes a brain mask from a (mean) EPI volume.
+
+    Separates brain from background with a two-class intensity clustering
+    (Otsu's threshold) and cleans up the result morphologically: opening,
+    keeping the largest connected component, closing and hole filling.
+
+    Parameters
+    ----------
+    mean_data : np.ndarray
+        3D array with the (mean) EPI data.
+    opening_iter : int (default: 2)
+        Number of iterations of the binary opening.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean 3D brain mask.
+    """
+    import numpy as np
+    import scipy.ndimage as nd
+
+    data = np.nan_to_num(np.asarray(mean_data, dtype=np.float64))
+    values = data[data > 0]
+    if values.size == 0:
+        return np.zeros(data.shape, dtype=bool)
+
+    # Otsu: maximise between-class variance over all histogram bins at once
+    hist, edges = np.histogram(values, bins=256)
+    centers = (edges[:-1] + edges[1:]) / 2.
+    w0 = np.cumsum(hist).astype(np.float64)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers) / np.maximum(w0, 1)
+    m1 = ((hist * centers).sum() - np.cumsum(hist * centers)) / np.maximum(w1, 1)
+    threshold = centers[np.argmax(w0 * w1 * (m0 - m1) ** 2)]
+
+    mask = nd.binary_opening(data > threshold, iterations=opening_iter)
+    labels, n_labels = nd.label(mask)
+    if n_labels > 1:
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        mask = labels == np.argmax(sizes)
+    mask = nd.binary_closing(mask, iterations=opening_iter)
+    return nd.binary_fill_holes(mask)
+
+
+def compute_epi_reference(in_file):
+    """ Computes the mean image and a brain mask of a (4D) EPI file.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to nifti-file.
+
+    Returns
+    -------
+    mean_file : str
+        Absolute path to the mean image.
+    mask_file : str
+        Absolute path to the brain mask.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.masking.nodes import epi_mask_from_mean
+
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    mean_data = data.mean(axis=-1) if data.ndim > 3 else data
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(mean_data.shape)
+    hdr.set_data_dtype(np.float32)
+    base = os.path.basename(in_file).split('.')[0]
+    mean_file = os.path.abspath(base + '_mean.nii.gz')
+    nib.save(nib.Nifti1Image(mean_data, img.affine, hdr), mean_file)
+
+    hdr.set_data_dtype(np.uint8)
+    mask_file = os.path.abspath(base + '_mask.nii.gz')
+    mask = epi_mask_from_mean(mean_data).astype(np.uint8)
+    nib.save(nib.Nifti1Image(mask, img.affine, hdr), mask_file)
+
+    return mean_file, mask_file
+
+
+Compute_epi_reference = Function(function=compute_epi_reference,
+                                 input_names=['in_file'],
+                                 output_names=['mean_file', 'mask_file'])
+
+
+def compute_epi_mask(in_file):
+    """ Computes a brain mask of a (mean) EPI file. If in_file is 4D, the
+    mask is computed on the temporal mean. """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.masking.nodes import epi_mask_from_mean
+
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    if data.ndim > 3:
+        data = data.mean(axis=-1)
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(np.uint8)
+    mask_file = os.path.abspath(
+        os.path.basename(in_file).split('.')[0] + '_mask.nii.gz')
+    mask = epi_mask_from_mean(data).astype(np.uint8)
+    nib.save(nib.Nifti1Image(mask, img.affine, hdr), mask_file)
+
+    return mask_file
+
+
+Compute_epi_mask = Function(function=compute_epi_mask,
+                            input_names=['in_file'],
+                            output_names=['mask_file'])
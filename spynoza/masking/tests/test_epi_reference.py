@@ -0,0 +1,22 @@
+import pytest
+import numpy as np
+import nibabel as nib
+from ..nodes import compute_epi_reference
+
+
+@pytest.mark.masking
+def test_compute_epi_reference(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    x, y, z = np.ogrid[-1:1:32j, -1:1:32j, -1:1:20j]
+    brain = (x / .7) ** 2 + (y / .8) ** 2 + (z / .8) ** 2 <= 1
+    data = rs.rand(32, 32, 20, 5) * 50
+    data[brain] += 1000
+    in_file = str(tmpdir.join('run-1_bold.nii.gz'))
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), in_file)
+
+    mean_file, mask_file = compute_epi_reference(in_file)
+    np.testing.assert_allclose(nib.load(mean_file).get_fdata(),
+                               data.mean(axis=-1), rtol=1e-5)
+    mask = np.asanyarray(nib.load(mask_file).dataobj).astype(bool)
+    assert (mask == brain).mean() > .99
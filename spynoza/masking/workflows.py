@@ -4,6 +4,7 @@ from nipype.interfaces import fsl
 from nipype.interfaces import freesurfer
 from nipype.interfaces.utility import IdentityInterface, Merge
 from .nodes import FS_aseg_file, FS_LabelNode
+from ..resampling.nodes import Apply_sparse_transform
 
 
 def create_transform_aseg_to_EPI_workflow(name = 'transform_aseg_to_EPI'):
@@ -86,15 +87,19 @@ def create_transform_aseg_to_EPI_workflow(name = 'transform_aseg_to_EPI'):
 
 
 
-def create_transform_atlas_to_EPI_workflow(name = 'transform_atlas_to_EPI'):
+def create_transform_atlas_to_EPI_workflow(name = 'transform_atlas_to_EPI', method='FSL'):
     """Transforms MNI-based volume-atlas to EPI space and dumps it in the masks folder.
     As this does not split up the file according to the values, this will work also for 
     MNI-based single ROI definitions.
-    Requires fsl tools
+    Requires fsl tools, unless method is 'native'
     Parameters
     ----------
     name : string
         name of workflow
+    method : string ['FSL', 'native']
+        'FSL' uses FLIRT with sinc interpolation; 'native' uses a cached
+        sparse nearest-neighbour resampling operator, which is built once and
+        reused for all atlases and runs with the same grids and matrix.
     Example
     -------
     >>> transform_atlas_to_EPI = create_transform_aseg_to_EPI_workflow('transform_aseg_to_EPI')
@@ -132,7 +137,13 @@ def create_transform_atlas_to_EPI_workflow(name = 'transform_atlas_to_EPI'):
         'reg_file']), name='inputspec')
     output_node = pe.Node(IdentityInterface(fields=('output_mask')), name='outputspec')
 
-    vol_trans_node = pe.Node(interface=fsl.ApplyXfm(apply_xfm = True, interp = 'sinc'), name='vol_trans')
+    if method == 'native':
+        vol_trans_node = pe.Node(interface=Apply_sparse_transform, name='vol_trans')
+        vol_trans_node.inputs.order = 0
+        in_names = ('in_file', 'mat_file', 'ref_file')
+    else:
+        vol_trans_node = pe.Node(interface=fsl.ApplyXfm(apply_xfm = True, interp = 'sinc'), name='vol_trans')
+        in_names = ('in_file', 'in_matrix_file', 'reference')
 
     ########################################################################################
     # actual workflow
@@ -140,9 +151,9 @@ def create_transform_atlas_to_EPI_workflow(name = 'transform_atlas_to_EPI'):
 
     transform_atlas_to_EPI_workflow = pe.Workflow(name=name)
 
-    transform_atlas_to_EPI_workflow.connect(input_node, 'atlas', vol_trans_node, 'in_file')
-    transform_atlas_to_EPI_workflow.connect(input_node, 'reg_file', vol_trans_node, 'in_matrix_file')
-    transform_atlas_to_EPI_workflow.connect(input_node, 'EPI_space_file', vol_trans_node, 'reference')
+    transform_atlas_to_EPI_workflow.connect(input_node, 'atlas', vol_trans_node, in_names[0])
+    transform_atlas_to_EPI_workflow.connect(input_node, 'reg_file', vol_trans_node, in_names[1])
+    transform_atlas_to_EPI_workflow.connect(input_node, 'EPI_space_file', vol_trans_node, in_names[2])
 
     transform_atlas_to_EPI_workflow.connect(vol_trans_node, 'out_file', output_node, 'output_mask')
 
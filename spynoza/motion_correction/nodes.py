@@ -13,3 +13,296 @@ def _check_if_iterable(to_iter, arg):
 
 fix_iterable = pe.Node(Function(input_names=['to_iter', 'arg'], output_names='arg_fixed',
                                 function=_check_if_iterable), name='fix_iterable')
+
+
+def compute_jenkinson_fd(mat_files, ref_file, radius=80.0):
+    """ Computes Jenkinson relative and absolute RMS displacement.
+
+    Loads all (MCFLIRT) matrices of a run into one (T, 4, 4) array and
+    computes the RMS deviation (Jenkinson, 1999) within a sphere of the given
+    radius, centered at the centre of gravity of the reference volume (as
+    rmsdiff does), for all volumes at once.
+
+    Parameters
+    ----------
+    mat_files : list or str
+        List of per-volume matrix files, or MCFLIRT's .mat directory.
+    ref_file : str
+        Absolute path to the reference (EPI space) nifti-file.
+    radius : float (default: 80.0)
+        Radius of the sphere in mm.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to tsv-file with columns rms_rel and rms_abs.
+    """
+    import os.path as op
+    import numpy as np
+    import nibabel as nib
+    import pandas as pd
+    from spynoza.utils import load_fsl_matrices, fsl_voxel_to_mm
+
+    mats = load_fsl_matrices(mat_files)
+
+    ref = nib.load(ref_file)
+    ref_data = np.clip(np.asanyarray(ref.dataobj, dtype=np.float64), 0, None)
+    if ref_data.ndim > 3:
+        ref_data = ref_data.mean(axis=-1)
+    grid = np.indices(ref_data.shape).reshape((3, -1))
+    cog_vox = grid.dot(ref_data.ravel()) / ref_data.sum()
+    vox2fsl = fsl_voxel_to_mm(ref_data.shape, ref.header.get_zooms(),
+                              ref.affine)
+    centre = vox2fsl[:3, :3].dot(cog_vox) + vox2fsl[:3, 3]
+
+    def _rms(diffs):
+        # diffs: (N, 4, 4) stack of M1 * inv(M2) - I
+        A = diffs[:, :3, :3]
+        t = diffs[:, :3, 3] + A.dot(centre)
+        rms = 0.2 * radius ** 2 * np.einsum('nij,nij->n', A, A)
+        return np.sqrt(rms + np.einsum('ni,ni->n', t, t))
+
+    eye = np.eye(4)
+    rms_abs = _rms(mats - eye)
+    rms_rel = np.zeros_like(rms_abs)
+    rms_rel[1:] = _rms(np.matmul(mats[1:], np.linalg.inv(mats[:-1])) - eye)
+
+    if isinstance(mat_files, list):
+        base = op.basename(op.dirname(mat_files[0]))
+    else:
+        base = op.basename(op.normpath(mat_files))
+    out_file = op.abspath(base.replace('.mat', '') + '_fd_jenkinson.tsv')
+    pd.DataFrame({'rms_rel': rms_rel, 'rms_abs': rms_abs}).to_csv(
+        out_file, sep=str('\t'), index=False, columns=['rms_rel', 'rms_abs'])
+
+    return out_file
+
+
+Compute_jenkinson_fd = Function(function=compute_jenkinson_fd,
+                                input_names=['mat_files', 'ref_file',
+                                             'radius'],
+                                output_names=['out_file'])
+
+
+def _rigid_vox_matrices(params, centre, ref2fsl, fsl2mov):
+    """ Maps rigid parameters (reference -> moving, in FSL scaled-mm) to
+    matrices from reference voxels to moving voxels. """
+    from spynoza.utils import params_to_fsl_matrix
+
+    return fsl2mov.dot(params_to_fsl_matrix(params, centre)).dot(ref2fsl)
+
+
+def _estimate_rigid(moving, levels, centre, ref2fsl, fsl2mov, init,
+                    n_iter=10, tol=1e-4):
+    """ Estimates the rigid transform (reference -> moving) of one volume
+    with Gauss-Newton updates over a multi-resolution pyramid.
+
+    Parameters
+    ----------
+    moving : np.ndarray
+        3D moving volume (intensity matched to the reference).
+    levels : list
+        List of (sigma, points, values) tuples, from coarse to fine: the
+        smoothing (in voxels) at that level, the (N, 3) reference voxel
+        coordinates to sample and the (N,) smoothed reference values there.
+    init : np.ndarray
+        Initial parameters (6,).
+
+    Returns
+    -------
+    params : np.ndarray
+        Estimated parameters (6,).
+    """
+    import numpy as np
+    import scipy.ndimage as nd
+    from spynoza.motion_correction.nodes import _rigid_vox_matrices
+
+    params = np.array(init, dtype=np.float64)
+    eps = np.array([1e-3] * 3 + [1e-2] * 3)
+    upper = np.array(moving.shape) - 1
+
+    for level, (sigma, points, ref_values) in enumerate(levels):
+        mov = nd.gaussian_filter(moving, sigma) if sigma > 0 else moving
+        grads = np.gradient(mov)
+
+        # trilinear sampling is biased by up to ~.1 voxel, so the finest
+        # level samples cubic spline coefficients instead
+        order = 3 if level == len(levels) - 1 else 1
+        coefs = nd.spline_filter(mov, order=3) if order == 3 else mov
+
+        for _ in range(n_iter):
+            A = _rigid_vox_matrices(params, centre, ref2fsl, fsl2mov)
+            coords = points.dot(A[:3, :3].T) + A[:3, 3]
+            valid = np.all((coords >= 0) & (coords <= upper), axis=1)
+            if valid.sum() < 10:
+                break
+            coords = coords[valid]
+
+            values = nd.map_coordinates(coefs, coords.T, order=order,
+                                        prefilter=False)
+            residual = values - ref_values[valid]
+            grad = np.stack([nd.map_coordinates(g, coords.T, order=1)
+                             for g in grads], axis=1)
+
+            # derivative of the sampled coordinates w.r.t. each parameter
+            d_coords = np.empty((6,) + coords.shape)
+            for j in range(6):
+                step = params.copy()
+                step[j] += eps[j]
+                A_j = _rigid_vox_matrices(step, centre, ref2fsl, fsl2mov)
+                d_coords[j] = ((points[valid].dot(A_j[:3, :3].T) + A_j[:3, 3])
+                               - coords) / eps[j]
+            J = np.einsum('ni,jni->nj', grad, d_coords)
+
+            H = J.T.dot(J)
+            H[np.diag_indices(6)] *= 1.001
+            update = np.linalg.solve(H, -J.T.dot(residual))
+            params += update
+            if np.all(np.abs(update) < tol * eps / eps.min()):
+                break
+
+    return params
+
+
+def _realign_chunk(data, levels, centre, ref2fsl, fsl2mov, ref_mean, n_iter):
+    """ Realigns a chunk of consecutive volumes; each volume is initialised
+    with the estimate of the previous one. """
+    import numpy as np
+    from spynoza.motion_correction.nodes import _estimate_rigid
+
+    params = np.zeros((data.shape[-1], 6))
+    init = np.zeros(6)
+    for i in range(data.shape[-1]):
+        vol = data[..., i]
+        vol = vol * (ref_mean / max(vol.mean(), 1e-6))
+        init = params[i] = _estimate_rigid(vol, levels, centre, ref2fsl,
+                                           fsl2mov, init, n_iter=n_iter)
+    return params
+
+
+def realign_rigid(in_file, ref_file=None, sigmas=(4, 2, 1), strides=(4, 2, 1),
+                  n_iter=10, interp='trilinear', n_procs=1):
+    """ Realigns all volumes of a 4D file to a reference (6 DOF).
+
+    A native (NumPy/SciPy) alternative to MCFLIRT: a multi-resolution
+    Gauss-Newton optimisation of the sum of squared differences, using
+    vectorised trilinear (cubic at the finest level) interpolation, with
+    volumes processed in chunks by a process pool. Outputs are MCFLIRT-compatible.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 4D nifti-file.
+    ref_file : str
+        Absolute path to 3D reference nifti-file. If None, the middle volume
+        of in_file is used.
+    sigmas : tuple (default: (4, 2, 1))
+        Gaussian smoothing (in voxels) per pyramid level.
+    strides : tuple (default: (4, 2, 1))
+        Sampling stride (in voxels) of the reference per pyramid level.
+    n_iter : int (default: 10)
+        Maximum number of Gauss-Newton iterations per level.
+    interp : str ['trilinear', 'spline'] (default: 'trilinear')
+        Interpolation used for the output.
+    n_procs : int (default: 1)
+        Number of processes (and resampling threads); set node.n_procs to
+        match, so that the nipype scheduler accounts for them.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to motion corrected nifti-file.
+    par_file : str
+        Absolute path to MCFLIRT-style .par file (rotations in radians,
+        translations in mm).
+    mat_file : list
+        Absolute paths to MCFLIRT-style per-volume matrices (input volume
+        to reference, FSL convention).
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from concurrent.futures import ProcessPoolExecutor
+    from spynoza.utils import fsl_voxel_to_mm, fsl_matrix_to_params
+    from spynoza.masking.nodes import epi_mask_from_mean
+    from spynoza.resampling.nodes import resample_chunk, write_nifti_stream
+    from spynoza.motion_correction.nodes import (_realign_chunk,
+                                                 _rigid_vox_matrices)
+
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    n_vols = data.shape[-1]
+
+    if ref_file is None:
+        ref_img, ref = img, data[..., n_vols // 2]
+    else:
+        ref_img = nib.load(ref_file)
+        ref = np.asanyarray(ref_img.dataobj, dtype=np.float32)
+        if ref.ndim > 3:
+            ref = ref.mean(axis=-1)
+
+    ref2fsl = fsl_voxel_to_mm(ref.shape, ref_img.header.get_zooms(),
+                              ref_img.affine)
+    mov2fsl = fsl_voxel_to_mm(data.shape, img.header.get_zooms(), img.affine)
+    fsl2mov = np.linalg.inv(mov2fsl)
+    centre = ref2fsl[:3, :3].dot((np.array(ref.shape) - 1) / 2.) + ref2fsl[:3, 3]
+
+    # sample the reference within a (dilated) brain mask
+    mask = nd.binary_dilation(epi_mask_from_mean(ref), iterations=2)
+    levels = []
+    for sigma, stride in zip(sigmas, strides):
+        sub = np.zeros_like(mask)
+        sub[::stride, ::stride, ::stride] = True
+        points = np.argwhere(mask & sub).astype(np.float64)
+        smoothed = nd.gaussian_filter(ref, sigma) if sigma > 0 else ref
+        levels.append((sigma, points, smoothed[mask & sub]))
+    ref_mean = ref.mean()
+
+    n_procs = n_procs or 1
+    chunks = np.array_split(np.arange(n_vols), min(n_procs, n_vols))
+    args = (levels, centre, ref2fsl, fsl2mov, ref_mean, n_iter)
+    if n_procs > 1:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            futures = [pool.submit(_realign_chunk, data[..., c], *args)
+                       for c in chunks]
+            params = np.vstack([f.result() for f in futures])
+    else:
+        params = np.vstack([_realign_chunk(data[..., c], *args)
+                            for c in chunks])
+
+    # params map reference -> moving; MCFLIRT matrices map moving -> reference
+    base = os.path.basename(in_file).split('.')[0] + '_mcf'
+    mat_dir = os.path.abspath(base + '.mat')
+    if not os.path.isdir(mat_dir):
+        os.makedirs(mat_dir)
+
+    vox_mats = np.array([_rigid_vox_matrices(p, centre, ref2fsl, fsl2mov)
+                         for p in params])
+    mcf_mats = np.linalg.inv(np.matmul(np.matmul(mov2fsl, vox_mats),
+                                       np.linalg.inv(ref2fsl)))
+    mat_files = []
+    for i, mat in enumerate(mcf_mats):
+        mat_files.append(os.path.join(mat_dir, 'MAT_%04i' % i))
+        np.savetxt(mat_files[-1], mat, fmt='%.6f')
+
+    par_file = os.path.abspath(base + '.par')
+    np.savetxt(par_file, fsl_matrix_to_params(mcf_mats, centre), fmt='%.6f')
+
+    order = {'trilinear': 1, 'spline': 3}[interp]
+    chunks = (resample_chunk(data[..., i:i + 16], vox_mats[i:i + 16],
+                             ref.shape, order=order, n_threads=n_procs)
+              for i in range(0, n_vols, 16))
+    out_file = os.path.abspath(base + '.nii.gz')
+    write_nifti_stream(out_file, chunks, ref.shape + (n_vols,),
+                       ref_img.affine, header=img.header,
+                       space_header=ref_img.header)
+
+    return out_file, par_file, mat_files
+
+
+Realign_rigid = Function(function=realign_rigid,
+                         input_names=['in_file', 'ref_file', 'sigmas',
+                                      'strides', 'n_iter', 'interp',
+                                      'n_procs'],
+                         output_names=['out_file', 'par_file', 'mat_file'])
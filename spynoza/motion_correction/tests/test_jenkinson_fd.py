@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import os
+import os.path as op
+from ..nodes import compute_jenkinson_fd
+
+
+@pytest.mark.moco
+def test_compute_jenkinson_fd(tmpdir):
+    tmpdir.chdir()
+    ref_data = np.zeros((20, 20, 10))
+    ref_data[5:15, 5:15, 2:8] = 100
+    ref_file = op.abspath('ref.nii.gz')
+    nib.save(nib.Nifti1Image(ref_data, np.diag([-2., 2., 3., 1.])), ref_file)
+
+    mats = np.tile(np.eye(4), (3, 1, 1))
+    mats[1, :3, 3] = [0.3, 0., 0.4]
+    mats[2, :3, 3] = [0.3, 0., 0.4]
+    theta = 0.01
+    mats[2, :2, :2] = [[np.cos(theta), np.sin(theta)],
+                       [-np.sin(theta), np.cos(theta)]]
+
+    os.mkdir('run_mcf.mat')
+    for i, mat in enumerate(mats):
+        np.savetxt(op.join('run_mcf.mat', 'MAT_%04i' % i), mat)
+
+    fd = pd.read_csv(compute_jenkinson_fd(op.abspath('run_mcf.mat'), ref_file),
+                     sep='\t')
+    np.testing.assert_allclose(fd['rms_abs'].values[:2], [0, 0.5])
+    np.testing.assert_allclose(fd['rms_rel'].values[:2], [0, 0.5])
+
+    # compare against brute-force RMS over points in an 80 mm sphere,
+    # centred on the centre of gravity (in FSL scaled-mm coordinates)
+    centre = np.array([9.5 * 2, 9.5 * 2, 4.5 * 3])
+    pts = np.random.RandomState(0).uniform(-1, 1, (200000, 3))
+    pts = pts[(pts ** 2).sum(axis=1) <= 1] * 80 + centre
+    moved = pts.dot(mats[2, :3, :3].T) + mats[2, :3, 3]
+    expected = np.sqrt(((moved - pts) ** 2).sum(axis=1).mean())
+    np.testing.assert_allclose(fd['rms_abs'].values[2], expected, rtol=1e-2)
@@ -23,7 +23,7 @@ methods = ['FSL', 'AFNI'] if hostname != 'uva' else ['FSL']
 @pytest.mark.parametrize("method", methods)
 @pytest.mark.moco
 def test_create_motion_correction_workflow(method):
-    moco_wf = create_motion_correction_workflow(method=method)
+    moco_wf = create_motion_correction_workflow(method=method, render_qc=True)
     moco_wf.base_dir = '/tmp/spynoza/workingdir'
     moco_wf.inputs.inputspec.in_files = [op.join(test_data_path, 'func', 'sub-0020_task-harriri_bold_cut.nii.gz'),
                                          op.join(test_data_path, 'func', 'sub-0020_task-wm_bold_cut.nii.gz')]
@@ -0,0 +1,97 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import scipy.ndimage as nd
+import os.path as op
+from ..nodes import realign_rigid, _rigid_vox_matrices
+from ..workflows import create_motion_correction_workflow
+from ...utils import (fsl_voxel_to_mm, load_fsl_matrices,
+                      params_to_fsl_matrix, fsl_matrix_to_params)
+
+
+def _make_run(fn, params, noise=5., seed=0, ref_fn=None):
+    rs = np.random.RandomState(seed)
+    shape = (40, 40, 24)
+    x, y, z = np.ogrid[-1:1:40j, -1:1:40j, -1:1:24j]
+    brain = ((x / .7) ** 2 + (y / .8) ** 2 + (z / .8) ** 2 <= 1)
+    texture = nd.gaussian_filter(np.random.RandomState(42).rand(*shape), 2)
+    ref = nd.gaussian_filter(brain * (1000 + 3000 * texture), 1)
+
+    affine = np.diag([3., 3., 3.5, 1.])
+    vox2fsl = fsl_voxel_to_mm(shape, (3., 3., 3.5), affine)
+    centre = vox2fsl[:3, :3].dot((np.array(shape) - 1) / 2.) + vox2fsl[:3, 3]
+    grid = np.indices(shape).reshape((3, -1)).astype(np.float64)
+
+    vols = []
+    for p in params:
+        A = _rigid_vox_matrices(p, centre, vox2fsl, np.linalg.inv(vox2fsl))
+        vols.append(nd.map_coordinates(ref, A[:3, :3].dot(grid) + A[:3, 3:],
+                                       order=3).reshape(shape))
+    data = np.stack(vols, axis=-1) + rs.randn(*(shape + (len(params),))) * noise
+    nib.save(nib.Nifti1Image(data.astype(np.float32), affine), fn)
+    if ref_fn is not None:
+        nib.save(nib.Nifti1Image(ref.astype(np.float32), affine), ref_fn)
+    return centre
+
+
+@pytest.mark.moco
+def test_realign_rigid(tmpdir):
+    tmpdir.chdir()
+    params = np.array([[0, 0, 0, 0, 0, 0],
+                       [.02, -.01, .03, 1., -.5, .8],
+                       [-.03, .02, .01, -1.5, 1., .3]])
+    centre = _make_run(op.abspath('run.nii.gz'), params,
+                       ref_fn=op.abspath('ref.nii.gz'))
+
+    out_file, par_file, mat_files = realign_rigid(
+        op.abspath('run.nii.gz'), ref_file=op.abspath('ref.nii.gz'), n_procs=2)
+    assert nib.load(out_file).shape == (40, 40, 24, 3)
+
+    # volumes were sampled from the reference with these matrices, so the
+    # moving -> reference matrices should match them
+    expected = params_to_fsl_matrix(params, centre)
+    estimated = fsl_matrix_to_params(load_fsl_matrices(mat_files), centre)
+    expected = fsl_matrix_to_params(expected, centre)
+    np.testing.assert_allclose(estimated[:, :3], expected[:, :3], atol=5e-3)
+    np.testing.assert_allclose(estimated[:, 3:], expected[:, 3:], atol=.1)
+    np.testing.assert_allclose(np.loadtxt(par_file), estimated, atol=1e-4)
+
+
+@pytest.mark.moco
+def test_create_motion_correction_workflow_native(tmpdir):
+    in_files = [str(tmpdir.join('sub-01_task-%s_bold.nii.gz' % t))
+                for t in ('a', 'b')]
+    params = np.zeros((4, 6))
+    params[:, 3] = np.linspace(0, 1, 4)
+    for i, f in enumerate(in_files):
+        _make_run(f, params, seed=i)
+
+    moco_wf = create_motion_correction_workflow(method='native', n_procs=2,
+                                                render_qc=True)
+    # the scheduler reserves the processes the realignment uses
+    for name in ('motion_correct_EPI_space', 'motion_correct_all'):
+        node = moco_wf.get_node(name)
+        assert node.n_procs == node.inputs.n_procs == 2
+    moco_wf.base_dir = str(tmpdir.join('workingdir'))
+    moco_wf.inputs.inputspec.in_files = in_files
+    moco_wf.inputs.inputspec.output_directory = str(tmpdir)
+    moco_wf.inputs.inputspec.sub_id = 'sub-01'
+    moco_wf.inputs.inputspec.which_file_is_EPI_space = 'first'
+    moco_wf.run()
+
+    datasink = op.join(str(tmpdir), 'sub-01', 'mcf')
+    for f in in_files:
+        base = op.basename(f).replace('.nii.gz', '_mcf')
+        assert op.isfile(op.join(datasink, base + '.nii.gz'))
+        assert op.isfile(op.join(datasink, 'motion_pars', base + '.par'))
+        assert op.isfile(op.join(datasink, 'fd', base + '_fd_jenkinson.tsv'))
+        for plot in ('_rot.png', '_trans.png'):
+            assert op.isfile(op.join(datasink, 'motion_plots', base + plot))
+
+
+@pytest.mark.moco
+def test_create_motion_correction_workflow_qc_files():
+    # by default, the QC data is left to a subject-level node
+    moco_wf = create_motion_correction_workflow(method='native')
+    assert moco_wf.get_node('render_qc') is None
+    assert 'qc_files' in moco_wf.get_node('outputspec').inputs.copyable_trait_names()
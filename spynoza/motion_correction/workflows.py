@@ -6,15 +6,29 @@ from nipype.interfaces.utility import Rename
 from nipype.interfaces.utility import IdentityInterface
 import nipype.interfaces.utility as niu
 from ..utils import EPI_file_selector, Set_postfix, Remove_extension
+from ..masking.nodes import Compute_epi_reference
+from .nodes import Compute_jenkinson_fd, Realign_rigid
+from ..qc.nodes import Motion_qc, Render_qc
 
 
-def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_params=False):
+def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_params=False,
+                                      n_procs=1, render_qc=False):
     """uses sub-workflows to perform different registration steps.
     Requires fsl and freesurfer tools
     Parameters
     ----------
     name : string
         name of workflow
+    method : string ['FSL', 'AFNI', 'native'] (default: 'AFNI')
+        MCFLIRT, 3dVolreg or the native (NumPy/SciPy) rigid realignment,
+        which writes MCFLIRT-compatible outputs
+    n_procs : int (default: 1)
+        number of processes per run of the native realignment (also
+        reserved from the nipype scheduler through node.n_procs)
+    render_qc : bool (default: False)
+        whether to render the motion plots in this workflow; by default,
+        outputspec.qc_files is left to a single, subject-level render_qc
+        node (spynoza.qc.nodes.Render_qc) that collects all QC data
 
     Example
     -------
@@ -29,9 +43,13 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
           inputspec.which_file_is_EPI_space : determines which file is the 'standard EPI space'
     Outputs::
            outputspec.EPI_space_file : standard EPI space file, one timepoint
+           outputspec.mask_EPI_space_file : brain mask of the standard EPI space file
            outputspec.motion_corrected_files : motion corrected files
-           outputspec.motion_correction_plots : motion correction plots
+           outputspec.motion_correction_plots : motion correction plots (FSL and native only, if render_qc)
+           outputspec.qc_files : QC data of the motion correction plots (FSL and native only)
            outputspec.motion_correction_parameters : motion correction parameters
+           outputspec.motion_correction_matrices : per-volume matrices (.mat directories) to the EPI space file (FSL and native only)
+           outputspec.jenkinson_fd_files : Jenkinson relative/absolute RMS displacement (FSL and native only)
     """
 
     ### NODES
@@ -46,9 +64,12 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
                                                     'EPI_space_file',
                                                     'mask_EPI_space_file',
                                                     'motion_correction_plots',
+                                                    'qc_files',
                                                     'motion_correction_parameters',
                                                     'extended_motion_correction_parameters',
-                                                    'new_motion_correction_parameters'])), 
+                                                    'new_motion_correction_parameters',
+                                                    'motion_correction_matrices',
+                                                    'jenkinson_fd_files'])), 
                                             name='outputspec')
 
     ########################################################################################
@@ -56,7 +77,9 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
     ########################################################################################
 
     EPI_file_selector_node = pe.Node(interface=EPI_file_selector, name='EPI_file_selector_node')
-    mean_bold = pe.Node(interface=fsl.maths.MeanImage(dimension='T'), name='mean_space')
+    # mean (EPI space) and brain mask in a single pass; downstream workflows
+    # (compcor, smoothing) take both from the outputspec
+    mean_bold = pe.Node(interface=Compute_epi_reference, name='mean_space')
     rename_mean_bold = pe.Node(niu.Rename(format_string='session_EPI_space', keep_ext=True),
                                 name='rename_mean_bold')
 
@@ -69,6 +92,7 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
                                        EPI_file_selector_node, 'which_file')
     motion_correction_workflow.connect(input_node, 'in_files',
                                        EPI_file_selector_node, 'in_files')
+    motion_correction_workflow.connect(mean_bold, 'mask_file', output_node, 'mask_EPI_space_file')
 
     ########################################################################################
     # outputs via datasink
@@ -115,10 +139,16 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
                                         name='motion_correct_all',
                                         iterfield=['in_file'])
 
-        plot_motion = pe.MapNode(
-            interface=fsl.PlotMotionParams(in_source='fsl'),
-            name='plot_motion',
-            iterfield=['in_file'])
+        plot_motion = pe.MapNode(interface=Motion_qc,
+                                 name='plot_motion',
+                                 iterfield=['in_file'])
+
+        # all runs' plots are rendered at once, after motion correction
+        qc_renderer = pe.Node(interface=Render_qc, name='render_qc')
+
+        jenkinson_fd = pe.MapNode(interface=Compute_jenkinson_fd,
+                                  name='jenkinson_fd',
+                                  iterfield=['mat_files'])
 
         if extend_moco_params:
             # make extend_motion_pars node here
@@ -129,11 +159,16 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
         # create reference:
         motion_correction_workflow.connect(EPI_file_selector_node, 'out_file', motion_correct_EPI_space, 'in_file')
         motion_correction_workflow.connect(motion_correct_EPI_space, 'out_file', mean_bold, 'in_file')
-        motion_correction_workflow.connect(mean_bold, 'out_file', motion_correct_all, 'ref_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', motion_correct_all, 'ref_file')
 
         # motion correction across runs
         motion_correction_workflow.connect(input_node, 'in_files', motion_correct_all, 'in_file')
         #motion_correction_workflow.connect(motion_correct_all, 'out_file', output_node, 'motion_corrected_files')
+
+        # framewise displacement, directly from the saved matrices
+        motion_correction_workflow.connect(motion_correct_all, 'mat_file', jenkinson_fd, 'mat_files')
+        motion_correction_workflow.connect(motion_correct_all, 'mat_file', output_node, 'motion_correction_matrices')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', jenkinson_fd, 'ref_file')
         # motion_correction_workflow.connect(motion_correct_all, 'par_file', extend_motion_pars, 'moco_par_file')
         # motion_correction_workflow.connect(input_node, 'tr', extend_motion_pars, 'tr')
         # motion_correction_workflow.connect(extend_motion_pars, 'ext_out_file', output_node, 'extended_motion_correction_parameters')
@@ -144,26 +179,30 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
         ########################################################################################
 
         # rename:
-        motion_correction_workflow.connect(mean_bold, 'out_file', rename_mean_bold, 'in_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', rename_mean_bold, 'in_file')
         motion_correction_workflow.connect(motion_correct_all, 'par_file', rename_motion_files, 'in_file')
         motion_correction_workflow.connect(motion_correct_all, 'par_file', remove_niigz_ext, 'in_file')
         motion_correction_workflow.connect(remove_niigz_ext, 'out_file', rename_motion_files, 'format_string')
         
         # plots:
-        plot_motion.iterables = ('plot_type', ['rotations', 'translations'])
         motion_correction_workflow.connect(rename_motion_files, 'out_file', plot_motion, 'in_file')
-        motion_correction_workflow.connect(plot_motion, 'out_file', output_node, 'motion_correction_plots')
+        motion_correction_workflow.connect(plot_motion, 'qc_files', output_node, 'qc_files')
+        if render_qc:
+            motion_correction_workflow.connect(plot_motion, 'qc_files', qc_renderer, 'qc_files')
+            motion_correction_workflow.connect(qc_renderer, 'fig_files', output_node, 'motion_correction_plots')
+            motion_correction_workflow.connect(qc_renderer, 'fig_files', datasink, 'mcf.motion_plots')
         
         # output node:
-        motion_correction_workflow.connect(mean_bold, 'out_file', output_node, 'EPI_space_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', output_node, 'EPI_space_file')
         motion_correction_workflow.connect(rename_motion_files, 'out_file', output_node, 'motion_correction_parameters')
         motion_correction_workflow.connect(motion_correct_all, 'out_file', output_node, 'motion_corrected_files')
+        motion_correction_workflow.connect(jenkinson_fd, 'out_file', output_node, 'jenkinson_fd_files')
         
         # datasink:
         motion_correction_workflow.connect(rename_mean_bold, 'out_file', datasink, 'reg')
         motion_correction_workflow.connect(motion_correct_all, 'out_file', datasink, 'mcf')
         motion_correction_workflow.connect(rename_motion_files, 'out_file', datasink, 'mcf.motion_pars')
-        motion_correction_workflow.connect(plot_motion, 'out_file', datasink, 'mcf.motion_plots')
+        motion_correction_workflow.connect(jenkinson_fd, 'out_file', datasink, 'mcf.fd')
         # motion_correction_workflow.connect(extend_motion_pars, 'ext_out_file', datasink, 'mcf.ext_motion_pars')
         # motion_correction_workflow.connect(extend_motion_pars, 'new_out_file', datasink, 'mcf.new_motion_pars')
         
@@ -205,12 +244,12 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
 
         # motion correction across runs
         motion_correction_workflow.connect(input_node, 'in_files', motion_correct_all, 'in_file')
-        motion_correction_workflow.connect(mean_bold, 'out_file', motion_correct_all, 'basefile')
-        # motion_correction_workflow.connect(mean_bold, 'out_file', motion_correct_all, 'rotparent')
-        # motion_correction_workflow.connect(mean_bold, 'out_file', motion_correct_all, 'gridparent')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', motion_correct_all, 'basefile')
+        # motion_correction_workflow.connect(mean_bold, 'mean_file', motion_correct_all, 'rotparent')
+        # motion_correction_workflow.connect(mean_bold, 'mean_file', motion_correct_all, 'gridparent')
 
         # output node:
-        motion_correction_workflow.connect(mean_bold, 'out_file', output_node, 'EPI_space_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', output_node, 'EPI_space_file')
         motion_correction_workflow.connect(motion_correct_all, 'md1d_file', output_node, 'max_displacement_info')
         motion_correction_workflow.connect(motion_correct_all, 'oned_file', output_node, 'motion_correction_parameter_info')
         motion_correction_workflow.connect(motion_correct_all, 'oned_matrix_save', output_node, 'motion_correction_parameter_matrix')
@@ -220,13 +259,75 @@ def create_motion_correction_workflow(name='moco', method='AFNI', extend_moco_pa
         motion_correction_workflow.connect(rename_volreg, 'out_file', output_node, 'motion_corrected_files')
 
         # datasink:
-        motion_correction_workflow.connect(mean_bold, 'out_file', rename_mean_bold, 'in_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', rename_mean_bold, 'in_file')
         motion_correction_workflow.connect(rename_mean_bold, 'out_file', datasink, 'reg')
         motion_correction_workflow.connect(rename_volreg, 'out_file', datasink, 'mcf')
         motion_correction_workflow.connect(motion_correct_all, 'md1d_file', datasink, 'mcf.max_displacement_info')
         motion_correction_workflow.connect(motion_correct_all, 'oned_file', datasink, 'mcf.parameter_info')
         motion_correction_workflow.connect(motion_correct_all, 'oned_matrix_save', datasink, 'mcf.motion_pars')
         
+    ########################################################################################
+    # native rigid-body realignment
+    ########################################################################################
+    # same setup as with MCFLIRT: realign the selected run (to its middle volume),
+    # take its mean as EPI space and realign all runs to that, without
+    # external toolkits.
+
+    if method == 'native':
+
+        motion_correct_EPI_space = pe.Node(interface=Realign_rigid,
+                                           name='motion_correct_EPI_space')
+
+        motion_correct_all = pe.MapNode(interface=Realign_rigid,
+                                        name='motion_correct_all',
+                                        iterfield=['in_file'])
+
+        for node in (motion_correct_EPI_space, motion_correct_all):
+            node.inputs.n_procs = n_procs
+            node.n_procs = n_procs
+
+        jenkinson_fd = pe.MapNode(interface=Compute_jenkinson_fd,
+                                  name='jenkinson_fd',
+                                  iterfield=['mat_files'])
+
+        plot_motion = pe.MapNode(interface=Motion_qc,
+                                 name='plot_motion',
+                                 iterfield=['in_file'])
+
+        qc_renderer = pe.Node(interface=Render_qc, name='render_qc')
+
+        # create reference:
+        motion_correction_workflow.connect(EPI_file_selector_node, 'out_file', motion_correct_EPI_space, 'in_file')
+        motion_correction_workflow.connect(motion_correct_EPI_space, 'out_file', mean_bold, 'in_file')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', motion_correct_all, 'ref_file')
+
+        # motion correction across runs
+        motion_correction_workflow.connect(input_node, 'in_files', motion_correct_all, 'in_file')
+        motion_correction_workflow.connect(motion_correct_all, 'mat_file', jenkinson_fd, 'mat_files')
+        motion_correction_workflow.connect(motion_correct_all, 'mat_file', output_node, 'motion_correction_matrices')
+        motion_correction_workflow.connect(mean_bold, 'mean_file', jenkinson_fd, 'ref_file')
+
+        # output node:
+        motion_correction_workflow.connect(mean_bold, 'mean_file', output_node, 'EPI_space_file')
+        motion_correction_workflow.connect(motion_correct_all, 'par_file', output_node, 'motion_correction_parameters')
+        motion_correction_workflow.connect(motion_correct_all, 'out_file', output_node, 'motion_corrected_files')
+        motion_correction_workflow.connect(jenkinson_fd, 'out_file', output_node, 'jenkinson_fd_files')
+
+        # plots:
+        motion_correction_workflow.connect(motion_correct_all, 'par_file', plot_motion, 'in_file')
+        motion_correction_workflow.connect(plot_motion, 'qc_files', output_node, 'qc_files')
+        if render_qc:
+            motion_correction_workflow.connect(plot_motion, 'qc_files', qc_renderer, 'qc_files')
+            motion_correction_workflow.connect(qc_renderer, 'fig_files', output_node, 'motion_correction_plots')
+            motion_correction_workflow.connect(qc_renderer, 'fig_files', datasink, 'mcf.motion_plots')
+
+        # datasink:
+        motion_correction_workflow.connect(mean_bold, 'mean_file', rename_mean_bold, 'in_file')
+        motion_correction_workflow.connect(rename_mean_bold, 'out_file', datasink, 'reg')
+        motion_correction_workflow.connect(motion_correct_all, 'out_file', datasink, 'mcf')
+        motion_correction_workflow.connect(motion_correct_all, 'par_file', datasink, 'mcf.motion_pars')
+        motion_correction_workflow.connect(jenkinson_fd, 'out_file', datasink, 'mcf.fd')
+
     return motion_correction_workflow
 
 
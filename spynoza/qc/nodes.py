@@ -0,0 +1,240 @@
+from nipype.interfaces.utility import Function
+
+
+def write_qc_data(kind, fig_file, arrays, **options):
+    """ Stores the data of a QC figure, to be rendered later by render_qc.
+
+    Compute nodes call this instead of plotting, so that no plotting library
+    is imported (and no figure drawn) on the critical path.
+
+    Parameters
+    ----------
+    kind : str
+        Type of figure; a key of QC_RENDERERS.
+    fig_file : str
+        Filename of the figure (only its basename is used).
+    arrays : dict
+        Arrays to plot, by name.
+    **options
+        JSON-serialisable options passed on to the renderer.
+
+    Returns
+    -------
+    qc_file : str
+        Absolute path to .npz file with the arrays and, as JSON under
+        'qc_spec', the kind, filename and options of the figure. A single
+        file, as nipype removes files that a node does not output.
+    """
+    import os
+    import json
+    import numpy as np
+
+    base = os.path.splitext(os.path.basename(fig_file))[0]
+    qc_file = os.path.abspath(base + '.npz')
+    spec = json.dumps({'kind': kind, 'fig_file': os.path.basename(fig_file),
+                       'options': options})
+    np.savez(qc_file, qc_spec=np.array(spec), **arrays)
+    return qc_file
+
+
+def motion_qc(in_file, plot_types=('rotations', 'translations')):
+    """ Emits the QC data of the motion parameter plots of a run, with the
+    names fsl.PlotMotionParams gives them (<base>_rot.png and
+    <base>_trans.png).
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to MCFLIRT-style .par file (rotations in radians,
+        then translations in mm).
+    plot_types : list (default: ('rotations', 'translations'))
+        Plots to make.
+
+    Returns
+    -------
+    qc_files : list
+        Absolute paths to QC data files, one per plot type.
+    """
+    import numpy as np
+    from nipype.utils.filemanip import split_filename
+    from spynoza.qc.nodes import write_qc_data
+
+    params = np.loadtxt(in_file, ndmin=2)
+    _, base, _ = split_filename(in_file)
+    qc_files = []
+    for plot_type in plot_types:
+        suffix = dict(rot='rot', tra='trans')[plot_type[:3]]
+        qc_files.append(write_qc_data('motion', '%s_%s.png' % (base, suffix),
+                                      {'params': params},
+                                      plot_type=plot_type))
+    return qc_files
+
+
+Motion_qc = Function(function=motion_qc,
+                     input_names=['in_file', 'plot_types'],
+                     output_names=['qc_files'])
+
+
+def downsample_trace(x, y, max_points):
+    """ Reduces a trace to at most max_points samples by keeping the minimum
+    and maximum of equally sized bins, so that spikes survive.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        1D sample positions.
+    y : np.ndarray
+        Samples, with time along the first axis.
+    max_points : int
+        Maximal number of samples to keep.
+
+    Returns
+    -------
+    x, y : np.ndarray
+        Downsampled positions and samples.
+    """
+    import numpy as np
+
+    n = y.shape[0]
+    if max_points is None or n <= max_points:
+        return x, y
+    n_bins = max(max_points // 2, 1)
+    edges = np.linspace(0, n, n_bins + 1).astype(int)
+    flat = y.reshape((n, -1)).max(axis=1)
+    keep = [np.argmin(flat[start:stop]) + start for start, stop in
+            zip(edges[:-1], edges[1:])] + \
+           [np.argmax(flat[start:stop]) + start for start, stop in
+            zip(edges[:-1], edges[1:])]
+    keep = np.unique(keep)
+    return x[keep], y[keep]
+
+
+def _render_motion(fig, arrays, max_points=None, plot_type='rotations'):
+    import numpy as np
+    from spynoza.qc.nodes import downsample_trace
+
+    ax = fig.add_subplot(1, 1, 1)
+    params = arrays['params']
+    columns, unit = dict(rot=(slice(0, 3), 'radians'),
+                         tra=(slice(3, 6), 'mm'))[plot_type[:3]]
+    x, y = downsample_trace(np.arange(params.shape[0]), params[:, columns],
+                            max_points)
+    for i, label in enumerate('xyz'):
+        ax.plot(x, y[:, i], label=label)
+    ax.set_title('MCFLIRT estimated %s (%s)' % (plot_type, unit))
+    ax.set_xlabel('volume')
+    ax.legend(loc=2)
+
+
+def _render_gradients(fig, arrays, max_points=None, threshold=1.,
+                      sample_rate=496, nr_volumes=None):
+    from spynoza.qc.nodes import downsample_trace
+
+    n_windows = len([k for k in arrays if k.startswith('samples_')])
+    fig.set_size_inches(15, 6)
+    for i in range(n_windows):
+        s = fig.add_subplot(n_windows, 1, i + 1)
+        x = arrays['samples_%i' % i]
+        for key, kwargs in (('gradient_%i', dict(label='summed gradient signal (x, y, z)')),
+                            ('dummies_%i', dict(color='k', lw=3, label='dummies')),
+                            ('triggers_%i', dict(color='g', lw=3, label='triggers'))):
+            y = arrays[key % i]
+            if not key.startswith('gradient'):
+                y = y * threshold * 1.5
+            s.plot(*downsample_trace(x, y, max_points), **kwargs)
+        s.axhline(threshold, color='r', ls='--', label='threshold')
+        s.set_title('summed gradient signal (x, y, z) -- nr volumes = {}'.format(nr_volumes))
+        s.set_xlabel('samples, {}Hz'.format(sample_rate))
+        s.set_ylim((0, threshold * 1.5))
+        s.legend(loc=2)
+
+
+# renderer per kind of QC figure; renderers draw on a matplotlib figure
+QC_RENDERERS = {'motion': _render_motion,
+                'gradients': _render_gradients}
+
+
+def _render_qc_file(qc_file, max_points=None):
+    import os
+    import json
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from spynoza.qc.nodes import QC_RENDERERS
+
+    with np.load(qc_file) as data:
+        arrays = dict(data)
+    spec = json.loads(str(arrays.pop('qc_spec')))
+
+    fig = plt.figure(figsize=(10, 4))
+    QC_RENDERERS[spec['kind']](fig, arrays, max_points=max_points,
+                               **spec['options'])
+    fig.tight_layout()
+    fig_file = os.path.abspath(spec['fig_file'])
+    fig.savefig(fig_file)
+    plt.close(fig)
+    return fig_file
+
+
+def _lower_priority(niceness):
+    import os
+    os.nice(niceness)
+
+
+def render_qc(qc_files, max_points=None, n_procs=1, niceness=10,
+              wait_for=None):
+    """ Renders QC figures from the data emitted by compute nodes (see
+    write_qc_data), in batch, in a pool of low-priority processes.
+
+    Connecting all QC outputs (the outputspec.qc_files of the
+    sub-workflows) of a subject's workflow to a single render_qc node defers
+    plotting until the heavy nodes are done.
+
+    Parameters
+    ----------
+    qc_files : list
+        (Nested lists of) absolute paths to QC data files.
+    max_points : int
+        If given, traces are downsampled to at most this many samples.
+    n_procs : int (default: 1)
+        Number of rendering processes; set node.n_procs to match.
+    niceness : int (default: 10)
+        Increment of the niceness of the rendering processes.
+    wait_for : list
+        Not used; connect the final outputs of a workflow to it so that
+        rendering only starts once they are done, instead of alongside the
+        heavy nodes that follow the QC data.
+
+    Returns
+    -------
+    fig_files : list
+        Absolute paths to the figures, in the (flattened) order of qc_files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from nipype.utils.filemanip import ensure_list
+    from spynoza.qc.nodes import _render_qc_file, _lower_priority
+
+    def _flatten(files):
+        for f in ensure_list(files):
+            if isinstance(f, (list, tuple)):
+                for g in _flatten(f):
+                    yield g
+            else:
+                yield f
+
+    qc_files = list(_flatten(qc_files))
+    if not qc_files:
+        return []
+    n_procs = min(n_procs or 1, len(qc_files))
+    with ProcessPoolExecutor(max_workers=n_procs, initializer=_lower_priority,
+                             initargs=(niceness,)) as pool:
+        fig_files = list(pool.map(_render_qc_file, qc_files,
+                                  [max_points] * len(qc_files)))
+    return fig_files
+
+
+Render_qc = Function(function=render_qc,
+                     input_names=['qc_files', 'max_points', 'n_procs',
+                                  'niceness', 'wait_for'],
+                     output_names=['fig_files'])
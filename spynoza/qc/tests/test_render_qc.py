@@ -0,0 +1,71 @@
+import json
+import pytest
+import numpy as np
+import os.path as op
+from ..nodes import motion_qc, render_qc, downsample_trace, write_qc_data
+
+
+@pytest.mark.qc
+def test_motion_qc(tmpdir):
+    tmpdir.chdir()
+    par_file = op.abspath('run_mcf.par')
+    np.savetxt(par_file, np.random.RandomState(0).randn(50, 6) * .1)
+
+    qc_files = motion_qc(par_file)
+    assert qc_files == [op.abspath('run_mcf_rot.npz'),
+                        op.abspath('run_mcf_trans.npz')]
+    with np.load(qc_files[1]) as data:
+        spec = json.loads(str(data['qc_spec']))
+        np.testing.assert_allclose(data['params'], np.loadtxt(par_file))
+    assert spec['kind'] == 'motion' and spec['fig_file'] == 'run_mcf_trans.png'
+    assert spec['options'] == {'plot_type': 'translations'}
+
+
+@pytest.mark.qc
+def test_downsample_trace():
+    x = np.arange(100000)
+    y = np.zeros(100000)
+    y[[12345, 67890]] = [5., -3.]
+    x_ds, y_ds = downsample_trace(x, y, 1000)
+    assert x_ds.shape[0] <= 1000
+    # spikes survive
+    assert y_ds.max() == 5. and y_ds.min() == -3.
+    assert downsample_trace(x, y, None)[0] is x
+
+
+@pytest.mark.qc
+def test_render_qc(tmpdir):
+    pytest.importorskip('matplotlib')
+    tmpdir.chdir()
+    params = np.random.RandomState(0).randn(50, 6) * .1
+    qc_files = []
+    for run in ('run-1', 'run-2'):
+        np.savetxt(run + '_mcf.par', params)
+        qc_files.append(motion_qc(op.abspath(run + '_mcf.par')))
+    samples = np.arange(5000)
+    qc_files.append(write_qc_data(
+        'gradients', 'run-1_fig.png',
+        {'samples_0': samples, 'gradient_0': np.sin(samples / 10.),
+         'dummies_0': samples == 10, 'triggers_0': samples % 100 == 0},
+        threshold=.5, sample_rate=496, nr_volumes=50))
+
+    fig_files = render_qc(qc_files, max_points=500, n_procs=2)
+    assert [op.basename(f) for f in fig_files] == \
+        ['run-1_mcf_rot.png', 'run-1_mcf_trans.png', 'run-2_mcf_rot.png',
+         'run-2_mcf_trans.png', 'run-1_fig.png']
+    assert all(op.getsize(f) > 0 for f in fig_files)
+
+
+@pytest.mark.qc
+def test_render_qc_wait_for():
+    import nipype.pipeline as pe
+    from nipype.interfaces.utility import IdentityInterface
+    from ..nodes import Render_qc
+
+    # wait_for only orders the renderer after the given outputs
+    assert render_qc([], wait_for=['psc.nii.gz']) == []
+    final = pe.Node(IdentityInterface(fields=['out_file']), name='final')
+    renderer = pe.Node(Render_qc, name='render_qc')
+    wf = pe.Workflow(name='qc')
+    wf.connect(final, 'out_file', renderer, 'wait_for')
+    assert renderer in wf._graph.successors(final)
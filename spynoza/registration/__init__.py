@@ -1 +1 @@
-from . import workflows, sub_workflows
\ No newline at end of file
+from . import nodes, workflows, sub_workflows
@@ -0,0 +1,742 @@
+from nipype.interfaces.utility import Function
+
+
+def invert_fsl_matrix(in_file):
+    """ Inverts an FSL (FLIRT) matrix, like convert_xfm -inverse.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to FSL matrix file.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to inverted matrix file (<base>_inv.mat).
+    """
+    import os
+    import numpy as np
+
+    out_file = os.path.abspath(
+        os.path.splitext(os.path.basename(in_file))[0] + '_inv.mat')
+    np.savetxt(out_file, np.linalg.inv(np.loadtxt(in_file)), fmt='%.10f')
+
+    return out_file
+
+
+Invert_fsl_matrix = Function(function=invert_fsl_matrix,
+                             input_names=['in_file'],
+                             output_names=['out_file'])
+
+
+def select_fsl_matrix(mat_file, index=0, invert=False):
+    """ Picks the matrix of a single volume from per-volume FSL matrices
+    (e.g., MCFLIRT's .mat directory), optionally inverted.
+
+    Parameters
+    ----------
+    mat_file : str or list
+        A .mat directory or a list of matrix files, one per volume (see
+        spynoza.utils.load_fsl_matrices).
+    index : int (default: 0)
+        Index of the volume.
+    invert : bool (default: False)
+        Whether to invert the matrix, e.g., to map the motion correction
+        reference to the volume.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to matrix file (<base>_<index>[_inv].mat).
+    """
+    import os
+    import numpy as np
+    from spynoza.utils import load_fsl_matrices
+
+    mats = load_fsl_matrices(mat_file)
+    index = index % mats.shape[0]
+    mat = np.linalg.inv(mats[index]) if invert else mats[index]
+
+    first = mat_file[0] if isinstance(mat_file, list) else mat_file
+    base = os.path.basename(os.path.normpath(first)).split('.')[0]
+    out_file = os.path.abspath('%s_%04i%s.mat' % (base, index,
+                                                  '_inv' if invert else ''))
+    np.savetxt(out_file, mat, fmt='%.10f')
+
+    return out_file
+
+
+Select_fsl_matrix = Function(function=select_fsl_matrix,
+                             input_names=['mat_file', 'index', 'invert'],
+                             output_names=['out_file'])
+
+
+def concat_fsl_matrices(in_file, in_file2):
+    """ Concatenates two FSL (FLIRT) matrices, like convert_xfm -concat:
+    the result applies in_file first and in_file2 second.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to first FSL matrix file (A -> B).
+    in_file2 : str
+        Absolute path to second FSL matrix file (B -> C).
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to concatenated matrix file (A -> C).
+    """
+    import os
+    import numpy as np
+
+    base = [os.path.splitext(os.path.basename(f))[0]
+            for f in (in_file, in_file2)]
+    out_file = os.path.abspath('%s_%s.mat' % tuple(base))
+    np.savetxt(out_file, np.loadtxt(in_file2).dot(np.loadtxt(in_file)),
+               fmt='%.10f')
+
+    return out_file
+
+
+Concat_fsl_matrices = Function(function=concat_fsl_matrices,
+                               input_names=['in_file', 'in_file2'],
+                               output_names=['out_file'])
+
+
+def create_feat_reg_dir(EPI_T1_matrix_file, T1_standard_matrix_file,
+                        example_func=None, highres=None, standard=None,
+                        register_file=None):
+    """ Writes a FEAT-style reg directory in one go: all forward and inverse
+    combinations of the EPI -> T1 and T1 -> standard FLIRT matrices, plus
+    the images under their FEAT names.
+
+    FLIRT matrices map between the scaled-mm spaces of their input and
+    reference images, so (as for convert_xfm) they invert and concatenate
+    as plain 4x4 matrices, as long as the images they were estimated on are
+    used as the corresponding spaces.
+
+    Parameters
+    ----------
+    EPI_T1_matrix_file : str
+        FLIRT/BBRegister matrix mapping EPI (example_func) to T1 (highres).
+    T1_standard_matrix_file : str
+        FLIRT matrix mapping T1 (highres) to standard.
+    example_func : str
+        EPI space file (optional).
+    highres : str
+        T1 file (optional).
+    standard : str
+        Standard space file (optional).
+    register_file : str
+        BBRegister register.dat file (optional).
+
+    Returns
+    -------
+    out_files : list
+        Absolute paths to all files written (matrices and images).
+    EPI_T1_matrix_file : str
+        example_func2highres.mat
+    T1_EPI_matrix_file : str
+        highres2example_func.mat
+    T1_standard_matrix_file : str
+        highres2standard.mat
+    standard_T1_matrix_file : str
+        standard2highres.mat
+    EPI_standard_matrix_file : str
+        example_func2standard.mat
+    standard_EPI_matrix_file : str
+        standard2example_func.mat
+    """
+    import os
+    import shutil
+    import numpy as np
+
+    e2h = np.loadtxt(EPI_T1_matrix_file)
+    h2s = np.loadtxt(T1_standard_matrix_file)
+    e2s = h2s.dot(e2h)
+    mats = [('example_func2highres', e2h),
+            ('highres2example_func', np.linalg.inv(e2h)),
+            ('highres2standard', h2s),
+            ('standard2highres', np.linalg.inv(h2s)),
+            ('example_func2standard', e2s),
+            ('standard2example_func', np.linalg.inv(e2s))]
+
+    mat_files = []
+    for name, mat in mats:
+        mat_files.append(os.path.abspath(name + '.mat'))
+        np.savetxt(mat_files[-1], mat, fmt='%.10f')
+
+    out_files = list(mat_files)
+    images = [('example_func', example_func), ('highres', highres),
+              ('standard', standard), ('register', register_file)]
+    for name, in_file in images:
+        if in_file is None:
+            continue
+        ext = os.path.splitext(in_file)[1]
+        if in_file.endswith('.nii.gz'):
+            ext = '.nii.gz'
+        out_file = os.path.abspath(name + ext)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        # hard link where possible: the datasink copies these anyway
+        try:
+            os.link(in_file, out_file)
+        except OSError:
+            shutil.copyfile(in_file, out_file)
+        out_files.append(out_file)
+
+    return tuple([out_files] + mat_files)
+
+
+Create_feat_reg_dir = Function(function=create_feat_reg_dir,
+                               input_names=['EPI_T1_matrix_file',
+                                            'T1_standard_matrix_file',
+                                            'example_func', 'highres',
+                                            'standard', 'register_file'],
+                               output_names=['out_files',
+                                             'EPI_T1_matrix_file',
+                                             'T1_EPI_matrix_file',
+                                             'T1_standard_matrix_file',
+                                             'standard_T1_matrix_file',
+                                             'EPI_standard_matrix_file',
+                                             'standard_EPI_matrix_file'])
+
+
+def _affine_from_params(params, centre, dof=12):
+    """ Builds the 4x4 matrix (in FSL scaled-mm, reference -> input) from
+    rotations (rad), translations (mm), log-scales and shears, about
+    `centre`. Only the first parameters are used for dof < 12: 6 (rigid),
+    7 (global scale), 9 (scales) or 12 (shears). """
+    import numpy as np
+    from spynoza.utils import params_to_fsl_matrix
+
+    p = np.zeros(12)
+    p[:len(params)] = params
+    if dof == 7:
+        p[7] = p[8] = p[6]
+    rigid = params_to_fsl_matrix(np.r_[p[:3], 0, 0, 0])
+    scale_shear = np.diag(np.r_[np.exp(p[6:9]), 1.])
+    scale_shear[0, 1], scale_shear[0, 2], scale_shear[1, 2] = p[9:12]
+
+    centre = np.asarray(centre, dtype=np.float64)
+    mat = np.eye(4)
+    mat[:3, :3] = rigid[:3, :3].dot(scale_shear[:3, :3])
+    mat[:3, 3] = centre + p[3:6] - mat[:3, :3].dot(centre)
+    return mat
+
+
+def _registration_cost(params, dof, level):
+    """ Similarity cost (lower is better) of one parameter set at one pyramid
+    level; `level` is a dict with the sampled reference and the moving
+    image, see register_affine. """
+    import numpy as np
+    import scipy.ndimage as nd
+    from spynoza.registration.nodes import _affine_from_params
+
+    mat = level['fsl2mov'].dot(_affine_from_params(params, level['centre'],
+                                                   dof))
+    coords = mat[:3, :3].dot(level['points']) + mat[:3, 3:]
+    valid = np.all((coords >= 0) & (coords <= level['upper']), axis=0)
+    if valid.sum() < .1 * valid.size:
+        return 1e3
+
+    bins = level['bins']
+    values = nd.map_coordinates(level['moving'], coords[:, valid], order=1)
+    ref_bins = level['ref_bins'][valid]
+
+    if level['cost'] == 'normmi':
+        # linear (partial) binning of the moving values keeps the cost
+        # smooth in the parameters
+        pos = np.clip((values - level['mov_min']) * level['mov_scale'] - .5,
+                      0, bins - 1)
+        low = np.minimum(pos.astype(np.int64), bins - 2)
+        frac = pos - low
+        joint = np.bincount(ref_bins * bins + low, weights=1 - frac,
+                            minlength=bins * bins)
+        joint += np.bincount(ref_bins * bins + low + 1, weights=frac,
+                             minlength=bins * bins)
+        joint /= joint.sum()
+        joint = joint.reshape((bins, bins))
+
+        def _entropy(p):
+            p = p[p > 0]
+            return -(p * np.log(p)).sum()
+
+        return -(_entropy(joint.sum(axis=1)) + _entropy(joint.sum(axis=0))) / \
+            _entropy(joint)
+    elif level['cost'] == 'corratio':
+        n = np.bincount(ref_bins, minlength=bins).astype(np.float64)
+        s = np.bincount(ref_bins, weights=values, minlength=bins)
+        ss = np.bincount(ref_bins, weights=values ** 2, minlength=bins)
+        total_var = values.var()
+        if total_var <= 0:
+            return 1e3
+        within = (ss - s ** 2 / np.maximum(n, 1)).sum() / values.size
+        return within / total_var
+    else:  # leastsq, after matching the means
+        ref_values = level['ref_values'][valid]
+        values = values * (ref_values.mean() / max(values.mean(), 1e-6))
+        return ((values - ref_values) ** 2).mean() / ref_values.var()
+
+
+def _optimize_registration(params, dof, level, scales, xtol=1e-2):
+    """ Powell optimisation of the first dof parameters from `params`;
+    returns (cost, params). """
+    import numpy as np
+    from scipy.optimize import minimize
+    from spynoza.registration.nodes import _registration_cost
+
+    n = dof
+    x0 = np.asarray(params, dtype=np.float64)[:n] / scales[:n]
+
+    res = minimize(lambda x: _registration_cost(x * scales[:n], dof, level),
+                   x0, method='Powell',
+                   options={'xtol': xtol, 'ftol': 1e-5})
+    out = np.zeros(12)
+    out[:n] = res.x * scales[:n]
+    return res.fun, out
+
+
+def register_affine(in_file, reference, dof=12, cost_func='normmi', bins=64,
+                    levels=(8., 4., 2.), searchr=30., n_search=3,
+                    interp='trilinear', n_procs=1):
+    """ Affine registration of in_file to reference; a native (NumPy/SciPy)
+    alternative to FLIRT that writes FLIRT-format outputs.
+
+    The cost is computed from joint histograms (np.bincount) of the
+    resampled input and the reference, over a coarse-to-fine pyramid (in mm).
+    At the coarsest level a grid of starting rotations is evaluated and the
+    best candidates are optimised in parallel (rigid); finer levels refine
+    all degrees of freedom.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 3D nifti-file to register.
+    reference : str
+        Absolute path to 3D reference nifti-file.
+    dof : int [6, 7, 9, 12] (default: 12)
+        Degrees of freedom.
+    cost_func : str ['normmi', 'corratio', 'leastsq'] (default: 'normmi')
+        Cost function, as in FLIRT.
+    bins : int (default: 64)
+        Number of histogram bins.
+    levels : tuple (default: (8., 4., 2.))
+        Sampling resolution (in mm) of the pyramid levels, coarse to fine.
+    searchr : float (default: 30.)
+        Search range (+/-, in degrees) of the starting rotations.
+    n_search : int (default: 3)
+        Number of starting rotations per axis.
+    interp : str ['trilinear', 'nearestneighbour', 'sinc', 'spline']
+        Interpolation of the output image ('sinc' uses a cubic spline).
+    n_procs : int (default: 1)
+        Number of processes for the coarse search; set node.n_procs to
+        match, so that the nipype scheduler accounts for them.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to in_file resampled to the reference.
+    out_matrix_file : str
+        Absolute path to FLIRT matrix (in_file -> reference).
+    """
+    import os
+    import itertools
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from concurrent.futures import ProcessPoolExecutor
+    from spynoza.utils import fsl_voxel_to_mm
+    from spynoza.resampling.nodes import resample_chunk
+    from spynoza.registration.nodes import (_affine_from_params,
+                                            _registration_cost,
+                                            _optimize_registration)
+
+    in_img, ref_img = nib.load(in_file), nib.load(reference)
+    mov = np.asanyarray(in_img.dataobj, dtype=np.float32).squeeze()
+    ref = np.asanyarray(ref_img.dataobj, dtype=np.float32).squeeze()
+    in_zooms = np.array(in_img.header.get_zooms()[:3])
+    ref_zooms = np.array(ref_img.header.get_zooms()[:3])
+    in2fsl = fsl_voxel_to_mm(mov.shape, in_zooms, in_img.affine)
+    ref2fsl = fsl_voxel_to_mm(ref.shape, ref_zooms, ref_img.affine)
+
+    def _cog(data, vox2fsl):
+        w = np.clip(data, 0, None)
+        idx = np.indices(data.shape).reshape((3, -1))
+        cog = idx.dot(w.ravel()) / max(w.sum(), 1e-6)
+        return vox2fsl[:3, :3].dot(cog) + vox2fsl[:3, 3]
+
+    centre = _cog(ref, ref2fsl)
+    init = np.zeros(12)
+    init[3:6] = _cog(mov, in2fsl) - centre
+
+    pyramid = []
+    for res in levels:
+        step = np.maximum(np.round(res / ref_zooms), 1).astype(int)
+        ref_s = nd.gaussian_filter(ref, np.maximum(res / ref_zooms / 2.355 *
+                                                   (step > 1), 0))
+        mov_s = nd.gaussian_filter(mov, np.maximum(res / in_zooms / 2.355 *
+                                                   (res > in_zooms), 0))
+        sl = tuple(slice(0, None, s) for s in step)
+        idx = np.indices(ref.shape)[(slice(None),) + sl].reshape((3, -1))
+        ref_values = ref_s[sl].ravel()
+        keep = ref_values > 0
+        points = ref2fsl[:3, :3].dot(idx[:, keep]) + ref2fsl[:3, 3:]
+        ref_values = ref_values[keep]
+
+        r_lo, r_hi = ref_values.min(), ref_values.max()
+        m_lo, m_hi = np.percentile(mov_s, [0, 99.9])
+        pyramid.append({
+            'points': points, 'ref_values': ref_values,
+            'ref_bins': np.clip(((ref_values - r_lo) / max(r_hi - r_lo, 1e-6) *
+                                 bins).astype(np.int64), 0, bins - 1),
+            'moving': mov_s, 'upper': np.array(mov.shape)[:, np.newaxis] - 1,
+            'fsl2mov': np.linalg.inv(in2fsl), 'centre': centre,
+            'mov_min': m_lo, 'mov_scale': bins / max(m_hi - m_lo, 1e-6),
+            'bins': bins, 'cost': cost_func})
+
+    scales = np.array([.05] * 3 + [2.] * 3 + [.02] * 3 + [.02] * 3)
+    angles = np.deg2rad(np.linspace(-searchr, searchr, n_search)) \
+        if n_search > 1 else np.zeros(1)
+    starts = []
+    for rot in itertools.product(angles, repeat=3):
+        p = init.copy()
+        p[:3] = rot
+        starts.append(p)
+
+    # coarsest level: evaluate all starts, optimise the best few (rigid)
+    n_procs = n_procs or 1
+    coarse = pyramid[0]
+    costs = [_registration_cost(p[:6], 6, coarse) for p in starts]
+    best = [starts[i] for i in np.argsort(costs)[:min(3, len(starts))]]
+    if n_procs > 1 and len(best) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_procs, len(best))) as pool:
+            results = list(pool.map(_optimize_registration, best,
+                                    [6] * len(best), [coarse] * len(best),
+                                    [scales] * len(best)))
+    else:
+        results = [_optimize_registration(p, 6, coarse, scales) for p in best]
+    params = min(results, key=lambda r: r[0])[1]
+
+    # finer levels: all degrees of freedom, with a tighter tolerance at the
+    # finest level only
+    fine = pyramid[1:] if len(pyramid) > 1 else pyramid
+    for i, level in enumerate(fine):
+        params = _optimize_registration(params, dof, level, scales,
+                                        xtol=1e-2 if i == len(fine) - 1
+                                        else 5e-2)[1]
+
+    ref2mov = _affine_from_params(params, centre, dof)
+    flirt_mat = np.linalg.inv(ref2mov)
+
+    base = os.path.basename(in_file).split('.')[0] + '_flirt'
+    out_matrix_file = os.path.abspath(base + '.mat')
+    np.savetxt(out_matrix_file, flirt_mat, fmt='%.10f')
+
+    order = {'nearestneighbour': 0, 'trilinear': 1, 'sinc': 3,
+             'spline': 3}[interp]
+    vox_mat = np.linalg.inv(in2fsl).dot(ref2mov).dot(ref2fsl)
+    out_data = resample_chunk(mov[..., np.newaxis], vox_mat[np.newaxis],
+                              ref.shape, order=order, n_threads=1)[..., 0]
+    out_file = os.path.abspath(base + '.nii.gz')
+    nib.save(nib.Nifti1Image(out_data, ref_img.affine), out_file)
+
+    return out_file, out_matrix_file
+
+
+Register_affine = Function(function=register_affine,
+                           input_names=['in_file', 'reference', 'dof',
+                                        'cost_func', 'bins', 'levels',
+                                        'searchr', 'n_search', 'interp',
+                                        'n_procs'],
+                           output_names=['out_file', 'out_matrix_file'])
+
+
+def boundary_points_from_surfaces(surf_files, ref_img):
+    """ Reads FreeSurfer (white) surfaces and returns vertex coordinates and
+    outward normals in the FSL scaled-mm space of ref_img (e.g., T1.mgz).
+
+    Returns
+    -------
+    points : np.ndarray
+        Array of shape (3, N) with vertex coordinates.
+    normals : np.ndarray
+        Array of shape (3, N) with unit normals (pointing out of WM).
+    """
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import fsl_voxel_to_mm
+
+    # surface (tkr) RAS -> voxels of the volume the surfaces belong to
+    if hasattr(ref_img.header, 'get_vox2ras_tkr'):
+        tkr2vox = np.linalg.inv(ref_img.header.get_vox2ras_tkr())
+    else:
+        tkr2vox = np.linalg.inv(ref_img.affine)
+    vox2fsl = fsl_voxel_to_mm(ref_img.shape[:3], ref_img.header.get_zooms(),
+                              ref_img.affine)
+    tkr2fsl = vox2fsl.dot(tkr2vox)
+
+    points, normals = [], []
+    for surf_file in surf_files:
+        coords, faces = nib.freesurfer.read_geometry(surf_file)
+        tri = coords[faces]
+        face_normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        vertex_normals = np.zeros_like(coords)
+        for i in range(3):
+            np.add.at(vertex_normals, faces[:, i], face_normals)
+
+        points.append(tkr2fsl[:3, :3].dot(coords.T) + tkr2fsl[:3, 3:])
+        # normals transform with the inverse transpose
+        n = np.linalg.inv(tkr2fsl[:3, :3]).T.dot(vertex_normals.T)
+        normals.append(n / np.maximum(np.linalg.norm(n, axis=0), 1e-12))
+
+    return np.hstack(points), np.hstack(normals)
+
+
+def boundary_points_from_wm_seg(wm_seg, max_points=20000):
+    """ Returns points on the boundary of a white matter segmentation and
+    outward normals, in the FSL scaled-mm space of the segmentation.
+
+    Parameters
+    ----------
+    wm_seg : str
+        Absolute path to white matter segmentation (e.g., from FAST).
+    max_points : int (default: 20000)
+        Boundary voxels are subsampled evenly to at most this number.
+
+    Returns
+    -------
+    points : np.ndarray
+        Array of shape (3, N) with boundary coordinates.
+    normals : np.ndarray
+        Array of shape (3, N) with unit normals (pointing out of WM).
+    """
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from spynoza.utils import fsl_voxel_to_mm
+
+    img = nib.load(wm_seg)
+    wm = np.asanyarray(img.dataobj).squeeze() > 0.5
+    boundary = wm & ~nd.binary_erosion(wm)
+    idx = np.argwhere(boundary)[::max(1, int(boundary.sum() // max_points))]
+
+    vox2fsl = fsl_voxel_to_mm(wm.shape, img.header.get_zooms(), img.affine)
+    smooth = nd.gaussian_filter(wm.astype(np.float32), 1.)
+    grad = np.stack([g[tuple(idx.T)] for g in np.gradient(smooth)])
+    # the gradient points into WM, in voxel units
+    normals = -np.linalg.inv(vox2fsl[:3, :3]).T.dot(grad)
+    normals /= np.maximum(np.linalg.norm(normals, axis=0), 1e-12)
+    points = vox2fsl[:3, :3].dot(idx.T) + vox2fsl[:3, 3:]
+
+    return points, normals
+
+
+def _trilinear(vol, coords):
+    """ Trilinear interpolation of vol at coords (3, N), with the exact
+    gradient of the interpolant w.r.t. the coordinates (3, N). Coordinates
+    must lie within the volume. """
+    import numpy as np
+
+    upper = np.array(vol.shape)[:, np.newaxis] - 2
+    base = np.clip(np.floor(coords).astype(np.int64), 0, upper)
+    t = coords - base
+    values = np.zeros(coords.shape[1])
+    grad = np.zeros(coords.shape)
+    for corner in np.ndindex(2, 2, 2):
+        d = np.array(corner)[:, np.newaxis]
+        v = vol[tuple(base + d)]
+        w = np.where(d, t, 1 - t)  # per-axis weights
+        values += v * w.prod(axis=0)
+        sign = np.where(d, 1., -1.)
+        grad[0] += v * sign[0] * w[1] * w[2]
+        grad[1] += v * sign[1] * w[0] * w[2]
+        grad[2] += v * sign[2] * w[0] * w[1]
+    return values, grad
+
+
+def _bbr_cost(params, centre, wm_points, gm_points, epi, fsl2epi, sign,
+              slope):
+    """ BBR cost (and analytic gradient) of rigid parameters mapping
+    anatomical scaled-mm to EPI scaled-mm. """
+    import numpy as np
+    from spynoza.utils import params_to_fsl_matrix
+    from spynoza.registration.nodes import _trilinear
+
+    A = params_to_fsl_matrix(params, centre)
+    # derivatives of the matrix w.r.t. each parameter (central differences
+    # of the closed-form matrix; exact up to rounding)
+    eps = 1e-6
+    dA = np.empty((6, 4, 4))
+    for j in range(6):
+        step = np.zeros(6)
+        step[j] = eps
+        dA[j] = (params_to_fsl_matrix(params + step, centre) -
+                 params_to_fsl_matrix(params - step, centre)) / (2 * eps)
+    M = fsl2epi.dot(A)
+    dM = np.matmul(fsl2epi, dA)
+
+    upper = np.array(epi.shape)[:, np.newaxis] - 1
+    coords = [M[:3, :3].dot(pts) + M[:3, 3:] for pts in (wm_points, gm_points)]
+    valid = np.all([(c >= 0) & (c <= upper) for c in coords], axis=(0, 1))
+    if valid.sum() < 10:
+        return 2., np.zeros(6)
+
+    samples, jacobians = [], []
+    for c, pts in zip(coords, (wm_points, gm_points)):
+        values, g = _trilinear(epi, c[:, valid])
+        # d(coords)/d(params) = dM_j * pts
+        d_coords = np.einsum('jik,kn->jin', dM[:, :3, :3], pts[:, valid]) + \
+            dM[:, :3, 3][..., np.newaxis]
+        samples.append(values)
+        jacobians.append(np.einsum('in,jin->jn', g, d_coords))
+
+    w, g = samples
+    dw, dg = jacobians
+    total = np.maximum(g + w, 1e-6)
+    Q = 200. * (g - w) / total
+    t = np.tanh(sign * slope * Q)
+    cost = (1 - t).mean()
+
+    dcost_dQ = -sign * slope * (1 - t ** 2)
+    dQ_dg = 400. * w / total ** 2
+    dQ_dw = -400. * g / total ** 2
+    grad = (dcost_dQ * (dQ_dg * dg + dQ_dw * dw)).mean(axis=1)
+    return cost, grad
+
+
+def register_bbr(in_file, reference=None, wm_seg=None, subject_id=None,
+                 subjects_dir=None, init_matrix=None, contrast='t2',
+                 slope=0.5, wm_dist=2., gm_dist=1., interp='trilinear'):
+    """ Boundary-based registration (6 DOF) of an EPI to an anatomical
+    image; a native alternative to bbregister and FLIRT -cost bbr.
+
+    The EPI is sampled at fixed distances inside (WM) and outside (GM) the
+    white matter boundary, along its normals; the boundary points are
+    computed once, from FreeSurfer white surfaces or from a WM segmentation,
+    and reused for every candidate transform. The cost (Greve & Fischl,
+    2009) is optimised with its analytic gradient.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to (3D) EPI nifti-file.
+    reference : str
+        Absolute path to anatomical file; defaults to the FreeSurfer T1.mgz
+        if subject_id is given.
+    wm_seg : str
+        Absolute path to white matter segmentation of the reference; only
+        used without subject_id.
+    subject_id : str
+        FreeSurfer subject ID; if given, lh.white and rh.white are used.
+    subjects_dir : str
+        FreeSurfer subjects directory.
+    init_matrix : str
+        FLIRT matrix (EPI -> reference) to start from; if None, a native
+        rigid correlation-ratio registration is used for initialisation.
+    contrast : str ['t2', 't1'] (default: 't2')
+        Whether grey matter is brighter ('t2', as in BOLD EPI) or darker
+        than white matter in the EPI.
+    slope : float (default: 0.5)
+        Slope of the tanh cost, as FLIRT's bbrslope.
+    wm_dist : float (default: 2.)
+        Sampling distance (mm) into white matter.
+    gm_dist : float (default: 1.)
+        Sampling distance (mm) into grey matter.
+    interp : str ['trilinear', 'nearestneighbour', 'sinc', 'spline']
+        Interpolation of the output image.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to EPI resampled to the reference.
+    out_matrix_file : str
+        Absolute path to FLIRT matrix (EPI -> reference).
+    min_cost : float
+        Final BBR cost.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from scipy.optimize import minimize
+    from spynoza.utils import (fsl_voxel_to_mm, fsl_matrix_to_params,
+                               params_to_fsl_matrix)
+    from spynoza.resampling.nodes import resample_chunk
+    from spynoza.registration.nodes import (boundary_points_from_surfaces,
+                                            boundary_points_from_wm_seg,
+                                            register_affine, _bbr_cost)
+
+    if subject_id is not None:
+        subj = os.path.join(subjects_dir, subject_id)
+        if reference is None:
+            reference = os.path.join(subj, 'mri', 'T1.mgz')
+        ref_img = nib.load(reference)
+        points, normals = boundary_points_from_surfaces(
+            [os.path.join(subj, 'surf', h + '.white') for h in ('lh', 'rh')],
+            ref_img)
+    elif wm_seg is not None:
+        ref_img = nib.load(reference)
+        points, normals = boundary_points_from_wm_seg(wm_seg)
+    else:
+        raise ValueError('BBR needs either a FreeSurfer subject or a white '
+                         'matter segmentation')
+
+    epi_img = nib.load(in_file)
+    epi = np.asanyarray(epi_img.dataobj, dtype=np.float32)
+    if epi.ndim > 3:
+        epi = epi.mean(axis=-1)
+    epi2fsl = fsl_voxel_to_mm(epi.shape, epi_img.header.get_zooms(),
+                              epi_img.affine)
+    fsl2epi = np.linalg.inv(epi2fsl)
+
+    if init_matrix is None:
+        ref_file = reference
+        if not reference.endswith(('.nii', '.nii.gz')):
+            ref_file = os.path.abspath('bbr_reference.nii.gz')
+            nib.save(nib.Nifti1Image(np.asanyarray(ref_img.dataobj,
+                                                   dtype=np.float32),
+                                     ref_img.affine), ref_file)
+        init_matrix = register_affine(in_file, ref_file, dof=6,
+                                      cost_func='corratio', n_procs=1)[1]
+
+    # parameters of the anatomical -> EPI transform, about the boundary centre
+    centre = points.mean(axis=1)
+    params = fsl_matrix_to_params(np.linalg.inv(np.loadtxt(init_matrix)),
+                                  centre)
+
+    wm_points = points - wm_dist * normals
+    gm_points = points + gm_dist * normals
+    sign = 1. if contrast == 't2' else -1.
+    args = (centre, wm_points, gm_points, epi, fsl2epi, sign, slope)
+
+    res = minimize(_bbr_cost, params, args=args, jac=True, method='L-BFGS-B')
+    params, min_cost = res.x, float(res.fun)
+
+    anat2epi = params_to_fsl_matrix(params, centre)
+    base = os.path.basename(in_file).split('.')[0] + '_bbr'
+    out_matrix_file = os.path.abspath(base + '.mat')
+    np.savetxt(out_matrix_file, np.linalg.inv(anat2epi), fmt='%.10f')
+
+    order = {'nearestneighbour': 0, 'trilinear': 1, 'sinc': 3,
+             'spline': 3}[interp]
+    ref2fsl = fsl_voxel_to_mm(ref_img.shape[:3], ref_img.header.get_zooms(),
+                              ref_img.affine)
+    vox_mat = fsl2epi.dot(anat2epi).dot(ref2fsl)
+    out_data = resample_chunk(epi[..., np.newaxis], vox_mat[np.newaxis],
+                              ref_img.shape[:3], order=order,
+                              n_threads=1)[..., 0]
+    out_file = os.path.abspath(base + '.nii.gz')
+    nib.save(nib.Nifti1Image(out_data, ref_img.affine), out_file)
+
+    return out_file, out_matrix_file, min_cost
+
+
+Register_bbr = Function(function=register_bbr,
+                        input_names=['in_file', 'reference', 'wm_seg',
+                                     'subject_id', 'subjects_dir',
+                                     'init_matrix', 'contrast', 'slope',
+                                     'wm_dist', 'gm_dist', 'interp'],
+                        output_names=['out_file', 'out_matrix_file',
+                                      'min_cost'])
@@ -4,11 +4,13 @@ from nipype.interfaces import freesurfer
 from nipype.interfaces.utility import Function, IdentityInterface, Merge
 from nipype.interfaces.afni import SkullStrip
 import nipype.interfaces.io as nio
+from ..nodes import Invert_fsl_matrix, Register_affine
 
 # to do: afni skullstrip
 
 def create_T1_to_standard_workflow(name='T1_to_standard', use_FS = True,
-                                   do_fnirt = False, use_AFNI_ss=False):
+                                   do_fnirt = False, use_AFNI_ss=False,
+                                   backend='fsl', n_procs=1):
     """Registers subject's T1 to standard space using FLIRT and FNIRT.
     Requires fsl tools
     Parameters
@@ -17,6 +19,13 @@ def create_T1_to_standard_workflow(name='T1_to_standard', use_FS = True,
         name of workflow
     use_FS : bool
         whether to use freesurfer's T1
+    backend : string ['fsl', 'native']
+        whether the affine registration is done by FLIRT or natively
+        (spynoza.registration.nodes.register_affine), which writes the same
+        FLIRT-format outputs
+    n_procs : int (default: 1)
+        number of processes of the native affine registration (also
+        reserved from the nipype scheduler through node.n_procs)
     Example
     -------
     >>> T1_to_standard = create_T1_to_standard_workflow()
@@ -81,8 +90,16 @@ def create_T1_to_standard_workflow(name='T1_to_standard', use_FS = True,
     else:
         bet_N = pe.Node(interface=fsl.BET(vertical_gradient = -0.1, functional=False, mask=True), name='bet_N_fsl')
 
-    flirt_t2s = pe.Node(fsl.FLIRT(cost_func='normmi', output_type = 'NIFTI_GZ', dof = 12, interp = 'sinc'),
-                        name='flirt_t2s')
+    if backend == 'native':
+        flirt_t2s = pe.Node(interface=Register_affine, name='flirt_t2s')
+        flirt_t2s.inputs.cost_func = 'normmi'
+        flirt_t2s.inputs.dof = 12
+        flirt_t2s.inputs.interp = 'sinc'
+        flirt_t2s.inputs.n_procs = n_procs
+        flirt_t2s.n_procs = n_procs
+    else:
+        flirt_t2s = pe.Node(fsl.FLIRT(cost_func='normmi', output_type = 'NIFTI_GZ', dof = 12, interp = 'sinc'),
+                            name='flirt_t2s')
     if do_fnirt: 
         fnirt_N = pe.Node(fsl.FNIRT(in_fwhm=[8, 4, 2, 2],
                               subsampling_scheme=[4, 2, 1, 1],
@@ -129,7 +146,7 @@ def create_T1_to_standard_workflow(name='T1_to_standard', use_FS = True,
     ########################################################################################
     # invert step
     ########################################################################################
-    invert_N = pe.Node(fsl.ConvertXFM(invert_xfm = True), name = 'invert_N')
+    invert_N = pe.Node(interface=Invert_fsl_matrix, name = 'invert_N')
     T1_to_standard_workflow.connect(flirt_t2s, 'out_matrix_file', invert_N, 'in_file')
     T1_to_standard_workflow.connect(invert_N, 'out_file', output_node, 'standard_T1_matrix_file')
 
@@ -1,6 +1,6 @@
 def create_concat_2_feat_workflow(name = 'concat_2_feat'):
     """Concatenates and inverts previously created fsl mat registration files.
-    Requires fsl tools
+    Matrices are inverted and concatenated natively (no fsl tools needed)
     Parameters
     ----------
     name : string
@@ -33,6 +33,7 @@ def create_concat_2_feat_workflow(name = 'concat_2_feat'):
     from nipype.interfaces import freesurfer
     from nipype.interfaces.utility import Function, IdentityInterface
     import nipype.interfaces.io as nio
+    from ..nodes import Concat_fsl_matrices, Invert_fsl_matrix
     ### NODES
     input_node = pe.Node(IdentityInterface(
     fields=['T1_standard_matrix_file', 'EPI_T1_matrix_file']), name='inputspec')
@@ -47,7 +48,7 @@ def create_concat_2_feat_workflow(name = 'concat_2_feat'):
     ########################################################################################
     # concat step, from EPI to T1 to standard
     ########################################################################################
-    concat_N = pe.Node(fsl.ConvertXFM(concat_xfm = True), name = 'concat_N')
+    concat_N = pe.Node(interface=Concat_fsl_matrices, name = 'concat_N')
     concat_2_feat_workflow.connect(input_node, 'EPI_T1_matrix_file', concat_N, 'in_file')
     concat_2_feat_workflow.connect(input_node, 'T1_standard_matrix_file', concat_N, 'in_file2')
     concat_2_feat_workflow.connect(concat_N, 'out_file', output_node, 'EPI_standard_matrix_file')
@@ -55,7 +56,7 @@ def create_concat_2_feat_workflow(name = 'concat_2_feat'):
     ########################################################################################
     # invert step, to go from standard to T1 to EPI
     ########################################################################################
-    invert_N = pe.Node(fsl.ConvertXFM(invert_xfm = True), name = 'invert_N')
+    invert_N = pe.Node(interface=Invert_fsl_matrix, name = 'invert_N')
     concat_2_feat_workflow.connect(concat_N, 'out_file', invert_N, 'in_file')
     concat_2_feat_workflow.connect(invert_N, 'out_file', output_node, 'standard_EPI_matrix_file')
 
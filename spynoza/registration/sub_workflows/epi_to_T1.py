@@ -3,10 +3,11 @@ from nipype.interfaces import fsl
 from nipype.interfaces import freesurfer
 from nipype.interfaces.utility import Function, IdentityInterface
 from ...utils import pick_last
+from ..nodes import Invert_fsl_matrix, Register_affine, Register_bbr
 
 
 def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
-                              do_FAST=True):
+                              do_FAST=True, backend='fsl', n_procs=1):
     """Registers session's EPI space to subject's T1 space
     uses either FLIRT or, when a FS segmentation is present, BBRegister
     Requires fsl and freesurfer tools
@@ -17,6 +18,15 @@ def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
         name of workflow
     use_FS : bool
         whether to use freesurfer's segmentation and BBRegister
+    backend : string ['fsl', 'native']
+        whether registration is done by BBRegister/FLIRT or natively, which
+        writes the same FLIRT-format outputs: boundary-based (on the FS
+        white surfaces if use_FS, else on the FAST WM segmentation if
+        do_FAST), otherwise rigid with a correlation ratio cost. The native
+        backend does not produce an EPI_T1_register_file.
+    n_procs : int (default: 1)
+        number of processes of the native affine registration (also
+        reserved from the nipype scheduler through node.n_procs)
     Example
     -------
     >>> epi_to_T1 = create_epi_to_T1_workflow('epi_to_T1', use_FS = True)
@@ -48,7 +58,21 @@ def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
 
     epi_to_T1_workflow = pe.Workflow(name=name)
 
-    if use_FS: # do BBRegister
+    if use_FS and backend == 'native':  # native BBR on the FS white surfaces
+        bbregister_N = pe.Node(interface=Register_bbr, name='bbregister_N')
+        bbregister_N.inputs.contrast = 't2'
+
+        epi_to_T1_workflow.connect(input_node, 'EPI_space_file', bbregister_N, 'in_file')
+        epi_to_T1_workflow.connect(input_node, 'freesurfer_subject_ID', bbregister_N, 'subject_id')
+        epi_to_T1_workflow.connect(input_node, 'freesurfer_subject_dir', bbregister_N, 'subjects_dir')
+
+        epi_to_T1_workflow.connect(bbregister_N, 'out_matrix_file', output_node, 'EPI_T1_matrix_file')
+
+        invert_EPI_N = pe.Node(interface=Invert_fsl_matrix, name='invert_EPI_N')
+        epi_to_T1_workflow.connect(bbregister_N, 'out_matrix_file', invert_EPI_N, 'in_file')
+        epi_to_T1_workflow.connect(invert_EPI_N, 'out_file', output_node, 'T1_EPI_matrix_file')
+
+    elif use_FS: # do BBRegister
         bbregister_N = pe.Node(freesurfer.BBRegister(init = 'fsl', contrast_type = 't2', out_fsl_file = True ),
                                name = 'bbregister_N')
 
@@ -60,15 +84,27 @@ def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
         epi_to_T1_workflow.connect(bbregister_N, 'out_reg_file', output_node, 'EPI_T1_register_file')
 
         # the final invert node
-        invert_EPI_N = pe.Node(fsl.ConvertXFM(invert_xfm = True), name = 'invert_EPI_N')
+        invert_EPI_N = pe.Node(interface=Invert_fsl_matrix, name = 'invert_EPI_N')
         epi_to_T1_workflow.connect(bbregister_N, 'out_fsl_file', invert_EPI_N, 'in_file')
         epi_to_T1_workflow.connect(invert_EPI_N, 'out_file', output_node, 'T1_EPI_matrix_file')
 
     else:  # do FAST + FLIRT
 
-        flirt_e2t = pe.Node(fsl.FLIRT(cost_func='bbr', output_type='NIFTI_GZ',
-                                    dof=12, interp='sinc'),
-                          name ='flirt_e2t')
+        if backend == 'native' and do_FAST:
+            flirt_e2t = pe.Node(interface=Register_bbr, name='flirt_e2t')
+            flirt_e2t.inputs.contrast = 't2'
+            flirt_e2t.inputs.interp = 'sinc'
+        elif backend == 'native':
+            flirt_e2t = pe.Node(interface=Register_affine, name='flirt_e2t')
+            flirt_e2t.inputs.cost_func = 'corratio'
+            flirt_e2t.inputs.dof = 6
+            flirt_e2t.inputs.interp = 'sinc'
+            flirt_e2t.inputs.n_procs = n_procs
+            flirt_e2t.n_procs = n_procs
+        else:
+            flirt_e2t = pe.Node(fsl.FLIRT(cost_func='bbr', output_type='NIFTI_GZ',
+                                        dof=12, interp='sinc'),
+                              name ='flirt_e2t')
 
         epi_to_T1_workflow.connect(input_node, 'EPI_space_file', flirt_e2t, 'in_file')
 
@@ -78,7 +114,7 @@ def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
 
             epi_to_T1_workflow.connect(input_node, 'T1_file', fast, 'in_files')
             epi_to_T1_workflow.connect(fast, ('tissue_class_files', pick_last), flirt_e2t, 'wm_seg')
-        elif not do_FAST and flirt_e2t.inputs.cost_func == 'bbr':
+        elif backend != 'native' and flirt_e2t.inputs.cost_func == 'bbr':
             print('You indicated not wanting to do FAST, but still wanting to do a'
                   ' BBR epi-to-T1 registration. That is probably not going to work ...')
 
@@ -86,7 +122,7 @@ def create_epi_to_T1_workflow(name='epi_to_T1', use_FS=True,
         epi_to_T1_workflow.connect(flirt_e2t, 'out_matrix_file', output_node, 'EPI_T1_matrix_file')
 
         # the final invert node
-        invert_EPI_N = pe.Node(fsl.ConvertXFM(invert_xfm = True), name='invert_EPI_N')
+        invert_EPI_N = pe.Node(interface=Invert_fsl_matrix, name='invert_EPI_N')
         epi_to_T1_workflow.connect(flirt_e2t, 'out_matrix_file', invert_EPI_N, 'in_file')
         epi_to_T1_workflow.connect(invert_EPI_N, 'out_file', output_node, 'T1_EPI_matrix_file')
 
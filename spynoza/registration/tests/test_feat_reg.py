@@ -0,0 +1,37 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes import create_feat_reg_dir, concat_fsl_matrices, invert_fsl_matrix
+
+
+@pytest.mark.registration
+def test_create_feat_reg_dir(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    e2h, h2s = np.eye(4), np.eye(4)
+    e2h[:3] = rs.randn(3, 4)
+    h2s[:3] = rs.randn(3, 4)
+    np.savetxt('epi2t1.mat', e2h)
+    np.savetxt('t12mni.mat', h2s)
+    nib.save(nib.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4)), 'mean.bold.nii.gz')
+
+    res = create_feat_reg_dir(op.abspath('epi2t1.mat'), op.abspath('t12mni.mat'),
+                              example_func=op.abspath('mean.bold.nii.gz'))
+    out_files = res[0]
+    assert op.abspath('example_func.nii.gz') in out_files
+    assert len(out_files) == 7
+
+    mats = dict((op.basename(f)[:-4], np.loadtxt(f)) for f in res[1:])
+    np.testing.assert_allclose(mats['example_func2standard'], h2s.dot(e2h))
+    np.testing.assert_allclose(mats['standard2example_func'].dot(h2s).dot(e2h),
+                               np.eye(4), atol=1e-8)
+    np.testing.assert_allclose(mats['standard2highres'].dot(h2s), np.eye(4),
+                               atol=1e-8)
+
+    # the separate nodes agree with the combined one
+    concat = np.loadtxt(concat_fsl_matrices(op.abspath('epi2t1.mat'),
+                                            op.abspath('t12mni.mat')))
+    np.testing.assert_allclose(concat, mats['example_func2standard'])
+    inv = np.loadtxt(invert_fsl_matrix(op.abspath('epi2t1.mat')))
+    np.testing.assert_allclose(inv, mats['highres2example_func'])
@@ -0,0 +1,65 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import scipy.ndimage as nd
+import os.path as op
+from ..nodes import register_affine, _affine_from_params
+from ..sub_workflows import (create_epi_to_T1_workflow,
+                             create_T1_to_standard_workflow)
+from ...utils import fsl_voxel_to_mm
+
+
+@pytest.mark.parametrize('cost_func', ['normmi', 'corratio'])
+@pytest.mark.registration
+def test_register_affine(tmpdir, cost_func):
+    tmpdir.chdir()
+    shape = (32, 36, 30)
+    x, y, z = np.ogrid[-1:1:32j, -1:1:36j, -1:1:30j]
+    head = (x / .8) ** 2 + (y / .85) ** 2 + (z / .8) ** 2 <= 1
+    wm = (x / .45) ** 2 + (y / .5) ** 2 + (z / .4) ** 2 <= 1
+    texture = nd.gaussian_filter(np.random.RandomState(0).rand(*shape), 2)
+    ref = 500. * head + 400 * wm + 1000 * (texture - texture.mean()) * head
+    ref = nd.gaussian_filter(ref, 1).astype(np.float32)
+    affine = np.diag([-5., 5., 5., 1.])
+    nib.save(nib.Nifti1Image(ref, affine), 'ref.nii.gz')
+
+    ref2fsl = fsl_voxel_to_mm(shape, (5., 5., 5.), affine)
+    centre = ref2fsl[:3, :3].dot((np.array(shape) - 1) / 2.)
+    true = _affine_from_params([.1, -.05, .08, 5., -3., 4.], centre, 6)
+
+    # the moving image has a different contrast: inverted (T2-like) for
+    # normalised mutual information, monotonic for the correlation ratio
+    vox = np.linalg.inv(np.linalg.inv(ref2fsl).dot(true).dot(ref2fsl))
+    grid = np.indices(shape).reshape((3, -1))
+    mov = nd.map_coordinates(ref, vox[:3, :3].dot(grid) + vox[:3, 3:],
+                             order=3).reshape(shape)
+    if cost_func == 'normmi':
+        mov = np.where(mov > 100, 2000 - mov, mov)
+    else:
+        mov = np.sqrt(np.clip(mov, 0, None)) * 20
+    mov = mov.astype(np.float32)
+    nib.save(nib.Nifti1Image(mov, affine), 'mov.nii.gz')
+
+    out_file, mat_file = register_affine(op.abspath('mov.nii.gz'),
+                                         op.abspath('ref.nii.gz'), dof=6,
+                                         cost_func=cost_func,
+                                         levels=(10., 5.), n_procs=1)
+    assert nib.load(out_file).shape == shape
+
+    # FLIRT matrices map the input to the reference
+    est = np.linalg.inv(np.loadtxt(mat_file))
+    pts = ref2fsl[:3, :3].dot(np.argwhere(head).T) + ref2fsl[:3, 3:]
+    err = (est - true)[:3, :3].dot(pts) + (est - true)[:3, 3:]
+    assert np.sqrt((err ** 2).sum(axis=0).mean()) < 1.
+
+
+@pytest.mark.registration
+def test_register_affine_n_procs():
+    # the scheduler reserves the processes the registration uses
+    wf = create_epi_to_T1_workflow(use_FS=False, do_FAST=False,
+                                   backend='native', n_procs=3)
+    node = wf.get_node('flirt_e2t')
+    assert node.n_procs == node.inputs.n_procs == 3
+    wf = create_T1_to_standard_workflow(use_FS=False, backend='native')
+    node = wf.get_node('flirt_t2s')
+    assert node.n_procs == node.inputs.n_procs == 1
@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import scipy.ndimage as nd
+import os.path as op
+from ..nodes import register_bbr
+from ...utils import fsl_voxel_to_mm, params_to_fsl_matrix
+
+
+@pytest.mark.registration
+def test_register_bbr(tmpdir):
+    tmpdir.chdir()
+    # anatomy at 2 mm, with a wavy white matter surface
+    shape = (60, 64, 56)
+    affine = np.diag([-2., 2., 2., 1.])
+    x, y, z = np.indices(shape) - (np.array(shape)[:, None, None, None] - 1) / 2.
+    r = np.sqrt((x / 1.) ** 2 + (y / 1.1) ** 2 + (z / .95) ** 2)
+    theta, phi = np.arctan2(y, x), np.arccos(z / np.maximum(r, 1e-6))
+    wm_radius = 16 + 2 * np.sin(5 * theta) * np.sin(4 * phi)
+    wm = r <= wm_radius
+    gm = (r <= wm_radius + 4) & ~wm
+    nib.save(nib.Nifti1Image(wm.astype(np.uint8), affine), 'wm.nii.gz')
+    nib.save(nib.Nifti1Image((wm * 1.).astype(np.float32), affine), 'T1.nii.gz')
+
+    # EPI at 3 mm with T2*-like contrast (grey matter brighter)
+    epi_shape = (42, 44, 38)
+    epi_affine = np.diag([-3., 3., 3., 1.])
+    anat = nd.gaussian_filter(900. * wm + 1000. * gm + 300. * (r > wm_radius + 4),
+                              1.)
+    ref2fsl = fsl_voxel_to_mm(shape, (2., 2., 2.), affine)
+    epi2fsl = fsl_voxel_to_mm(epi_shape, (3., 3., 3.), epi_affine)
+    centre = ref2fsl[:3, :3].dot((np.array(shape) - 1) / 2.)
+    true = params_to_fsl_matrix([.04, -.03, .05, 2.5, -1.5, 1.], centre)
+    # EPI voxels -> anatomical voxels: EPI -> anat is the FLIRT matrix `true`
+    vox = np.linalg.inv(ref2fsl).dot(true).dot(epi2fsl)
+    grid = np.indices(epi_shape).reshape((3, -1))
+    epi = nd.map_coordinates(anat, vox[:3, :3].dot(grid) + vox[:3, 3:],
+                             order=1).reshape(epi_shape)
+    nib.save(nib.Nifti1Image(epi.astype(np.float32), epi_affine), 'epi.nii.gz')
+
+    # start ~2 mm away from the truth
+    init = true.dot(params_to_fsl_matrix([.02, -.01, .02, 1.5, -1., .5],
+                                         centre))
+    np.savetxt('init.mat', init)
+
+    out_file, mat_file, cost = register_bbr(
+        op.abspath('epi.nii.gz'), op.abspath('T1.nii.gz'),
+        wm_seg=op.abspath('wm.nii.gz'), init_matrix=op.abspath('init.mat'))
+    assert nib.load(out_file).shape == shape
+
+    est = np.loadtxt(mat_file)
+    pts = ref2fsl[:3, :3].dot(np.argwhere(wm | gm).T) + ref2fsl[:3, 3:]
+    inv_true, inv_est = np.linalg.inv(true), np.linalg.inv(est)
+    err = (inv_est - inv_true)[:3, :3].dot(pts) + (inv_est - inv_true)[:3, 3:]
+    assert np.sqrt((err ** 2).sum(axis=0).mean()) < .5
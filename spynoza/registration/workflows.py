@@ -1,11 +1,10 @@
 from __future__ import absolute_import
 import nipype.pipeline as pe
 from nipype.interfaces.utility import IdentityInterface
-from nipype.interfaces.utility import Rename
 from nipype.interfaces.io import DataSink
 
-from .sub_workflows import (create_concat_2_feat_workflow,
-                            create_epi_to_T1_workflow,
+from .nodes import Create_feat_reg_dir
+from .sub_workflows import (create_epi_to_T1_workflow,
                             create_T1_to_standard_workflow)
 
 
@@ -18,7 +17,10 @@ def create_registration_workflow(analysis_info, name='reg'):
         name of workflow
     analysis_info : dict
         contains session information needed for workflow, such as
-        whether to use FreeSurfer or FLIRT etc.
+        whether to use FreeSurfer or FLIRT etc. 'registration_backend'
+        ('fsl' or 'native') selects FLIRT/BBRegister or the native affine and
+        boundary-based registrations; 'registration_n_procs' (default: 1) is
+        the number of processes of a native affine registration.
     Example
     -------
     >>> registration_workflow = create_registration_workflow(name = 'registration_workflow', analysis_info = {'use_FS':True})
@@ -39,6 +41,8 @@ def create_registration_workflow(analysis_info, name='reg'):
            outputspec.out_reg_file : BBRegister registration file that maps EPI space to T1
            outputspec.out_matrix_file : FLIRT registration file that maps EPI space to T1
            outputspec.out_inv_matrix_file : FLIRT registration file that maps T1 space to EPI
+           outputspec.EPI_standard_matrix_file : matrix that maps EPI space to standard
+           outputspec.standard_EPI_matrix_file : matrix that maps standard to EPI space
     """
 
     ### NODES
@@ -54,17 +58,20 @@ def create_registration_workflow(analysis_info, name='reg'):
     registration_workflow = pe.Workflow(name=name)
 
     ### sub-workflows
+    backend = analysis_info.get('registration_backend', 'fsl')
+    n_procs = analysis_info.get('registration_n_procs', 1)
     epi_2_T1 = create_epi_to_T1_workflow(name='epi',
                                          use_FS=analysis_info['use_FS'],
-                                         do_FAST=analysis_info['do_FAST'])
+                                         do_FAST=analysis_info['do_FAST'],
+                                         backend=backend, n_procs=n_procs)
     T1_to_standard = create_T1_to_standard_workflow(name='T1_to_standard',
                                                     use_FS=analysis_info[
                                                         'use_FS'],
                                                     do_fnirt=analysis_info[
                                                         'do_fnirt'],
-                                                    use_AFNI_ss=analysis_info['use_AFNI_ss'])
-    concat_2_feat = create_concat_2_feat_workflow(name='concat_2_feat')
-
+                                                    use_AFNI_ss=analysis_info['use_AFNI_ss'],
+                                                    backend=backend,
+                                                    n_procs=n_procs)
     output_node = pe.Node(IdentityInterface(fields=('EPI_T1_matrix_file',
                                                     'T1_EPI_matrix_file',
                                                     'EPI_T1_register_file',
@@ -72,6 +79,8 @@ def create_registration_workflow(analysis_info, name='reg'):
                                                     'standard_T1_matrix_file',
                                                     'EPI_T1_matrix_file',
                                                     'T1_EPI_matrix_file',
+                                                    'EPI_standard_matrix_file',
+                                                    'standard_EPI_matrix_file',
                                                     'T1_file',
                                                     'standard_file',
                                                     'EPI_space_file'
@@ -101,94 +110,26 @@ def create_registration_workflow(analysis_info, name='reg'):
     ])])
 
     ###########################################################################
-    # concatenation of all matrices
+    # all forward/inverse combinations of the matrices, with FEAT names
     ###########################################################################
 
-    # then, the inputs from the previous sub-workflows
-    registration_workflow.connect([(epi_2_T1, concat_2_feat, [
-        ('outputspec.EPI_T1_matrix_file', 'inputspec.EPI_T1_matrix_file'),
-    ])])
-
-    registration_workflow.connect([(T1_to_standard, concat_2_feat, [
-        ('outputspec.T1_standard_matrix_file',
-         'inputspec.T1_standard_matrix_file'),
-    ])])
-
-    ###########################################################################
-    # Rename nodes, for the datasink
-    ###########################################################################
-
-    if analysis_info['use_FS']:
-        rename_register = pe.Node(
-            Rename(format_string='register.dat', keep_ext=False),
-            name='rename_register')
-
-        registration_workflow.connect(epi_2_T1,
-                                      'outputspec.EPI_T1_register_file',
-                                      rename_register, 'in_file')
-
-    rename_example_func = pe.Node(
-        Rename(format_string='example_func', keep_ext=True),
-        name='rename_example_func')
-
-    registration_workflow.connect(input_node, 'EPI_space_file',
-                                  rename_example_func, 'in_file')
-
-    rename_highres = pe.Node(Rename(format_string='highres', keep_ext=True),
-                             name='rename_highres')
-    registration_workflow.connect(T1_to_standard, 'outputspec.T1_file',
-                                  rename_highres, 'in_file')
-
-    rename_standard = pe.Node(
-        Rename(format_string='standard', keep_ext=True),
-        name='rename_standard')
-
-    registration_workflow.connect(input_node, 'standard_file', rename_standard,
-                                  'in_file')
-
-    rename_example_func2standard = pe.Node(
-        Rename(format_string='example_func2standard.mat', keep_ext=False),
-        name='rename_example_func2standard')
-
-    registration_workflow.connect(concat_2_feat,
-                                  'outputspec.EPI_standard_matrix_file',
-                                  rename_example_func2standard, 'in_file')
-
-    rename_example_func2highres = pe.Node(
-        Rename(format_string='example_func2highres.mat', keep_ext=False),
-        name='rename_example_func2highres')
+    feat_reg = pe.Node(interface=Create_feat_reg_dir, name='feat_reg')
 
     registration_workflow.connect(epi_2_T1, 'outputspec.EPI_T1_matrix_file',
-                                  rename_example_func2highres, 'in_file')
-
-    rename_highres2standard = pe.Node(
-        Rename(format_string='highres2standard.mat', keep_ext=False),
-        name='rename_highres2standard')
+                                  feat_reg, 'EPI_T1_matrix_file')
     registration_workflow.connect(T1_to_standard,
                                   'outputspec.T1_standard_matrix_file',
-                                  rename_highres2standard, 'in_file')
-
-    rename_standard2example_func = pe.Node(
-        Rename(format_string='standard2example_func.mat', keep_ext=False),
-        name='rename_standard2example_func')
-
-    registration_workflow.connect(concat_2_feat,
-                                  'outputspec.standard_EPI_matrix_file',
-                                  rename_standard2example_func, 'in_file')
-
-    rename_highres2example_func = pe.Node(
-        Rename(format_string='highres2example_func.mat', keep_ext=False),
-        name='rename_highres2example_func')
-
-    registration_workflow.connect(epi_2_T1, 'outputspec.T1_EPI_matrix_file',
-                                  rename_highres2example_func, 'in_file')
-
-    rename_standard2highres = pe.Node(
-        Rename(format_string='standard2highres.mat', keep_ext=False),
-        name='rename_standard2highres')
-    registration_workflow.connect(T1_to_standard,
-                                  'outputspec.standard_T1_matrix_file',
-                                  rename_standard2highres, 'in_file')
+                                  feat_reg, 'T1_standard_matrix_file')
+    registration_workflow.connect(input_node, 'EPI_space_file', feat_reg,
+                                  'example_func')
+    registration_workflow.connect(T1_to_standard, 'outputspec.T1_file',
+                                  feat_reg, 'highres')
+    registration_workflow.connect(input_node, 'standard_file', feat_reg,
+                                  'standard')
+    if analysis_info['use_FS'] and backend != 'native':
+        registration_workflow.connect(epi_2_T1,
+                                      'outputspec.EPI_T1_register_file',
+                                      feat_reg, 'register_file')
 
     # outputs via datasink
     datasink = pe.Node(DataSink(infields=['reg']), name='sinker')
@@ -196,36 +137,21 @@ def create_registration_workflow(analysis_info, name='reg'):
     registration_workflow.connect(input_node, 'output_directory', datasink,
                                   'base_directory')
     registration_workflow.connect(input_node, 'sub_id', datasink, 'container')
+    registration_workflow.connect(feat_reg, 'out_files', datasink, 'reg.@feat')
 
-    # NEW SETUP WITH RENAME (WITHOUT MERGER)
-    if analysis_info['use_FS']:
-        registration_workflow.connect(rename_register, 'out_file', datasink,
-                                      'reg.@dat')
-
-    registration_workflow.connect(rename_example_func, 'out_file', datasink,
-                                  'reg.@example_func')
-    registration_workflow.connect(rename_standard, 'out_file', datasink,
-                                  'reg.@standard')
-    registration_workflow.connect(rename_highres, 'out_file', datasink,
-                                  'reg.@highres')
-    registration_workflow.connect(rename_example_func2highres, 'out_file',
-                                  datasink, 'reg.@example_func2highres')
-    registration_workflow.connect(rename_highres2example_func, 'out_file',
-                                  datasink, 'reg.@highres2example_func')
-    registration_workflow.connect(rename_highres2standard, 'out_file', datasink,
-                                  'reg.@highres2standard')
-    registration_workflow.connect(rename_standard2highres, 'out_file', datasink,
-                                  'reg.@standard2highres')
-    registration_workflow.connect(rename_standard2example_func, 'out_file',
-                                  datasink, 'reg.@standard2example_func')
-    registration_workflow.connect(rename_example_func2standard, 'out_file',
-                                  datasink, 'reg.@example_func2standard')
-
-    registration_workflow.connect(rename_highres, 'out_file', output_node,
-                                  'T1_file')
-
-    # put the nifti and mat files, renamed above, in the reg/feat directory.
-    # don't yet know what's wrong with this merge to datasink
-    # registration_workflow.connect(merge_for_reg_N, 'out', datasink, 'reg')
+    for field in ('EPI_T1_matrix_file', 'T1_EPI_matrix_file',
+                  'T1_standard_matrix_file', 'standard_T1_matrix_file',
+                  'EPI_standard_matrix_file', 'standard_EPI_matrix_file'):
+        registration_workflow.connect(feat_reg, field, output_node, field)
+    if analysis_info['use_FS'] and backend != 'native':
+        registration_workflow.connect(epi_2_T1,
+                                      'outputspec.EPI_T1_register_file',
+                                      output_node, 'EPI_T1_register_file')
+    registration_workflow.connect(T1_to_standard, 'outputspec.T1_file',
+                                  output_node, 'T1_file')
+    registration_workflow.connect(input_node, 'standard_file', output_node,
+                                  'standard_file')
+    registration_workflow.connect(input_node, 'EPI_space_file', output_node,
+                                  'EPI_space_file')
 
     return registration_workflow
@@ -0,0 +1,746 @@
+from nipype.interfaces.utility import Function
+
+
+def fsl_to_voxel_matrices(mats, in_img, ref_img):
+    """ Converts FSL matrices (input -> reference, scaled-mm) to matrices
+    mapping reference voxels to input voxels, i.e., the direction in which
+    the output grid is sampled.
+
+    Parameters
+    ----------
+    mats : np.ndarray
+        Array of shape (4, 4) or (T, 4, 4) with FSL matrices.
+    in_img : nibabel image
+        Image that is resampled.
+    ref_img : nibabel image
+        Image defining the output grid.
+
+    Returns
+    -------
+    vox_mats : np.ndarray
+        Array of shape (T, 4, 4).
+    """
+    import numpy as np
+    from spynoza.utils import fsl_voxel_to_mm
+
+    in2fsl = fsl_voxel_to_mm(in_img.shape[:3], in_img.header.get_zooms(),
+                             in_img.affine)
+    ref2fsl = fsl_voxel_to_mm(ref_img.shape[:3], ref_img.header.get_zooms(),
+                              ref_img.affine)
+    mats = np.asarray(mats, dtype=np.float64).reshape((-1, 4, 4))
+    return np.matmul(np.linalg.inv(in2fsl),
+                     np.matmul(np.linalg.inv(mats), ref2fsl))
+
+
+def resample_chunk(data, vox_mats, out_shape, order=1, cval=0.,
+                   n_threads=1, coords=None):
+    """ Resamples a chunk of volumes, each with its own affine.
+
+    Coordinates are computed per volume from a shared output grid (or from
+    shared, possibly non-linearly displaced, base coordinates) and the
+    volumes are interpolated with map_coordinates by a pool of threads.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Array of shape (x, y, z, K) with the input volumes.
+    vox_mats : np.ndarray
+        Array of shape (K, 4, 4) mapping output voxels to input voxels.
+    out_shape : tuple
+        Spatial shape of the output grid.
+    order : int (default: 1)
+        Spline order of the interpolation (0: nearest, 1: trilinear).
+    cval : float (default: 0.)
+        Value for samples outside the input volume.
+    n_threads : int (default: 1)
+        Number of threads.
+    coords : np.ndarray
+        Array of shape (3, N) with the base coordinates that vox_mats act on,
+        one per output voxel (C-order); defaults to the output voxel grid.
+
+    Returns
+    -------
+    out_data : np.ndarray
+        Array of shape out_shape + (K,) (float32).
+    """
+    import numpy as np
+    import scipy.ndimage as nd
+    from concurrent.futures import ThreadPoolExecutor
+
+    out_shape = tuple(out_shape[:3])
+    if coords is None:
+        grid = np.indices(out_shape, dtype=np.float32).reshape((3, -1))
+    else:
+        grid = np.asarray(coords, dtype=np.float32)
+    n_vols = data.shape[-1]
+    out_data = np.empty(out_shape + (n_vols,), dtype=np.float32)
+
+    def _resample(i):
+        A = vox_mats[i].astype(np.float32)
+        coords = A[:3, :3].dot(grid)
+        coords += A[:3, 3:]
+        out_data[..., i] = nd.map_coordinates(
+            np.asarray(data[..., i], dtype=np.float32), coords, order=order,
+            mode='constant', cval=cval).reshape(out_shape)
+
+    n_threads = min(n_threads or 1, n_vols)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(_resample, range(n_vols)))
+    else:
+        for i in range(n_vols):
+            _resample(i)
+
+    return out_data
+
+
+def write_nifti_stream(out_file, chunks, shape, affine, header=None,
+                       dtype='float32', space_header=None):
+    """ Writes a 4D nifti-file from an iterable of time-chunks, so that the
+    full 4D array never has to be in memory.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output nifti-file (.nii or .nii.gz).
+    chunks : iterable
+        Arrays of shape (x, y, z, K), in temporal order.
+    shape : tuple
+        Shape (x, y, z, T) of the full output.
+    affine : np.ndarray
+        Voxel-to-world affine of the output.
+    header : nibabel header
+        Header to take the TR, units, description and intent from
+        (optional), and, for integer dtypes, the scaling; voxel sizes are
+        taken from the affine.
+    dtype : str (default: 'float32')
+        Data type on disk.
+    space_header : nibabel header
+        Header of the image whose grid the affine belongs to (e.g., the
+        reference of a resampling), to take the qform/sform codes from;
+        defaults to header. If neither gives a code, the affine would be
+        ignored on reading, so both codes are set to 1 (scanner).
+
+    Returns
+    -------
+    out_file : str
+        Path to the output nifti-file.
+    """
+    import numpy as np
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+
+    if space_header is None:
+        space_header = header
+    qform_code, sform_code = 0, 0
+    if isinstance(space_header, nib.Nifti1Header):
+        qform_code = int(space_header['qform_code'])
+        sform_code = int(space_header['sform_code'])
+    if not qform_code and not sform_code:
+        qform_code, sform_code = 1, 1
+
+    hdr = nib.Nifti1Header()
+    hdr.set_data_dtype(dtype)
+    hdr.set_data_shape(shape)
+    hdr.set_qform(affine, code=qform_code)
+    hdr.set_sform(affine, code=sform_code)
+    zooms = list(np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0)))
+    if len(shape) > 3:
+        tr = 1.
+        if header is not None and len(header.get_zooms()) > 3:
+            tr = header.get_zooms()[3]
+        zooms += [tr] + [1.] * (len(shape) - 4)
+    hdr.set_zooms(zooms)
+    if header is not None:
+        hdr.set_xyzt_units(*header.get_xyzt_units())
+    slope, inter = None, None
+    if isinstance(header, nib.Nifti1Header):
+        hdr['descrip'] = header['descrip']
+        hdr['intent_code'] = header['intent_code']
+        hdr['intent_name'] = header['intent_name']
+        for i in range(1, 4):
+            hdr['intent_p%i' % i] = header['intent_p%i' % i]
+        # chunks hold scaled values; float data is stored as is
+        slope, inter = header.get_slope_inter()
+        if np.issubdtype(hdr.get_data_dtype(), np.integer) and \
+                slope is not None and slope != 0:
+            hdr.set_slope_inter(slope, inter or 0.)
+        else:
+            slope, inter = None, None
+
+    n_written = 0
+    with ImageOpener(out_file, 'wb') as f:
+        hdr.write_to(f)  # also sets vox_offset and the extension flag
+        for chunk in chunks:
+            if slope is not None:
+                chunk = np.round((np.asarray(chunk) - (inter or 0.)) / slope)
+            chunk = np.asarray(chunk, dtype=hdr.get_data_dtype())
+            if chunk.ndim == 3:
+                chunk = chunk[..., np.newaxis]
+            # nifti data is stored in Fortran order, i.e., volume by volume
+            f.write(chunk.tobytes(order='F'))
+            n_written += chunk.shape[-1]
+
+    if n_written != (shape[3] if len(shape) > 3 else 1):
+        raise ValueError('Wrote %i volumes to %s, but header specifies %s' %
+                         (n_written, out_file, shape))
+
+    return out_file
+
+
+def apply_affines(in_file, mat_file, ref_file=None, order=1, chunk_size=16,
+                  n_threads=1, suffix='_resampled'):
+    """ Resamples every volume of a 4D file with its own affine, e.g., the
+    MCFLIRT or native realignment matrices, in a single streaming pass.
+
+    Volumes are read in time-chunks, resampled by a thread pool and written
+    to disk chunk by chunk.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 4D nifti-file.
+    mat_file : str, list or np.ndarray
+        FSL matrices (input -> reference): a single matrix file (applied to
+        all volumes), a list of matrix files, a .mat directory or an array of
+        shape (T, 4, 4).
+    ref_file : str
+        Absolute path to nifti-file defining the output grid; defaults to
+        in_file.
+    order : int (default: 1)
+        Spline order of the interpolation (0: nearest, 1: trilinear).
+    chunk_size : int (default: 16)
+        Number of volumes read and resampled at once.
+    n_threads : int (default: 1)
+        Number of threads; set node.n_procs to match.
+    suffix : str (default: '_resampled')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to resampled nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import load_fsl_matrices, open_nifti_indexed
+    from spynoza.resampling.nodes import (fsl_to_voxel_matrices,
+                                          resample_chunk, write_nifti_stream)
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+        ref_img = img if ref_file is None else nib.load(ref_file)
+        out_shape = ref_img.shape[:3]
+
+        if isinstance(mat_file, np.ndarray):
+            mats = mat_file.reshape((-1, 4, 4))
+        else:
+            mats = load_fsl_matrices(mat_file)
+        if mats.shape[0] == 1:
+            mats = np.repeat(mats, n_vols, axis=0)
+        elif mats.shape[0] != n_vols:
+            raise ValueError('Got %i matrices for %i volumes in %s' %
+                             (mats.shape[0], n_vols, in_file))
+        vox_mats = fsl_to_voxel_matrices(mats, img, ref_img)
+
+        def _chunks():
+            for start in range(0, n_vols, chunk_size):
+                stop = min(start + chunk_size, n_vols)
+                if len(img.shape) > 3:
+                    data = img.dataobj[..., start:stop]
+                else:
+                    data = np.asanyarray(img.dataobj)[..., np.newaxis]
+                yield resample_chunk(data, vox_mats[start:stop], out_shape,
+                                     order=order, n_threads=n_threads)
+
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(), out_shape + (n_vols,),
+                           ref_img.affine, header=img.header,
+                           space_header=ref_img.header)
+
+        return out_file
+
+
+Apply_affines = Function(function=apply_affines,
+                         input_names=['in_file', 'mat_file', 'ref_file',
+                                      'order', 'chunk_size', 'n_threads',
+                                      'suffix'],
+                         output_names=['out_file'])
+
+
+def fieldmap_to_shift(fmap, echo_spacing, pe_direction='y'):
+    """ Converts a fieldmap (rad/s) to a voxel shift map along the phase
+    encoding axis: shift = fmap * echo_spacing * N_pe / (2 * pi).
+
+    Parameters
+    ----------
+    fmap : np.ndarray
+        3D fieldmap in rad/s, on the EPI grid.
+    echo_spacing : float
+        Effective echo spacing (dwell time) in seconds.
+    pe_direction : str (default: 'y')
+        Phase encoding (unwarp) direction: 'x', 'y', 'z', 'x-', 'y-' or 'z-'.
+
+    Returns
+    -------
+    axis : int
+        Voxel axis of the phase encoding direction.
+    shift : np.ndarray
+        3D voxel shift map (signed for the direction), in voxels.
+    """
+    import numpy as np
+
+    axis = 'xyz'.index(pe_direction[0])
+    sign = -1. if pe_direction.endswith('-') else 1.
+    shift = sign * np.asarray(fmap, dtype=np.float64) * echo_spacing * \
+        fmap.shape[axis] / (2 * np.pi)
+
+    return axis, shift
+
+
+def apply_composite_transform(in_file, motion_mat_file=None, fmap_file=None,
+                              echo_spacing=None, pe_direction='y',
+                              reg_mat_file=None, ref_file=None, order=1,
+                              chunk_size=16, n_threads=1,
+                              suffix='_resampled'):
+    """ Resamples every volume of a raw EPI run once, composing registration,
+    distortion correction and head motion into a single interpolation.
+
+    For every output voxel, the chain output -> EPI reference (inverse
+    registration) -> distorted EPI reference (voxel shift along the phase
+    encoding axis) is computed once; the per-volume motion affines are then
+    applied to these coordinates and each volume is sampled from the raw
+    data, in time-chunks by a thread pool, and streamed to disk.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to raw 4D EPI nifti-file.
+    motion_mat_file : str or list
+        Per-volume FSL matrices mapping each volume to the EPI reference
+        (e.g., MCFLIRT's .mat directory); if None, no motion correction.
+    fmap_file : str
+        Absolute path to fieldmap (rad/s) on the EPI grid, e.g., the
+        registered fieldmap of the B0 workflow; if None, no unwarping.
+    echo_spacing : float
+        Effective echo spacing in seconds (needed with fmap_file).
+    pe_direction : str (default: 'y')
+        Phase encoding (unwarp) direction, as for FUGUE.
+    reg_mat_file : str or list
+        FSL matrix (or list of matrices, applied in order, e.g.,
+        [example_func2highres.mat, highres2standard.mat]) mapping the EPI
+        reference to ref_file; if None, the output is in EPI space.
+    ref_file : str
+        Absolute path to nifti-file defining the output grid; defaults to
+        in_file.
+    order : int (default: 1)
+        Spline order of the interpolation (0: nearest, 1: trilinear).
+    chunk_size : int (default: 16)
+        Number of volumes read and resampled at once.
+    n_threads : int (default: 1)
+        Number of threads; set node.n_procs to match.
+    suffix : str (default: '_resampled')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to resampled nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from spynoza.utils import (load_fsl_matrices, fsl_voxel_to_mm,
+                               open_nifti_indexed)
+    from spynoza.resampling.nodes import (fieldmap_to_shift, resample_chunk,
+                                          write_nifti_stream)
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+        ref_img = img if ref_file is None else nib.load(ref_file)
+        out_shape = ref_img.shape[:3]
+
+        epi2fsl = fsl_voxel_to_mm(img.shape[:3], img.header.get_zooms(),
+                                  img.affine)
+        fsl2epi = np.linalg.inv(epi2fsl)
+        ref2fsl = fsl_voxel_to_mm(out_shape, ref_img.header.get_zooms(),
+                                  ref_img.affine)
+
+        # output voxels -> EPI reference voxels
+        reg = np.eye(4)
+        if reg_mat_file is not None:
+            for mat in load_fsl_matrices(reg_mat_file):
+                reg = mat.dot(reg)
+        out2epi = fsl2epi.dot(np.linalg.inv(reg)).dot(ref2fsl)
+        grid = np.indices(out_shape, dtype=np.float64).reshape((3, -1))
+        coords = out2epi[:3, :3].dot(grid) + out2epi[:3, 3:]
+
+        # EPI reference voxels -> distorted EPI reference voxels
+        if fmap_file is not None:
+            if echo_spacing is None:
+                raise ValueError('echo_spacing is needed to unwarp with %s' %
+                                 fmap_file)
+            fmap = np.asanyarray(nib.load(fmap_file).dataobj, dtype=np.float64)
+            if fmap.shape[:3] != img.shape[:3]:
+                raise ValueError('Fieldmap %s is not on the grid of %s' %
+                                 (fmap_file, in_file))
+            axis, shift = fieldmap_to_shift(fmap.reshape(fmap.shape[:3]),
+                                            echo_spacing, pe_direction)
+            coords[axis] += nd.map_coordinates(shift, coords, order=1,
+                                               mode='nearest')
+
+        # distorted EPI reference voxels -> raw voxels of every volume
+        if motion_mat_file is None:
+            mats = np.tile(np.eye(4), (n_vols, 1, 1))
+        else:
+            mats = load_fsl_matrices(motion_mat_file)
+            if mats.shape[0] != n_vols:
+                raise ValueError('Got %i motion matrices for %i volumes in '
+                                 '%s' % (mats.shape[0], n_vols, in_file))
+        vox_mats = np.matmul(fsl2epi, np.matmul(np.linalg.inv(mats), epi2fsl))
+
+        def _chunks():
+            for start in range(0, n_vols, chunk_size):
+                stop = min(start + chunk_size, n_vols)
+                if len(img.shape) > 3:
+                    data = img.dataobj[..., start:stop]
+                else:
+                    data = np.asanyarray(img.dataobj)[..., np.newaxis]
+                yield resample_chunk(data, vox_mats[start:stop], out_shape,
+                                     order=order, n_threads=n_threads,
+                                     coords=coords)
+
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(), out_shape + (n_vols,),
+                           ref_img.affine, header=img.header,
+                           space_header=ref_img.header)
+
+        return out_file
+
+
+Apply_composite_transform = Function(function=apply_composite_transform,
+                                     input_names=['in_file',
+                                                  'motion_mat_file',
+                                                  'fmap_file', 'echo_spacing',
+                                                  'pe_direction',
+                                                  'reg_mat_file', 'ref_file',
+                                                  'order', 'chunk_size',
+                                                  'n_threads', 'suffix'],
+                                     output_names=['out_file'])
+
+
+def apply_voxel_shift(in_file, fmap_file, echo_spacing, pe_direction='y',
+                      jacobian=False, chunk_size=16, n_threads=1,
+                      suffix='_unwarped'):
+    """ Unwarps a (4D) EPI run with a fieldmap, as FUGUE does: a voxel shift
+    map is computed once from the fieldmap and every volume is resampled
+    along the phase encoding axis only, by linear interpolation.
+
+    The interpolation indices and weights are shared by all volumes, so
+    the resampling of a time-chunk is a single vectorised gather; volumes
+    are spread over a pool of threads and written chunk by chunk.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to (4D) EPI nifti-file.
+    fmap_file : str
+        Absolute path to fieldmap (rad/s) on the grid of in_file.
+    echo_spacing : float
+        Effective echo spacing (dwell time) in seconds, e.g., from
+        compute_echo_spacing_philips or compute_echo_spacing_siemens.
+    pe_direction : str (default: 'y')
+        Phase encoding (unwarp) direction, as for FUGUE.
+    jacobian : bool (default: False)
+        Whether to modulate the intensities with the Jacobian of the shift
+        (1 + d(shift)/d(pe)), correcting signal pile-up and dilution.
+    chunk_size : int (default: 16)
+        Number of volumes read and unwarped at once.
+    n_threads : int (default: 1)
+        Number of threads; set node.n_procs to match.
+    suffix : str (default: '_unwarped')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to unwarped nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from concurrent.futures import ThreadPoolExecutor
+    from spynoza.utils import open_nifti_indexed
+    from spynoza.resampling.nodes import fieldmap_to_shift, write_nifti_stream
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        shape = img.shape[:3]
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+        fmap = np.asanyarray(nib.load(fmap_file).dataobj, dtype=np.float64)
+        if fmap.shape[:3] != shape:
+            raise ValueError('Fieldmap %s is not on the grid of %s' %
+                             (fmap_file, in_file))
+        axis, shift = fieldmap_to_shift(fmap.reshape(shape), echo_spacing,
+                                        pe_direction)
+
+        # every voxel samples its own line at position + shift
+        grid = np.indices(shape)
+        pos = grid[axis] + shift
+        lower = np.floor(pos).astype(np.int64)
+        weight = (pos - lower).ravel().astype(np.float32)
+        n_pe = shape[axis]
+        valid = ((pos >= 0) & (pos <= n_pe - 1)).ravel()
+        indices = []
+        for k in (lower, lower + 1):
+            grid[axis] = np.clip(k, 0, n_pe - 1)
+            indices.append(np.ravel_multi_index(grid, shape).ravel())
+        scale = valid.astype(np.float32)
+        if jacobian:
+            scale *= (1. + np.gradient(shift, axis=axis)).ravel()
+
+        def _unwarp(vol):
+            vol = np.asarray(vol, dtype=np.float32).ravel()
+            out = vol[indices[0]] * (1 - weight)
+            out += vol[indices[1]] * weight
+            out *= scale
+            return out.reshape(shape)
+
+        n_threads = n_threads or 1
+
+        def _chunks():
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                for start in range(0, n_vols, chunk_size):
+                    stop = min(start + chunk_size, n_vols)
+                    if len(img.shape) > 3:
+                        data = img.dataobj[..., start:stop]
+                    else:
+                        data = np.asanyarray(img.dataobj)[..., np.newaxis]
+                    vols = pool.map(_unwarp, [data[..., i]
+                                              for i in range(data.shape[-1])])
+                    yield np.stack(list(vols), axis=-1)
+
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(), img.shape[:3] + (n_vols,),
+                           img.affine, header=img.header)
+
+        return out_file
+
+
+Apply_voxel_shift = Function(function=apply_voxel_shift,
+                             input_names=['in_file', 'fmap_file',
+                                          'echo_spacing', 'pe_direction',
+                                          'jacobian', 'chunk_size',
+                                          'n_threads', 'suffix'],
+                             output_names=['out_file'])
+
+
+def sparse_resampling_matrix(src_shape, dst_shape, vox_mat, order=1):
+    """ Builds the (fixed) interpolation of a 3D grid as a sparse matrix.
+
+    Parameters
+    ----------
+    src_shape : tuple
+        Spatial shape of the input grid.
+    dst_shape : tuple
+        Spatial shape of the output grid.
+    vox_mat : np.ndarray
+        4x4 matrix mapping output voxels to input voxels.
+    order : int (default: 1)
+        0 for nearest neighbour, 1 for trilinear interpolation.
+
+    Returns
+    -------
+    operator : scipy.sparse.csr_matrix
+        Matrix of shape (n_dst, n_src) acting on C-ordered flattened volumes;
+        output voxels that fall outside the input grid get zero rows.
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    src_shape, dst_shape = tuple(src_shape[:3]), tuple(dst_shape[:3])
+    n_src, n_dst = int(np.prod(src_shape)), int(np.prod(dst_shape))
+    grid = np.indices(dst_shape, dtype=np.float64).reshape((3, -1))
+    coords = vox_mat[:3, :3].dot(grid) + vox_mat[:3, 3:]
+    upper = np.array(src_shape, dtype=np.float64)[:, np.newaxis] - 1
+
+    if order == 0:
+        idx = np.rint(coords).astype(np.int64)
+        valid = np.all((idx >= 0) & (idx <= upper), axis=0)
+        rows = np.flatnonzero(valid)
+        cols = np.ravel_multi_index(idx[:, valid], src_shape)
+        weights = np.ones(rows.size)
+    elif order == 1:
+        valid = np.all((coords >= 0) & (coords <= upper), axis=0)
+        coords = coords[:, valid]
+        base = np.clip(np.floor(coords), 0,
+                       np.maximum(upper - 1, 0)).astype(np.int64)
+        frac = coords - base
+        rows, cols, weights = [], [], []
+        for corner in np.ndindex(2, 2, 2):
+            d = np.array(corner)[:, np.newaxis]
+            w = np.prod(np.where(d, frac, 1 - frac), axis=0)
+            idx = np.minimum(base + d, upper.astype(np.int64))
+            rows.append(np.flatnonzero(valid))
+            cols.append(np.ravel_multi_index(idx, src_shape))
+            weights.append(w)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        weights = np.concatenate(weights)
+        keep = weights > 0
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+    else:
+        raise ValueError('Sparse resampling supports order 0 or 1, not %s' %
+                         order)
+
+    return sp.csr_matrix((weights.astype(np.float32), (rows, cols)),
+                         shape=(n_dst, n_src))
+
+
+def get_sparse_resampler(in_img, ref_img, mat, order=1, cache_dir=None):
+    """ Returns the sparse resampling matrix for a fixed FSL transform,
+    building it only if it is not cached yet.
+
+    Operators are cached as .npz files, keyed by a hash of the input and
+    output grids (shapes and affines), the matrix and the order, so that
+    every run (and every volume) of a session reuses the same operator.
+
+    Parameters
+    ----------
+    in_img : nibabel image
+        Image that is resampled.
+    ref_img : nibabel image
+        Image defining the output grid.
+    mat : np.ndarray
+        4x4 FSL matrix (input -> reference).
+    order : int (default: 1)
+        0 for nearest neighbour, 1 for trilinear interpolation.
+    cache_dir : str
+        Directory for cached operators; defaults to $SPYNOZA_CACHE_DIR or
+        ~/.cache/spynoza.
+
+    Returns
+    -------
+    operator : scipy.sparse.csr_matrix
+        Matrix of shape (n_ref_voxels, n_in_voxels).
+    """
+    import os
+    import hashlib
+    import tempfile
+    import numpy as np
+    import scipy.sparse as sp
+    from spynoza.resampling.nodes import (fsl_to_voxel_matrices,
+                                          sparse_resampling_matrix)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('SPYNOZA_CACHE_DIR', os.path.join(
+            os.path.expanduser('~'), '.cache', 'spynoza'))
+    cache_dir = os.path.join(cache_dir, 'resampling')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    key = hashlib.sha1()
+    for img in (in_img, ref_img):
+        key.update(np.array(img.shape[:3], dtype=np.int64).tobytes())
+        key.update(np.asarray(img.affine, dtype=np.float64).round(6).tobytes())
+    key.update(np.asarray(mat, dtype=np.float64).round(6).tobytes())
+    key.update(str(order).encode())
+    cache_file = os.path.join(cache_dir, key.hexdigest() + '.npz')
+
+    if os.path.isfile(cache_file):
+        return sp.load_npz(cache_file).tocsr()
+
+    vox_mat = fsl_to_voxel_matrices(mat, in_img, ref_img)[0]
+    operator = sparse_resampling_matrix(in_img.shape, ref_img.shape, vox_mat,
+                                        order=order)
+    # write to a temporary file first, so that parallel runs never read a
+    # partially written operator
+    fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    os.close(fd)
+    sp.save_npz(tmp_file, operator)
+    os.replace(tmp_file, cache_file)
+
+    return operator
+
+
+def apply_sparse_transform(in_file, mat_file, ref_file, order=1,
+                           cache_dir=None, chunk_size=64,
+                           suffix='_resampled'):
+    """ Resamples a 3D or 4D file with a fixed transform (e.g., EPI to
+    standard, or an atlas to EPI space) as sparse-times-dense products,
+    reusing a cached interpolation operator.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to nifti-file.
+    mat_file : str
+        FSL matrix (input -> reference).
+    ref_file : str
+        Absolute path to nifti-file defining the output grid.
+    order : int (default: 1)
+        0 for nearest neighbour (e.g., atlases), 1 for trilinear.
+    cache_dir : str
+        Directory for cached operators (see get_sparse_resampler).
+    chunk_size : int (default: 64)
+        Number of volumes transformed per product.
+    suffix : str (default: '_resampled')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to resampled nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import load_fsl_matrices, open_nifti_indexed
+    from spynoza.resampling.nodes import (get_sparse_resampler,
+                                          write_nifti_stream)
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        ref_img = nib.load(ref_file)
+        out_shape = ref_img.shape[:3]
+        operator = get_sparse_resampler(img, ref_img,
+                                        load_fsl_matrices(mat_file)[0],
+                                        order=order, cache_dir=cache_dir)
+
+        # nearest neighbour keeps labels (and their data type) intact
+        dtype = img.get_data_dtype() if order == 0 else np.dtype('float32')
+        n_src = int(np.prod(img.shape[:3]))
+
+        def _chunks(n_vols):
+            for start in range(0, n_vols, chunk_size):
+                stop = min(start + chunk_size, n_vols)
+                if len(img.shape) > 3:
+                    data = img.dataobj[..., start:stop]
+                else:
+                    data = np.asanyarray(img.dataobj)[..., np.newaxis]
+                data = np.asarray(data, dtype=np.float32).reshape((n_src, -1))
+                out = operator.dot(data).reshape(out_shape + (-1,))
+                yield np.rint(out) if order == 0 else out
+
+        # 3D files are written the same way, as a single chunk, so that they
+        # keep the header codes, intent and description as well
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(n_vols),
+                           out_shape + img.shape[3:4], ref_img.affine,
+                           header=img.header, dtype=dtype,
+                           space_header=ref_img.header)
+
+        return out_file
+
+
+Apply_sparse_transform = Function(function=apply_sparse_transform,
+                                  input_names=['in_file', 'mat_file',
+                                               'ref_file', 'order',
+                                               'cache_dir', 'chunk_size',
+                                               'suffix'],
+                                  output_names=['out_file'])
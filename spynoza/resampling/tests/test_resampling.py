@@ -0,0 +1,231 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes import (apply_affines, resample_chunk, write_nifti_stream,
+                     apply_sparse_transform, fsl_to_voxel_matrices,
+                     apply_voxel_shift, apply_composite_transform)
+from ..workflows import create_composite_resampling_workflow
+
+
+@pytest.mark.resampling
+def test_write_nifti_stream(tmpdir):
+    tmpdir.chdir()
+    data = np.random.RandomState(0).rand(6, 5, 4, 7).astype(np.float32)
+    affine = np.diag([2., 2., 3., 1.])
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    hdr.set_zooms((2., 2., 3., 1.5))
+
+    out_file = write_nifti_stream(op.abspath('out.nii.gz'),
+                                  (data[..., i:i + 3] for i in range(0, 7, 3)),
+                                  data.shape, affine, header=hdr)
+    img = nib.load(out_file)
+    np.testing.assert_array_equal(img.get_fdata(dtype=np.float32), data)
+    np.testing.assert_array_equal(img.affine, affine)
+    assert img.header.get_zooms() == (2., 2., 3., 1.5)
+    # without codes in the header, the affine is marked as scanner space
+    assert img.header['sform_code'] == 1
+
+    # codes, description and intent come from the input header, the codes
+    # of a resampling from the reference
+    hdr.set_qform(affine, code=0)
+    hdr.set_sform(affine, code=4)
+    hdr['descrip'] = b'bold run'
+    hdr.set_intent('estimate')
+    ref_hdr = nib.Nifti1Header()
+    ref_hdr.set_qform(affine, code=1)
+    ref_hdr.set_sform(affine, code=3)
+    for space_header, codes in ((None, (0, 4)), (ref_hdr, (1, 3))):
+        out_file = write_nifti_stream(op.abspath('coded.nii.gz'), [data],
+                                      data.shape, affine, header=hdr,
+                                      space_header=space_header)
+        out_hdr = nib.load(out_file).header
+        assert (out_hdr['qform_code'], out_hdr['sform_code']) == codes
+        assert out_hdr['descrip'] == b'bold run'
+        assert out_hdr.get_intent()[0] == 'estimate'
+
+    # integer output keeps the scaling of the input
+    hdr.set_data_dtype(np.int16)
+    hdr.set_slope_inter(.01, 0.)
+    out_file = write_nifti_stream(op.abspath('int.nii.gz'), [data],
+                                  data.shape, affine, header=hdr,
+                                  dtype='int16')
+    img = nib.load(out_file)
+    assert img.dataobj.slope == pytest.approx(.01)
+    np.testing.assert_allclose(img.get_fdata(), data, atol=.005 + 1e-6)
+
+    with pytest.raises(ValueError):
+        write_nifti_stream(op.abspath('bad.nii'), [data[..., :3]],
+                           data.shape, affine)
+
+
+@pytest.mark.resampling
+def test_apply_affines(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    data = rs.rand(10, 12, 8, 3).astype(np.float32)
+    affine = np.diag([-2., 2., 2., 1.])  # radiological: no x-flip for FSL
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(data, affine), in_file)
+
+    # identity, a shift of one voxel along y and a shift of two along z
+    mats = np.tile(np.eye(4), (3, 1, 1))
+    mats[1, 1, 3] = -2.
+    mats[2, 2, 3] = -4.
+    os.mkdir('run_mcf.mat')
+    for i, mat in enumerate(mats):
+        np.savetxt(op.join('run_mcf.mat', 'MAT_%04i' % i), mat)
+
+    out_file = apply_affines(in_file, op.abspath('run_mcf.mat'), chunk_size=2,
+                             n_threads=2)
+    out = nib.load(out_file).get_fdata()
+    assert out.shape == data.shape
+    np.testing.assert_allclose(out[..., 0], data[..., 0], atol=1e-6)
+    np.testing.assert_allclose(out[:, :-1, :, 1], data[:, 1:, :, 1], atol=1e-6)
+    np.testing.assert_allclose(out[:, :, :-2, 2], data[:, :, 2:, 2], atol=1e-6)
+    np.testing.assert_array_equal(out[:, :, -2:, 2], 0)
+
+    # a single matrix is applied to all volumes
+    out = apply_affines(in_file, op.join('run_mcf.mat', 'MAT_0001'))
+    out = nib.load(out).get_fdata()
+    np.testing.assert_allclose(out[:, :-1], data[:, 1:], atol=1e-6)
+
+    vox_mats = np.tile(np.eye(4), (3, 1, 1))
+    np.testing.assert_allclose(resample_chunk(data, vox_mats, data.shape,
+                                              n_threads=1), data)
+
+
+@pytest.mark.resampling
+def test_create_composite_resampling_workflow(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    data = rs.rand(10, 12, 8, 2).astype(np.float32)
+    affine = np.diag([-2., 2., 2., 1.])
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(data, affine), in_file)
+
+    # second volume moved by one voxel along z
+    mats = np.tile(np.eye(4), (2, 1, 1))
+    mats[1, 2, 3] = 2.
+    mat_files = [op.abspath('MAT_%04i' % i) for i in range(2)]
+    for f, mat in zip(mat_files, mats):
+        np.savetxt(f, mat)
+
+    # a field shifting by exactly one voxel along y
+    echo_spacing = .0005
+    fmap = np.full((10, 12, 8), 2 * np.pi / (echo_spacing * 12))
+    fmap_file = op.abspath('fmap.nii.gz')
+    nib.save(nib.Nifti1Image(fmap, affine), fmap_file)
+
+    # registration moving the EPI by one voxel along x
+    reg = np.eye(4)
+    reg[0, 3] = 2.
+    np.savetxt(op.abspath('example_func2standard.mat'), reg)
+
+    wf = create_composite_resampling_workflow(n_procs=2)
+    resample = wf.get_node('resample')
+    assert resample.n_procs == resample.inputs.n_threads == 2
+    wf.base_dir = str(tmpdir.join('workingdir'))
+    wf.inputs.inputspec.in_files = [in_file]
+    wf.inputs.inputspec.motion_matrix_files = [mat_files]
+    wf.inputs.inputspec.fmap_files = [fmap_file]
+    wf.inputs.inputspec.echo_spacing = echo_spacing
+    wf.inputs.inputspec.phase_encoding_direction = 'y'
+    wf.inputs.inputspec.reg_matrix_file = op.abspath('example_func2standard.mat')
+    res = wf.run()
+
+    node = [n for n in res.nodes() if n.name == 'resample'][0]
+    out = nib.load(node.result.outputs.out_file[0]).get_fdata()
+    assert out.shape == data.shape
+    np.testing.assert_allclose(out[1:, :-1, :, 0], data[:-1, 1:, :, 0],
+                               atol=1e-6)
+    np.testing.assert_allclose(out[1:, :-1, 1:, 1], data[:-1, 1:, :-1, 1],
+                               atol=1e-6)
+
+
+@pytest.mark.resampling
+def test_apply_sparse_transform(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    data = rs.rand(10, 12, 8, 4).astype(np.float32)
+    in_file = op.abspath('run.nii.gz')
+    in_img = nib.Nifti1Image(data, np.diag([-2., 2., 2., 1.]))
+    nib.save(in_img, in_file)
+    ref_file = op.abspath('ref.nii.gz')
+    ref_img = nib.Nifti1Image(np.zeros((8, 9, 7), dtype=np.float32),
+                              np.diag([-2.5, 2.5, 2.5, 1.]))
+    nib.save(ref_img, ref_file)
+
+    mat = np.eye(4)
+    mat[:3, :3] = [[.99, -.1, 0], [.1, .99, .02], [0, -.02, 1.]]
+    mat[:3, 3] = [1.3, -.7, .4]
+    np.savetxt(op.abspath('epi2ref.mat'), mat)
+
+    cache_dir = str(tmpdir.join('cache'))
+    out_file = apply_sparse_transform(in_file, op.abspath('epi2ref.mat'),
+                                      ref_file, cache_dir=cache_dir,
+                                      chunk_size=3)
+    out = nib.load(out_file).get_fdata()
+    assert out.shape == (8, 9, 7, 4)
+    assert len(os.listdir(op.join(cache_dir, 'resampling'))) == 1
+
+    vox_mats = np.repeat(fsl_to_voxel_matrices(mat, in_img, ref_img), 4,
+                         axis=0)
+    expected = resample_chunk(data, vox_mats, (8, 9, 7), n_threads=1)
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+    # nearest neighbour keeps labels, and reuses the same cache directory;
+    # a 3D output keeps the codes of the reference and the intent of the
+    # source
+    labels = rs.randint(0, 5, (10, 12, 8)).astype(np.int16)
+    atlas = nib.Nifti1Image(labels, in_img.affine)
+    atlas.header.set_intent('label')
+    atlas.header['descrip'] = b'atlas'
+    nib.save(atlas, op.abspath('atlas.nii.gz'))
+    ref_img.set_sform(ref_img.affine, code=4)
+    nib.save(ref_img, ref_file)
+    out = nib.load(apply_sparse_transform(op.abspath('atlas.nii.gz'),
+                                          op.abspath('epi2ref.mat'), ref_file,
+                                          order=0, cache_dir=cache_dir))
+    assert out.shape == (8, 9, 7)
+    assert out.header['sform_code'] == 4
+    assert out.header.get_intent()[0] == 'label'
+    assert out.header['descrip'] == b'atlas'
+    assert out.get_data_dtype() == np.int16
+    assert set(np.unique(np.asanyarray(out.dataobj))) <= set(range(5))
+    assert len(os.listdir(op.join(cache_dir, 'resampling'))) == 2
+
+
+@pytest.mark.resampling
+def test_apply_voxel_shift(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    data = rs.rand(10, 12, 8, 5).astype(np.float32)
+    affine = np.diag([-2., 2., 2., 1.])
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(data, affine), in_file)
+
+    # a smooth field of up to ~1.5 voxels along y
+    echo_spacing = .0005
+    x, y, z = np.indices((10, 12, 8))
+    fmap = 1.5 * np.sin(x / 3.) * np.cos(z / 4.) * 2 * np.pi / (echo_spacing * 12)
+    fmap_file = op.abspath('fmap.nii.gz')
+    nib.save(nib.Nifti1Image(fmap.astype(np.float32), affine), fmap_file)
+
+    out_file = apply_voxel_shift(in_file, fmap_file, echo_spacing,
+                                 chunk_size=2, n_threads=2)
+    out = nib.load(out_file).get_fdata()
+    expected = nib.load(apply_composite_transform(
+        in_file, fmap_file=fmap_file, echo_spacing=echo_spacing)).get_fdata()
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+    # a uniform shift has a unit Jacobian
+    fmap = np.full((10, 12, 8), 2 * np.pi / (echo_spacing * 12), np.float32)
+    nib.save(nib.Nifti1Image(fmap, affine), fmap_file)
+    out = nib.load(apply_voxel_shift(in_file, fmap_file, echo_spacing,
+                                     pe_direction='y-',
+                                     jacobian=True)).get_fdata()
+    np.testing.assert_allclose(out[:, 1:], data[:, :-1], atol=1e-6)
+    np.testing.assert_array_equal(out[:, 0], 0)
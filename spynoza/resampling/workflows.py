@@ -0,0 +1,73 @@
+import nipype.pipeline as pe
+from nipype.interfaces.utility import IdentityInterface
+from .nodes import Apply_composite_transform
+
+
+def create_composite_resampling_workflow(name='resample_once', unwarp=True,
+                                         n_procs=1):
+    """Resamples every run once from the raw EPI data, composing the
+    per-volume motion matrices, the fieldmap-based voxel shifts and the
+    registration matrices, instead of interpolating (and writing a 4D file)
+    after every separate step.
+    Parameters
+    ----------
+    name : string
+        name of workflow
+    unwarp : bool
+        whether to apply distortion correction (requires fmap_files)
+    n_procs : int (default: 1)
+        number of threads used to resample each run (and reserved from the
+        nipype scheduler through node.n_procs)
+    Example
+    -------
+    >>> resample_once = create_composite_resampling_workflow()
+    >>> resample_once.inputs.inputspec.in_files = ['run1.nii.gz', 'run2.nii.gz']
+    >>> resample_once.inputs.inputspec.motion_matrix_files = [['MAT_0000', ...], [...]]
+    >>> resample_once.inputs.inputspec.fmap_files = ['run1_fmap.nii.gz', 'run2_fmap.nii.gz']
+    >>> resample_once.inputs.inputspec.echo_spacing = 0.00027
+    >>> resample_once.inputs.inputspec.phase_encoding_direction = 'y'
+    >>> resample_once.inputs.inputspec.reg_matrix_file = 'example_func2standard.mat'
+    >>> resample_once.inputs.inputspec.ref_file = 'standard.nii.gz'
+
+    Inputs::
+          inputspec.in_files : list of raw functional files
+          inputspec.motion_matrix_files : per-run lists of motion matrices (e.g., outputspec.motion_correction_matrices of the motion correction workflow)
+          inputspec.fmap_files : per-run fieldmaps (rad/s) in EPI space (e.g., outputspec.field_coefs of the B0 workflow)
+          inputspec.echo_spacing : effective echo spacing in seconds
+          inputspec.phase_encoding_direction : unwarp direction (e.g. "y")
+          inputspec.reg_matrix_file : FSL matrix (or list of matrices) from EPI space to ref_file (optional)
+          inputspec.ref_file : file defining the output space (optional, defaults to EPI space)
+    Outputs::
+           outputspec.out_files : resampled files
+    """
+    input_node = pe.Node(IdentityInterface(fields=['in_files',
+                                                   'motion_matrix_files',
+                                                   'fmap_files',
+                                                   'echo_spacing',
+                                                   'phase_encoding_direction',
+                                                   'reg_matrix_file',
+                                                   'ref_file']),
+                         name='inputspec')
+    output_node = pe.Node(IdentityInterface(fields=['out_files']),
+                          name='outputspec')
+
+    iterfield = ['in_file', 'motion_mat_file']
+    if unwarp:
+        iterfield.append('fmap_file')
+    resample = pe.MapNode(interface=Apply_composite_transform,
+                          iterfield=iterfield, name='resample')
+    resample.inputs.n_threads = n_procs
+    resample.n_procs = n_procs
+
+    resampling_workflow = pe.Workflow(name=name)
+    resampling_workflow.connect(input_node, 'in_files', resample, 'in_file')
+    resampling_workflow.connect(input_node, 'motion_matrix_files', resample, 'motion_mat_file')
+    if unwarp:
+        resampling_workflow.connect(input_node, 'fmap_files', resample, 'fmap_file')
+        resampling_workflow.connect(input_node, 'echo_spacing', resample, 'echo_spacing')
+        resampling_workflow.connect(input_node, 'phase_encoding_direction', resample, 'pe_direction')
+    resampling_workflow.connect(input_node, 'reg_matrix_file', resample, 'reg_mat_file')
+    resampling_workflow.connect(input_node, 'ref_file', resample, 'ref_file')
+    resampling_workflow.connect(resample, 'out_file', output_node, 'out_files')
+
+    return resampling_workflow
@@ -0,0 +1,133 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import os.path as op
+from ..utils import (apply_per_volume, pack_regressors, load_regressors,
+                     open_nifti_indexed, extract_volume)
+
+
+def _scale_volume(in_file, factor=2.):
+    import os
+    import nibabel as nib
+    img = nib.load(in_file)
+    out_file = os.path.abspath(
+        os.path.basename(in_file).split('.')[0] + '_scaled.nii')
+    nib.save(nib.Nifti1Image(img.get_fdata() * factor, img.affine), out_file)
+    return out_file
+
+
+@pytest.mark.utils
+def test_apply_per_volume(tmpdir, monkeypatch):
+    from nipype.interfaces.utility import Function
+    tmpdir.chdir()
+    monkeypatch.setenv('SPYNOZA_SCRATCH_DIR', str(tmpdir.mkdir('scratch')))
+    data = np.random.RandomState(0).rand(6, 5, 4, 11).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), 'run.nii.gz')
+
+    scale = Function(function=_scale_volume, input_names=['in_file', 'factor'],
+                     output_names=['out_file'])
+    out_file = apply_per_volume(op.abspath('run.nii.gz'), scale,
+                                interface_inputs={'factor': 3.},
+                                batch_size=2, n_procs=2, ram_disk=False)
+    np.testing.assert_allclose(nib.load(out_file).get_fdata(), 3 * data,
+                               rtol=1e-6)
+    assert tmpdir.join('scratch').listdir() == []
+
+    # interfaces given by their dotted path
+    out_file = apply_per_volume(op.abspath('run.nii.gz'),
+                                'spynoza.utils.Mean_image', batch_size=4,
+                                n_procs=2, suffix='_mean')
+    np.testing.assert_allclose(nib.load(out_file).get_fdata(), data,
+                               rtol=1e-6)
+
+
+@pytest.mark.utils
+def test_pack_regressors_vol_orientation(tmpdir):
+    tmpdir.chdir()
+    pars = np.random.RandomState(0).randn(60, 6)
+    np.savetxt('run_mcf.par', pars)
+
+    # per-TR regressors alone are oriented by the number of volumes
+    packed = pack_regressors(vol_regressors=op.abspath('run_mcf.par'))
+    regressors, names, _ = load_regressors(packed)
+    assert regressors.shape == (1, 6, 60)
+    np.testing.assert_allclose(regressors[0], pars.T, rtol=1e-6)
+    assert names[0] == 'run_mcf_0'
+
+    # also when stored as regressors x time
+    np.savetxt('run_T.txt', pars.T)
+    packed = pack_regressors(vol_regressors=op.abspath('run_T.txt'),
+                             n_vols=60)
+    np.testing.assert_allclose(load_regressors(packed)[0][0], pars.T,
+                               rtol=1e-6)
+    with pytest.raises(ValueError):
+        pack_regressors(vol_regressors=op.abspath('run_mcf.par'), n_vols=50)
+
+    # tsv-files with a header keep their column names
+    pd.DataFrame(pars[:, :2], columns=['X', 'Y']).to_csv(
+        'run_confounds.tsv', sep='\t', index=False)
+    regressors, names, _ = load_regressors(
+        pack_regressors(vol_regressors=op.abspath('run_confounds.tsv')))
+    assert regressors.shape == (1, 2, 60) and names == ['X', 'Y']
+
+
+@pytest.mark.utils
+def test_open_nifti_indexed(tmpdir):
+    tmpdir.chdir()
+    data = np.random.RandomState(0).rand(6, 5, 4, 7).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), 'run.nii.gz')
+
+    with open_nifti_indexed(op.abspath('run.nii.gz'),
+                            cache_dir=str(tmpdir)) as img:
+        np.testing.assert_allclose(img.dataobj[..., 3], data[..., 3])
+    # the file the image read from is closed after the block
+    fobj = img.file_map['image'].fileobj
+    if fobj is not None:
+        assert fobj.closed
+    opener = getattr(img.dataobj, '_opener', None)
+    if opener is not None:
+        assert opener.closed
+
+
+@pytest.mark.utils
+def test_load_nifti_indexed_gzip_index(tmpdir, monkeypatch):
+    igzip = pytest.importorskip('indexed_gzip')
+    tmpdir.chdir()
+    data = np.random.RandomState(0).rand(6, 5, 4, 9).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), 'run.nii.gz')
+    in_file = op.abspath('run.nii.gz')
+    cache_dir = str(tmpdir.mkdir('cache'))
+
+    calls = []
+
+    class _IndexedGzipFile(igzip.IndexedGzipFile):
+        # indexed_gzip binds these methods per instance
+        def __init__(self, *args, **kwargs):
+            super(_IndexedGzipFile, self).__init__(*args, **kwargs)
+            for name in ('build_full_index', 'import_index'):
+                setattr(self, name, self._spy(name, getattr(self, name)))
+
+        @staticmethod
+        def _spy(name, method):
+            def _call(*args, **kwargs):
+                calls.append(name.split('_')[0])
+                return method(*args, **kwargs)
+            return _call
+
+    monkeypatch.setattr(igzip, 'IndexedGzipFile', _IndexedGzipFile)
+
+    # the index is built once and exported to the cache
+    with open_nifti_indexed(in_file, cache_dir=cache_dir) as img:
+        assert isinstance(img.file_map['image'].fileobj, _IndexedGzipFile)
+        np.testing.assert_array_equal(img.dataobj[..., 7], data[..., 7])
+    index_files = os.listdir(op.join(cache_dir, 'gzip_index'))
+    assert len(index_files) == 1 and index_files[0].endswith('.gzidx')
+    assert calls == ['build']
+
+    # later reads import it from the cache
+    roi_file = extract_volume(in_file, index=-1, cache_dir=cache_dir)
+    assert calls == ['build', 'import']
+    np.testing.assert_array_equal(nib.load(roi_file).get_fdata(),
+                                  data[..., -1])
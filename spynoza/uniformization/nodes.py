@@ -1,6 +1,7 @@
 from nipype.interfaces.afni.base import (AFNICommand, AFNICommandInputSpec,
                                          AFNICommandOutputSpec)
 from nipype.interfaces.base import (File, traits)
+from nipype.interfaces.utility import Function
 
 
 class UniformizeInputSpec(AFNICommandInputSpec):
@@ -51,3 +52,146 @@ class Uniformize(AFNICommand):
     _cmd = '3dUniformize'
     input_spec = UniformizeInputSpec
     output_spec = AFNICommandOutputSpec
+
+
+def correct_bias_field(in_file, order=3, n_volumes=None, auto_clip=True,
+                       clip_low=7, clip_high=200, chunk_size=16,
+                       suffix='_uni'):
+    """ Corrects a (4D) run for intensity non-uniformity, as a native
+    alternative to running 3dUniformize on every volume separately.
+
+    A smooth multiplicative bias field is estimated once, by a robust
+    least-squares fit of a Legendre polynomial (of the given total degree)
+    to the log intensities of the brain voxels of the temporal mean (or of
+    the mean of n_volumes evenly spaced volumes). The field is then divided
+    out of all volumes in a single streaming pass.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to (4D) nifti-file.
+    order : int (default: 3)
+        Total degree of the polynomial bias field.
+    n_volumes : int
+        Number of (evenly spaced) volumes to estimate the field from;
+        defaults to all volumes.
+    auto_clip : bool (default: True)
+        Whether to determine the intensity separating brain from air
+        automatically (as 3dClipLevel); otherwise clip_low and clip_high
+        are used.
+    clip_low : float (default: 7)
+        Voxels with lower intensities are not used in the fit.
+    clip_high : float (default: 200)
+        Voxels with higher intensities are not used in the fit.
+    chunk_size : int (default: 16)
+        Number of volumes read and corrected at once.
+    suffix : str (default: '_uni')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to corrected nifti-file.
+    bias_file : str
+        Absolute path to bias field nifti-file (mean 1 within the brain).
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from numpy.polynomial import legendre
+    from spynoza.utils import open_nifti_indexed
+    from spynoza.resampling.nodes import write_nifti_stream
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        shape = img.shape[:3]
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+        def _read(start, stop):
+            if len(img.shape) > 3:
+                return np.asarray(img.dataobj[..., start:stop],
+                                  dtype=np.float32)
+            return np.asarray(img.dataobj, dtype=np.float32)[..., np.newaxis]
+
+        # (sub-sampled) temporal mean
+        if n_volumes is None or n_volumes >= n_vols:
+            mean = np.zeros(shape)
+            for start in range(0, n_vols, chunk_size):
+                stop = min(start + chunk_size, n_vols)
+                mean += _read(start, stop).sum(axis=-1)
+            mean /= n_vols
+        else:
+            picks = np.linspace(0, n_vols - 1, n_volumes).round().astype(int)
+            mean = np.mean([_read(i, i + 1)[..., 0] for i in picks], axis=0)
+
+        if auto_clip:
+            # as 3dClipLevel: half the median of the voxels above the mean,
+            # iterated
+            low = mean.mean()
+            for _ in range(5):
+                low = .5 * np.median(mean[mean > low])
+            mask = mean > low
+        else:
+            mask = (mean > clip_low) & (mean < clip_high)
+        mask &= mean > 0
+
+        # Legendre polynomials per axis, on [-1, 1]
+        bases = [legendre.legvander(np.linspace(-1, 1, n), order)
+                 for n in shape]
+        terms = [(i, j, k) for i in range(order + 1) for j in range(order + 1)
+                 for k in range(order + 1) if i + j + k <= order]
+
+        voxels = np.argwhere(mask)
+        if voxels.shape[0] < len(terms):
+            raise ValueError('Only %i voxels of %s fall within the '
+                             'clipping bounds (%s, %s); need at least %i to '
+                             'fit the bias field' %
+                             (voxels.shape[0], in_file, clip_low, clip_high,
+                              len(terms)))
+        if voxels.shape[0] > 50000:
+            picks = np.random.RandomState(0).choice(voxels.shape[0], 50000,
+                                                    replace=False)
+            voxels = voxels[picks]
+        X = np.stack([bases[0][voxels[:, 0], i] * bases[1][voxels[:, 1], j] *
+                      bases[2][voxels[:, 2], k] for i, j, k in terms], axis=1)
+        y = np.log(mean[tuple(voxels.T)])
+
+        # robust fit: tissue contrast and vessels are outliers to a smooth
+        # field
+        keep = np.ones(y.shape, dtype=bool)
+        for _ in range(3):
+            beta = np.linalg.lstsq(X[keep], y[keep], rcond=None)[0]
+            residuals = y - X.dot(beta)
+            keep = np.abs(residuals) < 2.5 * residuals[keep].std()
+
+        coefs = np.zeros((order + 1,) * 3)
+        for b, (i, j, k) in zip(beta, terms):
+            coefs[i, j, k] = b
+        log_field = np.einsum('ia,jb,kc,abc->ijk', *(bases + [coefs]))
+        field = np.exp(log_field - log_field[mask].mean())
+        field = (field / field[mask].mean()).astype(np.float32)
+
+        base = os.path.basename(in_file).split('.')[0]
+        bias_file = os.path.abspath(base + '_bias.nii.gz')
+        hdr = img.header.copy()
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(field, img.affine, hdr), bias_file)
+
+        def _chunks():
+            for start in range(0, n_vols, chunk_size):
+                yield _read(start, min(start + chunk_size, n_vols)) / \
+                    field[..., np.newaxis]
+
+        out_file = os.path.abspath(base + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(), shape + (n_vols,), img.affine,
+                           header=img.header)
+
+        return out_file, bias_file
+
+
+Correct_bias_field = Function(function=correct_bias_field,
+                              input_names=['in_file', 'order', 'n_volumes',
+                                           'auto_clip', 'clip_low',
+                                           'clip_high', 'chunk_size',
+                                           'suffix'],
+                              output_names=['out_file', 'bias_file'])
@@ -0,0 +1,74 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import scipy.ndimage as nd
+import os.path as op
+from ..nodes import correct_bias_field
+from ..workflows import create_non_uniformity_correct_4D_file
+
+
+def _make_run(fn, n_vols=6):
+    rs = np.random.RandomState(0)
+    shape = (40, 44, 30)
+    x, y, z = np.ogrid[-1:1:40j, -1:1:44j, -1:1:30j]
+    brain = (x / .8) ** 2 + (y / .85) ** 2 + (z / .8) ** 2 <= 1
+    # two tissue classes and a smooth multiplicative bias
+    tissue = np.where(nd.gaussian_filter(rs.rand(*shape), .7) > .5, 800., 1000.)
+    clean = brain * tissue
+    bias = np.exp(.4 * x + .2 * y * z - .3 * z ** 2 + .1)
+    data = (clean * bias)[..., None] * (1 + .01 * rs.randn(n_vols))
+    nib.save(nib.Nifti1Image(data.astype(np.float32),
+                             np.diag([3., 3., 3.5, 1.])), fn)
+    return clean, brain
+
+
+@pytest.mark.uniformization
+def test_correct_bias_field(tmpdir):
+    tmpdir.chdir()
+    clean, brain = _make_run(op.abspath('run.nii.gz'))
+
+    for n_volumes in (None, 3):
+        out_file, bias_file = correct_bias_field(op.abspath('run.nii.gz'),
+                                                 n_volumes=n_volumes,
+                                                 chunk_size=4)
+        out = nib.load(out_file).get_fdata()
+        assert out.shape == clean.shape + (6,)
+        # corrected intensities are uniform up to a global scale
+        ratio = out[..., 0][brain] / clean[brain]
+        assert ratio.std() / ratio.mean() < .03
+        bias = nib.load(bias_file).get_fdata()
+        np.testing.assert_allclose(bias[brain].mean(), 1, atol=1e-3)
+
+    # absolute clip values outside of the data range leave nothing to fit
+    with pytest.raises(ValueError):
+        correct_bias_field(op.abspath('run.nii.gz'), auto_clip=False,
+                           clip_low=7, clip_high=200)
+
+
+@pytest.mark.uniformization
+def test_create_non_uniformity_correct_4D_file_native(tmpdir):
+    clean, brain = _make_run(str(tmpdir.join('run.nii.gz')))
+
+    nuc_wf = create_non_uniformity_correct_4D_file(method='native')
+    nuc_wf.base_dir = str(tmpdir.join('workingdir'))
+    nuc_wf.inputs.inputspec.in_file = str(tmpdir.join('run.nii.gz'))
+    nuc_wf.inputs.inputspec.output_directory = str(tmpdir)
+    nuc_wf.inputs.inputspec.sub_id = 'sub-01'
+    nuc_wf.run()
+
+    out_file = str(tmpdir.join('sub-01', 'uni', 'run_uni.nii.gz'))
+    out = nib.load(out_file).get_fdata()
+    assert np.isfinite(out).all()
+    ratio = out[..., 0][brain] / clean[brain]
+    assert ratio.std() / ratio.mean() < .03
+
+
+
+@pytest.mark.uniformization
+def test_create_non_uniformity_correct_4D_file_n_procs():
+    # the default reserves a single process, so that it runs anywhere
+    uniformer = create_non_uniformity_correct_4D_file().get_node('uniformer')
+    assert uniformer.n_procs == uniformer.inputs.n_procs == 1
+    uniformer = create_non_uniformity_correct_4D_file(
+        n_procs=4).get_node('uniformer')
+    assert uniformer.n_procs == uniformer.inputs.n_procs == 4
@@ -1,29 +1,37 @@
 import nipype.pipeline as pe
 import nipype.interfaces.io as nio
-from nipype.interfaces.utility import Function, IdentityInterface
-import nipype.interfaces.fsl as fsl
-from .nodes import Uniformize
-from ..utils import split_4D_to_3D
+from nipype.interfaces.utility import IdentityInterface
+from .nodes import Correct_bias_field
+from ..utils import Apply_per_volume
 
 
-def create_non_uniformity_correct_4D_file(auto_clip=False, clip_low=7,
-                                          clip_high=200, n_procs=12):
+def create_non_uniformity_correct_4D_file(auto_clip=None, clip_low=7,
+                                          clip_high=200, n_procs=1,
+                                          method='afni'):
     """non_uniformity_correct_4D_file corrects functional files for nonuniformity on a timepoint by timepoint way.
-    Internally it implements a workflow to split the in_file, correct each separately and then merge them back together.
-    This is an ugly workaround as we have to find the output of the workflow's datasink somewhere, but it should work.
+    Internally, 3dUniformize is run on batches of volumes by a pool of workers, and the outputs are merged back together
+    on the fly (see utils.apply_per_volume).
 
     Parameters
     ----------
     in_file : str
         Absolute path to nifti-file.
-    auto_clip : bool (default: False)
-        whether to let 3dUniformize decide on clipping boundaries
+    auto_clip : bool
+        whether to let 3dUniformize (or the native fit) decide on clipping
+        boundaries; defaults to False for 'afni' and to True for 'native',
+        as the 3dUniformize clip values are absolute intensities that do not
+        suit raw EPI data
     clip_low : float (default: 7),
-        lower clipping bound for 3dUniformize
+        lower clipping bound (absolute intensity)
     clip_high : float (default: 200),
-        higher clipping bound for 3dUniformize
-    n_procs : int (default: 12),
-        the number of processes to run the internal workflow with
+        higher clipping bound (absolute intensity)
+    n_procs : int (default: 1),
+        the number of processes to run 3dUniformize with (also reserved
+        from the nipype scheduler through node.n_procs)
+    method : str ['afni', 'native'] (default: 'afni')
+        whether to run 3dUniformize on every volume separately, or to
+        estimate a smooth (polynomial) bias field once, on the mean image,
+        and divide it out of all volumes in a single node
 
     Returns
     -------
@@ -38,15 +46,23 @@ def create_non_uniformity_correct_4D_file(auto_clip=False, clip_low=7,
                 'clip_high',
                 'output_directory',
                 'sub_id']), name='inputspec')
-    split = pe.Node(Function(input_names='in_file', output_names=['out_files'],
-                             function=split_4D_to_3D), name='split')
+    if auto_clip is None:
+        auto_clip = method == 'native'
 
-    uniformer = pe.MapNode(
-        Uniformize(clip_high=clip_high, clip_low=clip_low, auto_clip=auto_clip,
-                   outputtype='NIFTI_GZ'), name='uniformer',
-        iterfield=['in_file'])
-    merge = pe.MapNode(fsl.Merge(dimension='t'), name='merge',
-                       iterfield=['in_files'])
+    if method == 'native':
+        uniformer = pe.Node(Correct_bias_field, name='uniformer')
+        uniformer.inputs.auto_clip = auto_clip
+        uniformer.inputs.clip_low = clip_low
+        uniformer.inputs.clip_high = clip_high
+    else:
+        uniformer = pe.Node(Apply_per_volume, name='uniformer')
+        uniformer.inputs.interface = 'spynoza.uniformization.nodes.Uniformize'
+        uniformer.inputs.interface_inputs = dict(
+            clip_high=clip_high, clip_low=clip_low, auto_clip=auto_clip,
+            outputtype='NIFTI')
+        uniformer.inputs.n_procs = n_procs
+        uniformer.n_procs = n_procs
+        uniformer.inputs.suffix = '_uni'
 
     datasink = pe.Node(nio.DataSink(infields=['topup'], container=''),
                        name='sinker')
@@ -56,10 +72,8 @@ def create_non_uniformity_correct_4D_file(auto_clip=False, clip_low=7,
     nuc_wf = pe.Workflow(name='nuc')
     nuc_wf.connect(input_node, 'sub_id', datasink, 'container')
     nuc_wf.connect(input_node, 'output_directory', datasink, 'base_directory')
-    nuc_wf.connect(input_node, 'in_file', split, 'in_file')
-    nuc_wf.connect(split, 'out_files', uniformer, 'in_file')
-    nuc_wf.connect(uniformer, 'out_file', merge, 'in_files')
-    nuc_wf.connect(merge, 'merged_file', datasink, 'uni')
+    nuc_wf.connect(input_node, 'in_file', uniformer, 'in_file')
+    nuc_wf.connect(uniformer, 'out_file', datasink, 'uni')
 
     # nuc_wf.run('MultiProc', plugin_args={'n_procs': n_procs})
     # out_file = glob.glob(os.path.join(td, 'uni', fn_base + '_0000*.nii.gz'))[0]
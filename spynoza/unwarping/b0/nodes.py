@@ -39,18 +39,20 @@ def prepare_phasediff(in_file):
     import os
     import numpy as np
     img = nib.load(in_file)
-    max_diff = np.max(img.get_data().reshape(-1))
-    min_diff = np.min(img.get_data().reshape(-1))
+    data = img.get_fdata()
+    max_diff = data.max()
+    min_diff = data.min()
     A = (2.0 * np.pi) / (max_diff - min_diff)
     B = np.pi - (A * max_diff)
-    diff_norm = img.get_data() * A + B
+    diff_norm = data * A + B
 
     name, fext = os.path.splitext(os.path.basename(in_file))
     if fext == '.gz':
         name, _ = os.path.splitext(name)
     out_file = os.path.abspath('./%s_2pi.nii.gz' % name)
-    nib.save(nib.Nifti1Image(
-        diff_norm, img.get_affine(), img.get_header()), out_file)
+    out_img = nib.Nifti1Image(diff_norm, img.affine, img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, out_file)
     return out_file
 
 
@@ -61,16 +63,18 @@ Prepare_phasediff = Function(function=prepare_phasediff,
 
 def radials_per_second(in_file, asym):
     import nibabel as nib
+    import numpy as np
     import os
 
     img = nib.load(in_file)
-    img.data = img.get_data() * (1.0 / asym)
+    data = img.get_fdata() * (1.0 / asym)
     name, fext = os.path.splitext(os.path.basename(in_file))
     if fext == '.gz':
         name, _ = os.path.splitext(name)
     out_file = os.path.abspath('./%s_radials_ps.nii.gz' % name)
-    nib.save(nib.Nifti1Image(img.data, img.get_affine(), img.get_header()),
-             out_file)
+    out_img = nib.Nifti1Image(data, img.affine, img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, out_file)
     return out_file
 
 
@@ -81,19 +85,168 @@ Radials_per_second = Function(function=radials_per_second,
 
 def dilate_mask(in_file, iterations=4):
     import nibabel as nib
+    import numpy as np
     import scipy.ndimage as ndimage
     import os
 
     img = nib.load(in_file)
-    img.data = ndimage.binary_dilation(img.get_data(), iterations=iterations)
+    data = ndimage.binary_dilation(np.asanyarray(img.dataobj) > 0,
+                                   iterations=iterations)
     name, fext = os.path.splitext(os.path.basename(in_file))
     if fext == '.gz':
         name, _ = os.path.splitext(name)
     out_file = os.path.abspath('./%s_dil.nii.gz' % name)
-    nib.save(img, out_file)
+    out_img = nib.Nifti1Image(data.astype(np.uint8), img.affine, img.header)
+    out_img.set_data_dtype(np.uint8)
+    nib.save(out_img, out_file)
     return out_file
 
 
 Dilate_mask = Function(function=dilate_mask,
                        input_names=['in_file', 'iterations'],
                        output_names=['out_file'])
+
+
+def unwrap_phase(phase, mask=None):
+    """ Unwraps a 3D phase image with the least-squares (Poisson) method:
+    the Laplacian of the wrapped phase differences is integrated with a
+    discrete cosine transform, after which the result is made congruent
+    with the wrapped phase (i.e., differs from it by multiples of 2 pi).
+
+    Parameters
+    ----------
+    phase : np.ndarray
+        3D wrapped phase in radians, in [-pi, pi).
+    mask : np.ndarray
+        3D boolean mask; phase differences across its border are ignored.
+
+    Returns
+    -------
+    unwrapped : np.ndarray
+        3D unwrapped phase in radians (0 outside the mask).
+    """
+    import numpy as np
+    from scipy.fft import dctn, idctn
+
+    phase = np.asarray(phase, dtype=np.float64)
+    if mask is None:
+        mask = np.ones(phase.shape, dtype=bool)
+    mask = np.asarray(mask, dtype=bool)
+
+    def _wrap(x):
+        return (x + np.pi) % (2 * np.pi) - np.pi
+
+    # divergence of the wrapped gradient (Neumann boundaries)
+    rho = np.zeros(phase.shape)
+    for axis in range(3):
+        grad = _wrap(np.diff(phase, axis=axis))
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        grad *= mask[tuple(lower)] & mask[tuple(upper)]
+        pad = [(0, 0)] * 3
+        pad[axis] = (1, 1)
+        rho += np.diff(np.pad(grad, pad), axis=axis)
+
+    # the DCT diagonalises the Neumann Laplacian
+    eigen = np.zeros(phase.shape)
+    for axis, n in enumerate(phase.shape):
+        shape = [1] * 3
+        shape[axis] = n
+        eigen = eigen + (2 * np.cos(np.pi * np.arange(n) / n) -
+                         2).reshape(shape)
+    eigen[0, 0, 0] = 1.
+    coefs = dctn(rho, type=2, norm='ortho') / eigen
+    coefs[0, 0, 0] = 0.
+    smooth = idctn(coefs, type=2, norm='ortho')
+
+    # congruence: align the free constant, then add whole wraps
+    offset = np.angle(np.exp(1j * (phase - smooth))[mask].mean())
+    smooth += offset
+    unwrapped = phase + 2 * np.pi * np.round((smooth - phase) / (2 * np.pi))
+    unwrapped[~mask] = 0
+    return unwrapped
+
+
+def prepare_fieldmap(phase_file, te_diff, magnitude_file=None, mask_file=None,
+                     dilate=4):
+    """ Prepares a fieldmap in rad/s from a phase difference image, in a
+    single pass, replacing the chain phase rescaling -> BET -> mask
+    dilation -> PRELUDE -> conversion to rad/s (or fsl_prepare_fieldmap).
+
+    Parameters
+    ----------
+    phase_file : str
+        Absolute path to phase difference nifti-file, in arbitrary (scanner)
+        units; it is rescaled to [-pi, pi).
+    te_diff : float
+        Echo time difference in seconds.
+    magnitude_file : str
+        Absolute path to fieldmap magnitude nifti-file, used to compute a
+        mask if mask_file is not given.
+    mask_file : str
+        Absolute path to brain mask; if neither mask_file nor
+        magnitude_file is given, all voxels are unwrapped.
+    dilate : int (default: 4)
+        Number of dilation iterations applied to the mask.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to fieldmap (rad/s) nifti-file.
+    mask_file : str
+        Absolute path to (dilated) mask nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import scipy.ndimage as nd
+    from spynoza.unwarping.b0.nodes import unwrap_phase
+
+    img = nib.load(phase_file)
+    data = img.get_fdata()
+    data = data.reshape(data.shape[:3])
+    phase = (data - data.min()) * (2 * np.pi) / np.ptp(data) - np.pi
+
+    if mask_file is not None:
+        mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    elif magnitude_file is not None:
+        mag = nib.load(magnitude_file).get_fdata()
+        mag = nd.gaussian_filter(mag.reshape(mag.shape[:3]), 1)
+        mask = mag > .1 * np.percentile(mag, 98)
+        labels, n = nd.label(mask)
+        if n > 1:
+            sizes = nd.sum(mask, labels, range(1, n + 1))
+            mask = labels == np.argmax(sizes) + 1
+        mask = nd.binary_fill_holes(mask)
+    else:
+        mask = np.ones(phase.shape, dtype=bool)
+    mask = mask.reshape(phase.shape)
+    if dilate:
+        mask = nd.binary_dilation(mask, iterations=dilate)
+
+    unwrapped = unwrap_phase(phase, mask)
+    # the unwrapped phase is only defined up to a multiple of 2 pi: take the
+    # one closest to zero frequency offset
+    unwrapped[mask] -= 2 * np.pi * np.round(np.median(unwrapped[mask]) /
+                                            (2 * np.pi))
+    fmap = unwrapped / te_diff
+
+    name, fext = os.path.splitext(os.path.basename(phase_file))
+    if fext == '.gz':
+        name, _ = os.path.splitext(name)
+    out_file = os.path.abspath('./%s_radials_ps.nii.gz' % name)
+    out_img = nib.Nifti1Image(fmap.astype(np.float32), img.affine, img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, out_file)
+    mask_file = os.path.abspath('./%s_mask.nii.gz' % name)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine), mask_file)
+    return out_file, mask_file
+
+
+Prepare_fieldmap = Function(function=prepare_fieldmap,
+                            input_names=['phase_file', 'te_diff',
+                                         'magnitude_file', 'mask_file',
+                                         'dilate'],
+                            output_names=['out_file', 'mask_file'])
@@ -1,6 +1,11 @@
 import pytest
+import numpy as np
+import nibabel as nib
+import scipy.ndimage as nd
 import os.path as op
 from ..workflows import create_B0_workflow
+from ....registration.nodes import select_fsl_matrix, concat_fsl_matrices
+from ....resampling.nodes import apply_affines
 from .... import test_data_path
 
 test_data_path = op.join(test_data_path, 'sub-0020')
@@ -20,3 +25,73 @@ def test_create_B0_workflow():
     b0_wf.inputs.inputspec.te_diff = 0.005
     b0_wf.inputs.inputspec.phase_encoding_direction = 'y'
     b0_wf.run()
+
+
+@pytest.mark.b0
+def test_create_B0_workflow_register_once():
+
+    b0_wf = create_B0_workflow(method='native', register_once=True,
+                               n_procs=2)
+    # a single fieldmap registration, composed with the inverted motion
+    # matrix of every run; no registration per run
+    assert not hasattr(b0_wf.get_node('registration'), 'iterfield')
+    assert b0_wf.get_node('ref_to_run').iterfield == ['mat_file']
+    assert b0_wf.get_node('compose_xfm').iterfield == ['in_file2']
+    assert b0_wf.get_node('apply_xfm').iterfield == ['ref_file', 'mat_file']
+    apply_xfm = b0_wf.get_node('apply_xfm')
+    assert apply_xfm.n_procs == apply_xfm.inputs.n_threads == 2
+    assert b0_wf.get_node('unwarp').iterfield == ['in_file', 'fmap_file']
+    unwarp = b0_wf.get_node('unwarp')
+    assert unwarp.n_procs == unwarp.inputs.n_threads == 2
+
+    b0_wf = create_B0_workflow()
+    assert b0_wf.get_node('registration').iterfield == ['reference']
+    assert b0_wf.get_node('ref_to_run') is None
+
+
+@pytest.mark.b0
+def test_register_once_shifted_run(tmpdir):
+    tmpdir.chdir()
+    shape = (32, 36, 30)
+    affine = np.diag([3., 3., 3., 1.])
+    x, y, z = np.ogrid[-1:1:32j, -1:1:36j, -1:1:30j]
+    head = (x / .7) ** 2 + (y / .7) ** 2 + (z / .7) ** 2 <= 1
+    texture = nd.gaussian_filter(np.random.RandomState(0).rand(*shape), 2)
+    ref = nd.gaussian_filter(500. * head + 2000 * (texture - texture.mean()) *
+                             head, 1).astype(np.float32)
+    nib.save(nib.Nifti1Image(ref, affine), 'ref.nii.gz')
+
+    # a fieldmap (already registered to the reference) with a single blob
+    blob = (16, 12, 15)
+    fmap = np.zeros(shape, dtype=np.float32)
+    fmap[blob] = 1000.
+    fmap = nd.gaussian_filter(fmap, 2)
+    nib.save(nib.Nifti1Image(fmap, affine), 'fmap.nii.gz')
+    np.savetxt('fmap_to_ref.mat', np.eye(4))
+
+    # a (raw, not motion corrected) run, shifted by 4 voxels along y
+    shift = 4
+    run = nd.shift(ref, (0, shift, 0), order=1)
+    nib.save(nib.Nifti1Image(np.stack([run] * 3, axis=-1), affine),
+             'run.nii.gz')
+
+    # its motion estimates (to the reference), as MCFLIRT writes them
+    tmpdir.mkdir('run_mcf.mat')
+    run_to_ref = np.eye(4)
+    run_to_ref[1, 3] = -shift * 3.
+    for i in range(3):
+        np.savetxt(op.join('run_mcf.mat', 'MAT_%04i' % i), run_to_ref)
+
+    ref_to_run = select_fsl_matrix(op.abspath('run_mcf.mat'), index=0,
+                                   invert=True)
+    np.testing.assert_allclose(np.loadtxt(ref_to_run)[1, 3], shift * 3.)
+    mat_file = concat_fsl_matrices(op.abspath('fmap_to_ref.mat'), ref_to_run)
+    out_file = apply_affines(op.abspath('fmap.nii.gz'), mat_file,
+                             ref_file=op.abspath('run.nii.gz'),
+                             suffix='_warped')
+    warped = nib.load(out_file).get_fdata()[..., 0]
+    assert warped.shape == shape
+
+    # the field follows the run
+    peak = np.unravel_index(np.argmax(warped), shape)
+    assert peak == (blob[0], blob[1] + shift, blob[2])
@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes import prepare_fieldmap, unwrap_phase
+
+
+@pytest.mark.b0
+def test_prepare_fieldmap(tmpdir):
+    tmpdir.chdir()
+    shape = (48, 52, 40)
+    x, y, z = np.indices(shape) - ((np.array(shape) - 1) / 2.)[:, None, None, None]
+    brain = (x / 20.) ** 2 + (y / 22.) ** 2 + (z / 16.) ** 2 <= 1
+    rs = np.random.RandomState(0)
+    mag = np.where(brain, 1000., 20.) + rs.rand(*shape) * 10
+
+    # a field (rad/s) wrapping several times, random phase outside the brain
+    te_diff = .0023
+    field = 2 * np.pi * (450 * np.exp(-((x - 5) ** 2 + (y + 10) ** 2 +
+                                        (z + 8) ** 2) / 150.) - 2 * x)
+    phase = np.where(brain, (field * te_diff + np.pi) % (2 * np.pi) - np.pi,
+                     rs.uniform(-np.pi, np.pi, shape))
+    raw = (phase + np.pi) / (2 * np.pi) * 4094 - 2048  # scanner units
+    nib.save(nib.Nifti1Image(raw.astype(np.int16), np.eye(4)), 'phase.nii.gz')
+    nib.save(nib.Nifti1Image(mag.astype(np.float32), np.eye(4)), 'mag.nii.gz')
+
+    out_file, mask_file = prepare_fieldmap(
+        op.abspath('phase.nii.gz'), te_diff,
+        magnitude_file=op.abspath('mag.nii.gz'))
+    fmap = nib.load(out_file).get_fdata()
+    mask = nib.load(mask_file).get_fdata() > 0
+    assert mask[brain].all()
+    # up to the quantisation of the phase
+    np.testing.assert_allclose(fmap[brain], field[brain], atol=1.)
+
+    # without a mask, a smooth phase ramp is recovered up to a constant
+    ramp = np.linspace(0, 6 * np.pi, 30)[:, None, None] * np.ones((30, 8, 6))
+    unwrapped = unwrap_phase((ramp + np.pi) % (2 * np.pi) - np.pi)
+    np.testing.assert_allclose(unwrapped - unwrapped[0, 0, 0], ramp,
+                               atol=1e-8)
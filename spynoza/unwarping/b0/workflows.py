@@ -3,12 +3,45 @@ from nipype.interfaces.utility import IdentityInterface
 import nipype.interfaces.fsl.preprocess as fsl
 from .nodes import (Prepare_phasediff, Radials_per_second, Dilate_mask,
                     Compute_echo_spacing_philips, Compute_echo_spacing_siemens,
-                    TE_diff_ms, Make_output_filename)
+                    TE_diff_ms, Make_output_filename, Prepare_fieldmap)
 from nipype.interfaces.fsl import PrepareFieldmap
+from ...resampling.nodes import Apply_voxel_shift, Apply_affines
+from ...registration.nodes import Select_fsl_matrix, Concat_fsl_matrices
 
-def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
+def create_B0_workflow(name ='b0_unwarping', scanner='philips', method='fsl',
+                       register_once=False, n_procs=1):
     """ Does B0 field unwarping
 
+    Parameters
+    ----------
+    name : string
+        name of workflow
+    scanner : string ['philips', 'siemens']
+        how the fieldmap and echo spacing are prepared
+    method : string ['fsl', 'native']
+        whether the fieldmap is prepared (PRELUDE / fsl_prepare_fieldmap) and
+        the runs are unwarped (FUGUE) by FSL, or natively: the fieldmap is
+        rescaled, masked and unwrapped in a single node, and the runs are
+        unwarped by a voxel shift map that is computed once per run and
+        applied to all volumes (no median filtering of the fieldmap; set
+        unwarp.inputs.jacobian for intensity correction)
+    register_once : bool
+        whether to register the fieldmap magnitude once, to
+        inputspec.EPI_space_file, instead of to every run separately (a
+        single FLIRT call instead of one per run). The reference -> run
+        transform is then taken from the motion estimates: the inverse of
+        the matrix of the first volume of every run in
+        inputspec.motion_matrix_files, and the fieldmap is resampled to each
+        run with the concatenation of both matrices. This requires motion
+        correction of the raw (not unwarped) runs, e.g., for the composite
+        resampling workflow, with EPI_space_file the motion correction
+        reference (outputspec.EPI_space_file and
+        outputspec.motion_correction_matrices of the motion correction
+        workflow, FSL or native).
+    n_procs : int (default: 1)
+        number of threads used by the native nodes for each run (and
+        reserved from the nipype scheduler through node.n_procs)
+
     Example
     -------
     >>> nipype_epicorrect = create_unwarping_workflow('unwarp',)
@@ -31,8 +64,11 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
         input_node.acceleration - Acceleration factor used for EPI parallel imaging (SENSE)
         input_node.te_diff - Time difference between TE in seconds.
         input_node.phase_encoding_direction - Unwarp direction (default should be "y")
+        input_node.EPI_space_file - Session reference the fieldmap is registered to (if register_once)
+        input_node.motion_matrix_files - Per-run motion matrices (.mat directories) to EPI_space_file (if register_once)
     Outputs::
-        outputnode.epi_corrected
+        outputnode.out_files - Unwarped runs
+        outputnode.field_coefs - Fieldmaps (rad/s) in EPI space, one per run
     """
 
     # Nodes:
@@ -48,7 +84,14 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
                                                              'acceleration',
                                                              'echo_spacing',
                                                              'te_diff',
-                                                             'phase_encoding_direction']))
+                                                             'phase_encoding_direction',
+                                                             'EPI_space_file',
+                                                             'motion_matrix_files']))
+
+    # Rescale, mask and unwrap the phase difference, and convert to rad/s
+    # (native alternative to the steps below)
+    prepare_native = pe.Node(interface=Prepare_fieldmap,
+                             name='prepare_fieldmap_native')
 
     # Normalize phase difference of the fieldmap phase to be [-pi, pi)
     norm_pha = pe.Node(interface=Prepare_phasediff, name='normalize_phasediff')
@@ -67,18 +110,40 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
     prepare_fieldmap = pe.Node(PrepareFieldmap(), name='prepare_fieldmap')
 
     # Register unwrapped fieldmap (rad/s) to epi, using the magnitude of the fieldmap
-    registration = pe.MapNode(fsl.FLIRT(bins=256, cost='corratio', dof=6,
-                                        interp='trilinear',
-                                        searchr_x=[-10, 10],
-                                        searchr_y=[-10, 10],
-                                        searchr_z=[-10, 10]),
-                              iterfield=['reference'],
-                              name='registration')
+    flirt = fsl.FLIRT(bins=256, cost='corratio', dof=6, interp='trilinear',
+                      searchr_x=[-10, 10], searchr_y=[-10, 10],
+                      searchr_z=[-10, 10])
+    if register_once:
+        # once, to the session reference, for all runs
+        registration = pe.Node(flirt, name='registration')
+    else:
+        registration = pe.MapNode(flirt, iterfield=['reference'],
+                                  name='registration')
+
+    # map the session reference to the first volume of every run with the
+    # inverted motion matrix of that volume, and compose with the fieldmap
+    # -> reference matrix (if register_once)
+    ref_to_run = pe.MapNode(interface=Select_fsl_matrix,
+                            iterfield=['mat_file'], name='ref_to_run')
+    ref_to_run.inputs.index = 0
+    ref_to_run.inputs.invert = True
+    compose = pe.MapNode(interface=Concat_fsl_matrices,
+                         iterfield=['in_file2'], name='compose_xfm')
 
     # transform unwrapped fieldmap (rad/s)
-    applyxfm = pe.MapNode(fsl.ApplyXFM(interp='trilinear'),
-                          iterfield=['reference', 'in_matrix_file'],
-                          name='apply_xfm')
+    if method == 'native' and register_once:
+        applyxfm = pe.MapNode(interface=Apply_affines,
+                              iterfield=['ref_file', 'mat_file'],
+                              name='apply_xfm')
+        applyxfm.inputs.suffix = '_warped'
+        applyxfm.inputs.n_threads = n_procs
+        applyxfm.n_procs = n_procs
+        xfm_matrix, xfm_reference = 'mat_file', 'ref_file'
+    else:
+        applyxfm = pe.MapNode(fsl.ApplyXFM(interp='trilinear'),
+                              iterfield=['reference', 'in_matrix_file'],
+                              name='apply_xfm')
+        xfm_matrix, xfm_reference = 'in_matrix_file', 'reference'
 
     # compute effective echospacing:
     echo_spacing_philips = pe.Node(interface=Compute_echo_spacing_philips, name='echo_spacing_philips')
@@ -86,9 +151,25 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
     te_diff_in_ms = pe.Node(interface=TE_diff_ms, name='te_diff_in_ms')
 
     # Unwarp with FSL Fugue
-    fugue = pe.MapNode(interface=fsl.FUGUE(median_2dfilter=True),
-                       iterfield=['in_file', 'unwarped_file', 'fmap_in_file'],
-                       name='fugue')
+    if method == 'native':
+        fugue = pe.MapNode(interface=Apply_voxel_shift,
+                           iterfield=['in_file', 'fmap_file'],
+                           name='unwarp')
+        fugue.inputs.suffix = '_B0'
+        fugue.inputs.n_threads = n_procs
+        fugue.n_procs = n_procs
+    else:
+        fugue = pe.MapNode(interface=fsl.FUGUE(median_2dfilter=True),
+                           iterfield=['in_file', 'unwarped_file',
+                                      'fmap_in_file'],
+                           name='fugue')
+    # input and output names of the unwarping node
+    if method == 'native':
+        dwell_time, fmap_in_file, unwarp_direction, unwarped_file = \
+            'echo_spacing', 'fmap_file', 'pe_direction', 'out_file'
+    else:
+        dwell_time, fmap_in_file, unwarp_direction, unwarped_file = \
+            'dwell_time', 'fmap_in_file', 'unwarp_direction', 'unwarped_file'
 
     # Convert unwrapped fieldmap phase to radials per second:
     out_file = pe.MapNode(interface=Make_output_filename,
@@ -103,15 +184,28 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
     # ---------
 
     unwarp_workflow = pe.Workflow(name=name)
-    unwarp_workflow.connect(input_node, 'in_files', out_file, 'in_file')
+    if method != 'native':
+        unwarp_workflow.connect(input_node, 'in_files', out_file, 'in_file')
 
     # registration:
     unwarp_workflow.connect(input_node, 'fieldmap_mag', mask_mag, 'in_file')
-    unwarp_workflow.connect(mask_mag, 'mask_file', mask_mag_dil, 'in_file')
+    if method != 'native':
+        unwarp_workflow.connect(mask_mag, 'mask_file', mask_mag_dil, 'in_file')
     unwarp_workflow.connect(mask_mag, 'out_file', registration, 'in_file')
-    unwarp_workflow.connect(input_node, 'in_files', registration, 'reference')
+    if register_once:
+        unwarp_workflow.connect(input_node, 'EPI_space_file', registration, 'reference')
+    else:
+        unwarp_workflow.connect(input_node, 'in_files', registration, 'reference')
 
-    if scanner == 'philips':
+    if method == 'native':
+
+        # prepare fieldmap:
+        unwarp_workflow.connect(input_node, 'fieldmap_pha', prepare_native, 'phase_file')
+        unwarp_workflow.connect(input_node, 'fieldmap_mag', prepare_native, 'magnitude_file')
+        unwarp_workflow.connect(input_node, 'te_diff', prepare_native, 'te_diff')
+        unwarp_workflow.connect(prepare_native, 'out_file', applyxfm, 'in_file')
+
+    elif scanner == 'philips':
 
         # prepare fieldmap:
         unwarp_workflow.connect(input_node, 'fieldmap_pha', norm_pha, 'in_file')
@@ -120,17 +214,7 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
         unwarp_workflow.connect(mask_mag_dil, 'out_file', prelude, 'mask_file')
         unwarp_workflow.connect(prelude, 'unwrapped_phase_file', radials_per_second, 'in_file')
         unwarp_workflow.connect(input_node, 'te_diff', radials_per_second, 'asym')
-
-        # transform fieldmap:
         unwarp_workflow.connect(radials_per_second, 'out_file', applyxfm, 'in_file')
-        unwarp_workflow.connect(registration, 'out_matrix_file', applyxfm, 'in_matrix_file')
-        unwarp_workflow.connect(input_node, 'in_files', applyxfm, 'reference')
-
-        # compute echo spacing:
-        unwarp_workflow.connect(input_node, 'wfs', echo_spacing_philips, 'wfs')
-        unwarp_workflow.connect(input_node, 'epi_factor', echo_spacing_philips, 'epi_factor')
-        unwarp_workflow.connect(input_node, 'acceleration', echo_spacing_philips, 'acceleration')
-        unwarp_workflow.connect(echo_spacing_philips, 'echo_spacing', fugue, 'dwell_time')
 
     elif scanner == 'siemens':
 
@@ -140,23 +224,36 @@ def create_B0_workflow(name ='b0_unwarping', scanner='philips'):
         unwarp_workflow.connect(mask_mag, 'out_file', prepare_fieldmap, 'in_magnitude')
         unwarp_workflow.connect(input_node, 'fieldmap_pha', prepare_fieldmap, 'in_phase')
         unwarp_workflow.connect(te_diff_in_ms, 'te_diff', prepare_fieldmap, 'delta_TE')
-
-        # transform fieldmap:
         unwarp_workflow.connect(prepare_fieldmap, 'out_fieldmap', applyxfm, 'in_file')
-        unwarp_workflow.connect(registration, 'out_matrix_file', applyxfm, 'in_matrix_file')
-        unwarp_workflow.connect(input_node, 'in_files', applyxfm, 'reference')
 
-        # compute echo spacing:
+    # transform fieldmap:
+    if register_once:
+        unwarp_workflow.connect(input_node, 'motion_matrix_files', ref_to_run, 'mat_file')
+        unwarp_workflow.connect(registration, 'out_matrix_file', compose, 'in_file')
+        unwarp_workflow.connect(ref_to_run, 'out_file', compose, 'in_file2')
+        unwarp_workflow.connect(compose, 'out_file', applyxfm, xfm_matrix)
+    else:
+        unwarp_workflow.connect(registration, 'out_matrix_file', applyxfm, xfm_matrix)
+    unwarp_workflow.connect(input_node, 'in_files', applyxfm, xfm_reference)
+
+    # compute echo spacing:
+    if scanner == 'philips':
+        unwarp_workflow.connect(input_node, 'wfs', echo_spacing_philips, 'wfs')
+        unwarp_workflow.connect(input_node, 'epi_factor', echo_spacing_philips, 'epi_factor')
+        unwarp_workflow.connect(input_node, 'acceleration', echo_spacing_philips, 'acceleration')
+        unwarp_workflow.connect(echo_spacing_philips, 'echo_spacing', fugue, dwell_time)
+    elif scanner == 'siemens':
         unwarp_workflow.connect(input_node, 'acceleration', echo_spacing_siemens, 'acceleration')
         unwarp_workflow.connect(input_node, 'echo_spacing', echo_spacing_siemens, 'echo_spacing')
-        unwarp_workflow.connect(echo_spacing_siemens, 'echo_spacing', fugue, 'dwell_time')
+        unwarp_workflow.connect(echo_spacing_siemens, 'echo_spacing', fugue, dwell_time)
 
     unwarp_workflow.connect(input_node, 'in_files', fugue, 'in_file')
-    unwarp_workflow.connect(out_file, 'out_file', fugue, 'unwarped_file')
-    unwarp_workflow.connect(applyxfm, 'out_file', fugue, 'fmap_in_file')
-    unwarp_workflow.connect(input_node, 'te_diff', fugue, 'asym_se_time')
-    unwarp_workflow.connect(input_node, 'phase_encoding_direction', fugue, 'unwarp_direction')
-    unwarp_workflow.connect(fugue, 'unwarped_file', outputnode, 'out_files')
+    if method != 'native':
+        unwarp_workflow.connect(out_file, 'out_file', fugue, 'unwarped_file')
+        unwarp_workflow.connect(input_node, 'te_diff', fugue, 'asym_se_time')
+    unwarp_workflow.connect(applyxfm, 'out_file', fugue, fmap_in_file)
+    unwarp_workflow.connect(input_node, 'phase_encoding_direction', fugue, unwarp_direction)
+    unwarp_workflow.connect(fugue, unwarped_file, outputnode, 'out_files')
     unwarp_workflow.connect(applyxfm, 'out_file', outputnode, 'field_coefs')
 
     # # Connect
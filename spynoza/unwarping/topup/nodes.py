@@ -4,7 +4,6 @@ from nipype.interfaces.utility import Function
 def topup_scan_params(pe_direction='y', te=0.025, epi_factor=37):
     import numpy as np
     import os
-    import tempfile
 
     scan_param_array = np.zeros((2, 4))
     scan_param_array[0, ['x', 'y', 'z'].index(pe_direction)] = 1
@@ -14,7 +13,8 @@ def topup_scan_params(pe_direction='y', te=0.025, epi_factor=37):
     spa_txt = str('\n'.join(
         ['\t'.join(['%1.3f' % s for s in sp]) for sp in scan_param_array]))
 
-    fn = os.path.join(tempfile.gettempdir(), 'scan_params.txt')
+    # the node's own working directory, unique per invocation
+    fn = os.path.abspath('scan_params.txt')
     np.savetxt(fn, scan_param_array, fmt='%1.3f')
     return fn
 
@@ -27,7 +27,6 @@ Topup_scan_params = Function(function=topup_scan_params,
 def apply_scan_params(pe_direction='y', te=0.025, epi_factor=37, nr_trs=1):
     import numpy as np
     import os
-    import tempfile
 
     scan_param_array = np.zeros((nr_trs, 4))
     scan_param_array[:, ['x', 'y', 'z'].index(pe_direction)] = 1
@@ -36,7 +35,7 @@ def apply_scan_params(pe_direction='y', te=0.025, epi_factor=37, nr_trs=1):
     spa_txt = str('\n'.join(
         ['\t'.join(['%1.3f' % s for s in sp]) for sp in scan_param_array]))
 
-    fn = os.path.join(tempfile.gettempdir(), 'scan_params_apply.txt')
+    fn = os.path.abspath('scan_params_apply.txt')
     np.savetxt(fn, scan_param_array, fmt='%1.3f')
     return fn
 
@@ -45,3 +44,189 @@ Apply_scan_params = Function(function=apply_scan_params,
                              input_names=['pe_direction', 'te', 'epi_factor',
                                           'nr_trs'],
                              output_names=['fn'])
+
+
+def topup_coefs_to_field(fieldcoef_file, shape, derivative_axis=None):
+    """ Evaluates a topup field (Hz) on the grid of the images it was
+    estimated from, from its cubic B-spline coefficients (out_fieldcoef).
+
+    The spline is separable, so the field is computed as a tensor product
+    of three small per-axis weight matrices with the coefficient grid. Files
+    that already contain the field (topup's --fout) are returned as is.
+
+    Parameters
+    ----------
+    fieldcoef_file : str
+        Absolute path to topup field coefficient (or field) nifti-file; the
+        voxel sizes of the coefficient file are the knot spacings in voxels.
+    shape : tuple
+        Spatial shape of the images topup was run on.
+    derivative_axis : int
+        If given, the derivative of the field along this voxel axis
+        (Hz per voxel) is returned as well.
+
+    Returns
+    -------
+    field : np.ndarray
+        3D field in Hz.
+    derivative : np.ndarray
+        3D derivative of the field (only if derivative_axis is given).
+    """
+    import numpy as np
+    import nibabel as nib
+
+    img = nib.load(fieldcoef_file)
+    coefs = np.asanyarray(img.dataobj, dtype=np.float64)
+    coefs = coefs.reshape(coefs.shape[:3])
+    intent = int(img.header['intent_code'])
+
+    if intent in (2009, 2017):
+        raise ValueError('Quadratic spline coefficients (%s) are not '
+                         'supported' % fieldcoef_file)
+    if coefs.shape == tuple(shape[:3]) and intent not in (2007, 2016):
+        field = coefs
+        if derivative_axis is None:
+            return field
+        return field, np.gradient(field, axis=derivative_axis)
+
+    def _weights(n, n_coefs, spacing, derivative=False):
+        x = np.arange(n) / float(spacing)
+        i = np.floor(x).astype(int)
+        u = x - i
+        if derivative:
+            basis = [-(1 - u) ** 2 / 2., 1.5 * u ** 2 - 2 * u,
+                     -1.5 * u ** 2 + u + .5, u ** 2 / 2.]
+            basis = [b / spacing for b in basis]
+        else:
+            basis = [(1 - u) ** 3 / 6., (3 * u ** 3 - 6 * u ** 2 + 4) / 6.,
+                     (-3 * u ** 3 + 3 * u ** 2 + 3 * u + 1) / 6., u ** 3 / 6.]
+        W = np.zeros((n, n_coefs))
+        for l, b in enumerate(basis):
+            valid = (i + l) < n_coefs
+            W[np.arange(n)[valid], (i + l)[valid]] += b[valid]
+        return W
+
+    spacings = img.header.get_zooms()[:3]
+    weights = [_weights(n, c, s) for n, c, s in
+               zip(shape[:3], coefs.shape, spacings)]
+    field = np.einsum('ia,jb,kc,abc->ijk', *(weights + [coefs]))
+    if derivative_axis is None:
+        return field
+
+    weights[derivative_axis] = _weights(shape[derivative_axis],
+                                        coefs.shape[derivative_axis],
+                                        spacings[derivative_axis],
+                                        derivative=True)
+    derivative = np.einsum('ia,jb,kc,abc->ijk', *(weights + [coefs]))
+    return field, derivative
+
+
+def apply_topup(in_file, fieldcoef_file, encoding_file, in_index=1,
+                movpar_file=None, jacobian=True, order=1, chunk_size=16,
+                n_threads=1, suffix='_corrected'):
+    """ Corrects a (4D) EPI run with a topup field, as ApplyTOPUP does with
+    method='jac', in a single streaming pass.
+
+    The field is evaluated from its B-spline coefficients on the EPI grid
+    once, converted to a displacement along the phase encoding axis and
+    composed with the (optional) topup motion of the in_index volume; all
+    volumes are then resampled with the same coordinates, in time-chunks by
+    a thread pool, and modulated by the Jacobian of the displacement.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to (4D) EPI nifti-file.
+    fieldcoef_file : str
+        Absolute path to topup's out_fieldcoef (or out_field) file.
+    encoding_file : str
+        Absolute path to topup acquisition parameters file (phase encoding
+        vector and total readout time per row).
+    in_index : int (default: 1)
+        Row (1-based) of encoding_file (and movpar_file) that in_file was
+        acquired with.
+    movpar_file : str
+        Absolute path to topup's out_movpar file; if given, the rigid motion
+        of row in_index is applied as well.
+    jacobian : bool (default: True)
+        Whether to modulate the intensities with the Jacobian of the
+        displacement (ApplyTOPUP's method='jac').
+    order : int (default: 1)
+        Spline order of the interpolation (0: nearest, 1: trilinear).
+    chunk_size : int (default: 16)
+        Number of volumes read and resampled at once.
+    n_threads : int (default: 1)
+        Number of threads; set node.n_procs to match.
+    suffix : str (default: '_corrected')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to corrected nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import (params_to_fsl_matrix, fsl_voxel_to_mm,
+                               open_nifti_indexed)
+    from spynoza.resampling.nodes import (fsl_to_voxel_matrices,
+                                          resample_chunk, write_nifti_stream)
+    from spynoza.unwarping.topup.nodes import topup_coefs_to_field
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        shape = img.shape[:3]
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+        acq = np.loadtxt(encoding_file, ndmin=2)[in_index - 1]
+        axis = int(np.argmax(np.abs(acq[:3])))
+        sign, readout = np.sign(acq[axis]), acq[3]
+        field, derivative = topup_coefs_to_field(fieldcoef_file, shape,
+                                                 derivative_axis=axis)
+
+        # displacement (voxels) along the phase encoding axis
+        coords = np.indices(shape, dtype=np.float64).reshape((3, -1))
+        coords[axis] += (sign * readout * field).ravel()
+        scale = np.ones(int(np.prod(shape)), dtype=np.float32)
+        if jacobian:
+            scale *= (1. + sign * readout * derivative).ravel()
+
+        mat = np.eye(4)
+        if movpar_file is not None:
+            movpar = np.loadtxt(movpar_file, ndmin=2)[in_index - 1]
+            vox2fsl = fsl_voxel_to_mm(shape, img.header.get_zooms(),
+                                      img.affine)
+            centre = vox2fsl[:3, :3].dot((np.array(shape) - 1) / 2.) + \
+                vox2fsl[:3, 3]
+            # movpar holds translations (mm) followed by rotations (rad)
+            mat = params_to_fsl_matrix(np.r_[movpar[3:6], movpar[:3]], centre)
+        vox_mats = np.repeat(fsl_to_voxel_matrices(mat, img, img), n_vols,
+                             axis=0)
+
+        def _chunks():
+            for start in range(0, n_vols, chunk_size):
+                stop = min(start + chunk_size, n_vols)
+                if len(img.shape) > 3:
+                    data = img.dataobj[..., start:stop]
+                else:
+                    data = np.asanyarray(img.dataobj)[..., np.newaxis]
+                out = resample_chunk(data, vox_mats[start:stop], shape,
+                                     order=order, n_threads=n_threads,
+                                     coords=coords)
+                out *= scale.reshape(shape)[..., np.newaxis]
+                yield out
+
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+        write_nifti_stream(out_file, _chunks(), shape + (n_vols,), img.affine,
+                           header=img.header)
+
+        return out_file
+
+
+Apply_topup = Function(function=apply_topup,
+                       input_names=['in_file', 'fieldcoef_file',
+                                    'encoding_file', 'in_index',
+                                    'movpar_file', 'jacobian', 'order',
+                                    'chunk_size', 'n_threads', 'suffix'],
+                       output_names=['out_file'])
@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from ..nodes import apply_topup, topup_coefs_to_field
+from ..workflows import create_topup_workflow
+from ....resampling.nodes import apply_voxel_shift
+from ....utils import extract_volume
+
+
+def _save_coefs(fn, coefs, knot_spacing):
+    img = nib.Nifti1Image(coefs.astype(np.float32), np.eye(4))
+    img.header.set_zooms(knot_spacing)
+    img.header['intent_code'] = 2016  # FSL_TOPUP_CUBIC_SPLINE_COEFFICIENTS
+    nib.save(img, fn)
+
+
+@pytest.mark.topup
+def test_topup_coefs_to_field(tmpdir):
+    tmpdir.chdir()
+    shape, ksp = (20, 24, 10), (4., 4., 2.)
+    n_coefs = tuple(int(np.ceil(n / k)) + 3 for n, k in zip(shape, ksp))
+
+    # coefficient j sits at voxel (j - 1) * ksp: a linear ramp along y
+    coefs = np.zeros(n_coefs)
+    coefs += 3. * ((np.arange(n_coefs[1]) - 1) * ksp[1])[None, :, None]
+    _save_coefs('coefs.nii.gz', coefs + 10., ksp)
+    field, derivative = topup_coefs_to_field(op.abspath('coefs.nii.gz'),
+                                             shape, derivative_axis=1)
+    y = np.arange(shape[1])[None, :, None]
+    np.testing.assert_allclose(field, np.broadcast_to(3. * y + 10., shape),
+                               atol=1e-4)
+    np.testing.assert_allclose(derivative, 3., atol=1e-5)
+
+
+@pytest.mark.topup
+def test_apply_topup(tmpdir):
+    tmpdir.chdir()
+    rs = np.random.RandomState(0)
+    shape, ksp = (20, 24, 10), (4., 4., 2.)
+    data = rs.rand(*(shape + (4,))).astype(np.float32)
+    in_file = op.abspath('run.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.diag([-2., 2., 2., 1.])), in_file)
+
+    # smooth field, with up to ~1.5 voxels displacement for a 50 ms readout
+    n_coefs = tuple(int(np.ceil(n / k)) + 3 for n, k in zip(shape, ksp))
+    coefs = 30. * rs.randn(*n_coefs)
+    _save_coefs('coefs.nii.gz', coefs, ksp)
+    np.savetxt('acqparams.txt', [[0, -1, 0, .05], [0, 1, 0, .05]])
+    np.savetxt('movpar.txt', np.zeros((2, 6)))
+
+    out_file = apply_topup(in_file, op.abspath('coefs.nii.gz'),
+                           op.abspath('acqparams.txt'), in_index=2,
+                           movpar_file=op.abspath('movpar.txt'),
+                           jacobian=False, chunk_size=3)
+    out = nib.load(out_file).get_fdata()
+    assert out.shape == data.shape
+
+    # same as a fieldmap-based voxel shift with the equivalent field
+    field = topup_coefs_to_field(op.abspath('coefs.nii.gz'), shape)
+    nib.save(nib.Nifti1Image((2 * np.pi * field).astype(np.float32),
+                             np.diag([-2., 2., 2., 1.])), 'fmap.nii.gz')
+    expected = nib.load(apply_voxel_shift(
+        in_file, op.abspath('fmap.nii.gz'), .05 / shape[1])).get_fdata()
+    np.testing.assert_allclose(out, expected, atol=1e-4)
+
+    # Jacobian modulation
+    jac = nib.load(apply_topup(in_file, op.abspath('coefs.nii.gz'),
+                               op.abspath('acqparams.txt'), in_index=2,
+                               suffix='_jac')).get_fdata()
+    _, derivative = topup_coefs_to_field(op.abspath('coefs.nii.gz'), shape,
+                                         derivative_axis=1)
+    np.testing.assert_allclose(jac, out * (1 + .05 * derivative)[..., None],
+                               atol=1e-4)
+
+
+@pytest.mark.topup
+def test_create_topup_workflow_n_procs():
+    topup_wf = create_topup_workflow({}, method='native', n_procs=2)
+    unwarp = topup_wf.get_node('unwarp')
+    assert unwarp.n_procs == unwarp.inputs.n_threads == 2
+
+
+@pytest.mark.topup
+def test_extract_volume(tmpdir):
+    tmpdir.chdir()
+    data = np.random.RandomState(0).rand(6, 5, 4, 7).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.diag([2., 2., 2., 1.])), 'run.nii.gz')
+
+    for index in (0, 3, -1):
+        roi_file = extract_volume(op.abspath('run.nii.gz'), index=index,
+                                  cache_dir=str(tmpdir.join('cache')))
+        roi = nib.load(roi_file)
+        assert roi.shape == (6, 5, 4)
+        np.testing.assert_array_equal(roi.get_fdata(), data[..., index])
+
+    with pytest.raises(ValueError):
+        extract_volume(op.abspath('run.nii.gz'), index=7)
@@ -0,0 +1,42 @@
+import os
+import pytest
+import numpy as np
+from ..nodes import topup_scan_params, apply_scan_params
+from ....utils import scratch_space
+
+
+@pytest.mark.topup
+def test_scan_params_per_node(tmpdir):
+    # two invocations (e.g., two subjects under MultiProc) don't collide
+    fns = []
+    for i, pe in enumerate(('x', 'y')):
+        tmpdir.mkdir('node%i' % i).chdir()
+        fns.append((topup_scan_params(pe_direction=pe),
+                    apply_scan_params(pe_direction=pe, nr_trs=3)))
+    assert len(set(sum(fns, ()))) == 4
+    np.testing.assert_array_equal(np.loadtxt(fns[0][0])[:, 0], [1, -1])
+    np.testing.assert_array_equal(np.loadtxt(fns[1][1])[:, 1], [1, 1, 1])
+
+
+@pytest.mark.topup
+def test_scratch_space(tmpdir, monkeypatch):
+    monkeypatch.setenv('SPYNOZA_SCRATCH_DIR', str(tmpdir))
+    with scratch_space() as a, scratch_space() as b:
+        assert a != b and os.path.dirname(a) == str(tmpdir)
+    assert not os.path.exists(a) and not os.path.exists(b)
+
+    # kept for inspection if the node fails
+    with pytest.raises(RuntimeError):
+        with scratch_space() as c:
+            raise RuntimeError
+    assert os.path.isdir(c)
+
+    # the environment variable takes precedence over the RAM disk
+    with scratch_space(ram_disk=True) as d:
+        assert os.path.isdir(d) and os.path.dirname(d) == str(tmpdir)
+    assert not os.path.exists(d)
+
+    monkeypatch.delenv('SPYNOZA_SCRATCH_DIR')
+    with scratch_space(ram_disk=True) as e:
+        assert os.path.isdir(e)
+    assert not os.path.exists(e)
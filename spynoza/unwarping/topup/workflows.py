@@ -1,11 +1,30 @@
 import nipype.pipeline as pe
 from nipype.interfaces import fsl
-from ...utils import Get_scaninfo, Dyns_min_1
+from ...utils import Get_scaninfo, Extract_volume
 from nipype.interfaces.utility import Merge, IdentityInterface
-from .nodes import Topup_scan_params, Apply_scan_params
-
-
-def create_topup_workflow(analysis_info, name='topup'):
+from .nodes import Topup_scan_params, Apply_scan_params, Apply_topup
+
+
+def create_topup_workflow(analysis_info, name='topup', method='fsl',
+                          n_procs=1):
+    """ Estimates the susceptibility field from the last volume of each run
+    and a volume with opposite phase encoding, and unwarps the runs.
+
+    Parameters
+    ----------
+    analysis_info : dict
+        analysis settings
+    name : string
+        name of workflow
+    method : string ['fsl', 'native']
+        whether the runs are corrected by ApplyTOPUP (method='jac') or
+        natively, by evaluating the field coefficients on the EPI grid once
+        and resampling all volumes with Jacobian modulation (no per-TR
+        acquisition parameter file is needed then)
+    n_procs : int (default: 1)
+        number of threads used to unwarp each run natively (and reserved
+        from the nipype scheduler through node.n_procs)
+    """
 
     ###########################################################################
     # NODES
@@ -23,10 +42,6 @@ def create_topup_workflow(analysis_info, name='topup'):
                           name='get_scaninfo',
                           iterfield=['in_file'])
 
-    dyns_min_1_node = pe.MapNode(interface=Dyns_min_1,
-                                 name='dyns_min_1_node',
-                                 iterfield=['dyns'])
-
     topup_scan_params_node = pe.Node(interface=Topup_scan_params,
                                      name='topup_scan_params')
 
@@ -34,14 +49,17 @@ def create_topup_workflow(analysis_info, name='topup'):
                                         name='apply_scan_params',
                                         iterfield=['nr_trs'])
 
-    PE_ref = pe.MapNode(fsl.ExtractROI(t_size=1),
+    # the last volume of each run; only that volume is read (and inflated)
+    PE_ref = pe.MapNode(interface=Extract_volume,
                         name='PE_ref',
-                        iterfield=['in_file', 't_min'])
+                        iterfield=['in_file'])
+    PE_ref.inputs.index = -1
 
     # hard-coded the timepoint for this node, no more need for alt_t.
-    PE_alt = pe.MapNode(fsl.ExtractROI(t_min=0, t_size=1),
+    PE_alt = pe.MapNode(interface=Extract_volume,
                         name='PE_alt',
                         iterfield=['in_file'])
+    PE_alt.inputs.index = 0
 
     PE_comb = pe.MapNode(Merge(2), name='PE_list', iterfield = ['in1', 'in2'])
     PE_merge = pe.MapNode(fsl.Merge(dimension='t'),
@@ -68,10 +86,19 @@ def create_topup_workflow(analysis_info, name='topup'):
     topup_node = pe.MapNode(fsl.TOPUP(args=topup_args),
                             name='topup',
                             iterfield=['in_file'])
-    unwarp = pe.MapNode(fsl.ApplyTOPUP(in_index=[1], method='jac'),
-                        name='unwarp',
-                        iterfield = ['in_files', 'in_topup_fieldcoef',
-                                     'in_topup_movpar', 'encoding_file'])
+    if method == 'native':
+        unwarp = pe.MapNode(interface=Apply_topup,
+                            name='unwarp',
+                            iterfield=['in_file', 'fieldcoef_file',
+                                       'movpar_file'])
+        unwarp.inputs.in_index = 1
+        unwarp.inputs.n_threads = n_procs
+        unwarp.n_procs = n_procs
+    else:
+        unwarp = pe.MapNode(fsl.ApplyTOPUP(in_index=[1], method='jac'),
+                            name='unwarp',
+                            iterfield = ['in_files', 'in_topup_fieldcoef',
+                                         'in_topup_movpar', 'encoding_file'])
 
     ###########################################################################
     # WORKFLOW
@@ -79,7 +106,6 @@ def create_topup_workflow(analysis_info, name='topup'):
     topup_workflow = pe.Workflow(name=name)
 
     # these are now mapnodes because they split up over files
-    topup_workflow.connect(input_node, 'in_files', get_info, 'in_file')
     topup_workflow.connect(input_node, 'in_files', PE_ref, 'in_file')
     topup_workflow.connect(input_node, 'alt_files', PE_alt, 'in_file')
 
@@ -89,14 +115,12 @@ def create_topup_workflow(analysis_info, name='topup'):
     topup_workflow.connect(input_node, 'epi_factor', topup_scan_params_node, 'epi_factor')
 
     # preparing a node here, which automatically iterates over dyns output of the get_info mapnode
-    topup_workflow.connect(input_node, 'echo_time', apply_scan_params_node, 'te')
-    topup_workflow.connect(input_node, 'phase_encoding_direction', apply_scan_params_node, 'pe_direction')
-    topup_workflow.connect(input_node, 'epi_factor', apply_scan_params_node, 'epi_factor')
-    topup_workflow.connect(get_info, 'dyns', apply_scan_params_node, 'nr_trs')
-
-    # the nr_trs and in_files both propagate into the PR_ref node
-    topup_workflow.connect(get_info, 'dyns', dyns_min_1_node, 'dyns')
-    topup_workflow.connect(dyns_min_1_node, 'dyns_1', PE_ref, 't_min')
+    if method != 'native':
+        topup_workflow.connect(input_node, 'in_files', get_info, 'in_file')
+        topup_workflow.connect(input_node, 'echo_time', apply_scan_params_node, 'te')
+        topup_workflow.connect(input_node, 'phase_encoding_direction', apply_scan_params_node, 'pe_direction')
+        topup_workflow.connect(input_node, 'epi_factor', apply_scan_params_node, 'epi_factor')
+        topup_workflow.connect(get_info, 'dyns', apply_scan_params_node, 'nr_trs')
 
     topup_workflow.connect(PE_ref, 'roi_file', PE_comb, 'in1')
     topup_workflow.connect(PE_alt, 'roi_file', PE_comb, 'in2')
@@ -106,12 +130,20 @@ def create_topup_workflow(analysis_info, name='topup'):
     topup_workflow.connect(PE_merge, 'merged_file', topup_node, 'in_file')
     topup_workflow.connect(input_node, 'conf_file', topup_node, 'config')
 
-    topup_workflow.connect(input_node, 'in_files', unwarp, 'in_files')
-    topup_workflow.connect(apply_scan_params_node, 'fn', unwarp, 'encoding_file')
-    topup_workflow.connect(topup_node, 'out_fieldcoef', unwarp, 'in_topup_fieldcoef')
-    topup_workflow.connect(topup_node, 'out_movpar', unwarp, 'in_topup_movpar')
+    if method == 'native':
+        # the first row of the topup parameters is that of the runs
+        topup_workflow.connect(input_node, 'in_files', unwarp, 'in_file')
+        topup_workflow.connect(topup_scan_params_node, 'fn', unwarp, 'encoding_file')
+        topup_workflow.connect(topup_node, 'out_fieldcoef', unwarp, 'fieldcoef_file')
+        topup_workflow.connect(topup_node, 'out_movpar', unwarp, 'movpar_file')
+        topup_workflow.connect(unwarp, 'out_file', output_node, 'out_files')
+    else:
+        topup_workflow.connect(input_node, 'in_files', unwarp, 'in_files')
+        topup_workflow.connect(apply_scan_params_node, 'fn', unwarp, 'encoding_file')
+        topup_workflow.connect(topup_node, 'out_fieldcoef', unwarp, 'in_topup_fieldcoef')
+        topup_workflow.connect(topup_node, 'out_movpar', unwarp, 'in_topup_movpar')
+        topup_workflow.connect(unwarp, 'out_corrected', output_node, 'out_files')
 
-    topup_workflow.connect(unwarp, 'out_corrected', output_node, 'out_files')
     topup_workflow.connect(topup_node, 'out_fieldcoef', output_node, 'field_coefs')
 
     # ToDo: automatic datasink?
@@ -1,4 +1,5 @@
 import nipype.pipeline as pe
+from contextlib import contextmanager
 from nipype.interfaces.utility import Function
 import numpy as np
 
@@ -292,6 +293,42 @@ Average_over_runs = Function(function=average_over_runs,
                              output_names=['out_file'])
 
 
+def mean_image(in_file):
+    """ Computes the temporal mean of a 4D nifti-file (like fslmaths -Tmean).
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to nifti-file.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to mean nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    if data.ndim > 3:
+        data = data.mean(axis=-1)
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(np.float32)
+    out_file = os.path.abspath(
+        os.path.basename(in_file).split('.')[0] + '_mean.nii.gz')
+    nib.save(nib.Nifti1Image(data, img.affine, hdr), out_file)
+
+    return out_file
+
+
+Mean_image = Function(function=mean_image, input_names=['in_file'],
+                      output_names=['out_file'])
+
+
 def pickle_to_json(in_file):
     import json
     import jsonpickle
@@ -352,7 +389,196 @@ Set_nifti_intercept_slope = Function(function=set_nifti_intercept_slope,
                                      output_names=['out_file'])
 
 
-def split_4D_to_3D(in_file):
+def scratch_root(ram_disk=False):
+    """ Returns the directory under which scratch space is created:
+    $SPYNOZA_SCRATCH_DIR if set (also if ram_disk is True), /dev/shm if
+    ram_disk is True (and it is writable), and the system's temporary
+    directory otherwise. """
+    import os
+    import tempfile
+
+    if os.environ.get('SPYNOZA_SCRATCH_DIR'):
+        return os.environ['SPYNOZA_SCRATCH_DIR']
+    if ram_disk and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+@contextmanager
+def scratch_space(prefix='spynoza_', ram_disk=False):
+    """ Context manager providing a unique scratch directory per node
+    invocation, so that nodes running in parallel (e.g., under MultiProc)
+    never write to the same paths.
+
+    The directory is removed when the block exits normally, and kept (for
+    inspection) when it raises.
+
+    Parameters
+    ----------
+    prefix : str (default: 'spynoza_')
+        Prefix of the directory name.
+    ram_disk : bool (default: False)
+        Whether to create the directory on /dev/shm (if available), for
+        small, short-lived files.
+
+    Yields
+    ------
+    scratch_dir : str
+        Absolute path to the scratch directory.
+
+    Example
+    -------
+    >>> with scratch_space(ram_disk=True) as scratch_dir:
+    ...     tmp_file = os.path.join(scratch_dir, 'vol_0000.nii.gz')
+    """
+    import shutil
+    import tempfile
+    from spynoza.utils import scratch_root
+
+    scratch_dir = tempfile.mkdtemp(prefix=prefix, dir=scratch_root(ram_disk))
+    yield scratch_dir
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _run_interface_batch(batch_dir, in_files, interface, interface_inputs,
+                         in_field, out_field):
+    """ Runs a (3D) nipype interface on every file of a batch, in the batch's
+    own directory; used by apply_per_volume in worker processes. """
+    import os
+    import copy
+    import importlib
+
+    os.chdir(batch_dir)
+    if isinstance(interface, str):
+        module, name = interface.rsplit('.', 1)
+        interface = getattr(importlib.import_module(module), name)
+    if isinstance(interface, type):
+        interface = interface()
+
+    out_files = []
+    for in_file in in_files:
+        iface = copy.deepcopy(interface)
+        for key, value in (interface_inputs or {}).items():
+            setattr(iface.inputs, key, value)
+        setattr(iface.inputs, in_field, in_file)
+        result = iface.run()
+        out_files.append(os.path.abspath(getattr(result.outputs, out_field)))
+    return out_files
+
+
+def apply_per_volume(in_file, interface, interface_inputs=None,
+                     in_field='in_file', out_field='out_file', batch_size=8,
+                     n_procs=1, ram_disk=True, suffix='_pv'):
+    """ Applies an interface that only handles 3D images to every volume of
+    a 4D file, without a split -> MapNode -> merge workflow.
+
+    Volumes are written uncompressed to scratch space in batches, each
+    batch is processed by a worker from a bounded process pool (in its own
+    directory), and the outputs are read back and written to the 4D output
+    in order, while later batches are still running.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 4D nifti-file.
+    interface : str, class or nipype interface
+        The 3D interface, e.g., 'spynoza.uniformization.nodes.Uniformize';
+        a dotted path keeps the node's inputs hashable.
+    interface_inputs : dict
+        Inputs to set on the interface (besides in_field).
+    in_field : str (default: 'in_file')
+        Name of the interface's input image.
+    out_field : str (default: 'out_file')
+        Name of the interface's output image.
+    batch_size : int (default: 8)
+        Number of volumes processed per worker task.
+    n_procs : int (default: 1)
+        Number of worker processes; set node.n_procs to match, so that the
+        nipype scheduler accounts for them.
+    ram_disk : bool (default: True)
+        Whether the scratch space is on /dev/shm (if available).
+    suffix : str (default: '_pv')
+        Suffix added to the output filename.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to 4D nifti-file.
+    """
+    import os
+    import shutil
+    import numpy as np
+    import nibabel as nib
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from spynoza.utils import (open_nifti_indexed, scratch_space,
+                               _run_interface_batch)
+    from spynoza.resampling.nodes import write_nifti_stream
+
+    with open_nifti_indexed(in_file, build_index=False) as img:
+        shape = img.shape[:3]
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+        hdr = img.header.copy()
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(np.float32)
+        n_procs = n_procs or 1
+
+        out_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + suffix + '.nii.gz')
+
+        with scratch_space(prefix='spynoza_pv_', ram_disk=ram_disk) as scratch:
+
+            def _submit(pool, start):
+                stop = min(start + batch_size, n_vols)
+                batch_dir = os.path.join(scratch, 'batch_%05i' % start)
+                os.mkdir(batch_dir)
+                if len(img.shape) > 3:
+                    data = np.asarray(img.dataobj[..., start:stop],
+                                      dtype=np.float32)
+                else:
+                    data = np.asarray(img.dataobj, dtype=np.float32)[..., None]
+                in_files = []
+                for i in range(stop - start):
+                    fn = os.path.join(batch_dir, 'vol_%05i.nii' % (start + i))
+                    nib.save(nib.Nifti1Image(data[..., i], img.affine, hdr),
+                             fn)
+                    in_files.append(fn)
+                return batch_dir, pool.submit(_run_interface_batch, batch_dir,
+                                              in_files, interface,
+                                              interface_inputs, in_field,
+                                              out_field)
+
+            def _chunks():
+                starts = deque(range(0, n_vols, batch_size))
+                running = deque()
+                with ProcessPoolExecutor(max_workers=n_procs) as pool:
+                    while starts or running:
+                        # at most two batches per worker are in scratch space
+                        while starts and len(running) < 2 * n_procs:
+                            running.append(_submit(pool, starts.popleft()))
+                        batch_dir, future = running.popleft()
+                        vols = [np.asarray(nib.load(f).dataobj,
+                                           dtype=np.float32)
+                                for f in future.result()]
+                        shutil.rmtree(batch_dir)
+                        yield np.stack([v.reshape(shape) for v in vols],
+                                       axis=-1)
+
+            write_nifti_stream(out_file, _chunks(), shape + (n_vols,),
+                               img.affine, header=img.header)
+
+        return out_file
+
+
+Apply_per_volume = Function(function=apply_per_volume,
+                            input_names=['in_file', 'interface',
+                                         'interface_inputs', 'in_field',
+                                         'out_field', 'batch_size', 'n_procs',
+                                         'ram_disk', 'suffix'],
+                            output_names=['out_file'])
+
+
+def split_4D_to_3D(in_file, out_dir=None):
     """split_4D_to_3D splits a single 4D file into a list of nifti files.
     Because it splits the file at once, it's faster than fsl.ExtractROI
 
@@ -360,6 +586,9 @@ def split_4D_to_3D(in_file):
     ----------
     in_file : str
         Absolute path to nifti-file.
+    out_dir : str
+        Directory to write the volumes to; defaults to the current (i.e.,
+        the node's own) working directory.
 
     Returns
     -------
@@ -368,26 +597,482 @@ def split_4D_to_3D(in_file):
 
     import nibabel as nib
     import os
-    import tempfile
 
     original_file = nib.load(in_file)
     affine = original_file.affine
     header = original_file.header
     dyns = original_file.shape[-1]
 
-    data = original_file.get_data()
-    tempdir = tempfile.gettempdir()
+    data = original_file.get_fdata()
+    if out_dir is None:
+        out_dir = os.getcwd()
     fn_base = os.path.split(in_file)[-1][:-7]  # take off .nii.gz
 
     out_files = []
     for i in range(dyns):
         img = nib.Nifti1Image(data[..., i], affine=affine, header=header)
-        opfn = os.path.join(tempdir, fn_base + '_%s.nii.gz' % str(i).zfill(4))
+        opfn = os.path.abspath(os.path.join(out_dir, fn_base + '_%s.nii.gz' % str(i).zfill(4)))
         nib.save(img, opfn)
         out_files.append(opfn)
 
     return out_files
 
 
-Split_4D_to_3D = Function(function=split_4D_to_3D, input_names=['in_file'],
+Split_4D_to_3D = Function(function=split_4D_to_3D,
+                          input_names=['in_file', 'out_dir'],
                           output_names=['out_files'])
+
+
+def load_nifti_indexed(in_file, build_index=True, cache_dir=None):
+    """ Loads a nifti-file for random access along time.
+
+    For .nii.gz files, indexed_gzip (if installed) is used with a zran-style
+    seek index, cached per file (keyed on path, size and modification time),
+    so that reading volume k does not inflate all preceding volumes. Without
+    indexed_gzip, or for uncompressed files, nibabel's lazy loading is used.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to nifti-file.
+    build_index : bool (default: True)
+        Whether to build (and cache) the full index if no cached index
+        exists; this inflates the file once. Otherwise, a cached index is
+        only used if present.
+    cache_dir : str
+        Directory for cached indices; defaults to $SPYNOZA_CACHE_DIR or
+        ~/.cache/spynoza.
+
+    Returns
+    -------
+    img : nibabel image
+        Image whose dataobj supports cheap slicing along time. The file it
+        reads from stays open; use open_nifti_indexed to close it after
+        reading.
+    """
+    import os
+    import hashlib
+    import nibabel as nib
+
+    if not in_file.endswith('.gz'):
+        return nib.load(in_file, mmap=True)
+    try:
+        import indexed_gzip as igzip
+    except ImportError:
+        return nib.load(in_file, keep_file_open=True)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('SPYNOZA_CACHE_DIR', os.path.join(
+            os.path.expanduser('~'), '.cache', 'spynoza'))
+    cache_dir = os.path.join(cache_dir, 'gzip_index')
+    stat = os.stat(in_file)
+    key = hashlib.sha1(('%s:%i:%i' % (os.path.abspath(in_file), stat.st_size,
+                                      stat.st_mtime_ns)).encode())
+    index_file = os.path.join(cache_dir, key.hexdigest() + '.gzidx')
+
+    fobj = igzip.IndexedGzipFile(in_file, spacing=4 * 2 ** 20)
+    if os.path.isfile(index_file):
+        fobj.import_index(index_file)
+    elif build_index:
+        fobj.build_full_index()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fobj.export_index(index_file + '.%i' % os.getpid())
+        os.replace(index_file + '.%i' % os.getpid(), index_file)
+
+    holder = nib.FileHolder(filename=in_file, fileobj=fobj)
+    return nib.Nifti1Image.from_file_map({'header': holder, 'image': holder})
+
+
+@contextmanager
+def open_nifti_indexed(in_file, build_index=True, cache_dir=None):
+    """ Context manager around load_nifti_indexed that closes the file object
+    the image reads from (e.g., the IndexedGzipFile) when the block exits.
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to nifti-file.
+    build_index : bool (default: True)
+        See load_nifti_indexed.
+    cache_dir : str
+        See load_nifti_indexed.
+
+    Yields
+    ------
+    img : nibabel image
+        Image whose dataobj supports cheap slicing along time; it can only
+        be read inside the block.
+
+    Example
+    -------
+    >>> with open_nifti_indexed(in_file) as img:
+    ...     data = np.asanyarray(img.dataobj[..., 0])
+    """
+    img = load_nifti_indexed(in_file, build_index=build_index,
+                             cache_dir=cache_dir)
+    try:
+        yield img
+    finally:
+        fobj = img.file_map['image'].fileobj
+        if fobj is not None:
+            fobj.close()
+        opener = getattr(img.dataobj, '_opener', None)
+        if opener is not None and not opener.closed:
+            opener.close_if_mine()
+
+
+def extract_volume(in_file, index=-1, cache_dir=None):
+    """ Extracts a single volume from a 4D nifti-file, like fsl.ExtractROI
+    with t_size=1, but reading only that volume (see load_nifti_indexed).
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to 4D nifti-file.
+    index : int (default: -1)
+        Index of the volume; negative indices count from the end.
+    cache_dir : str
+        Directory for cached gzip indices (see load_nifti_indexed).
+
+    Returns
+    -------
+    roi_file : str
+        Absolute path to 3D nifti-file.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from spynoza.utils import open_nifti_indexed
+
+    with open_nifti_indexed(in_file, cache_dir=cache_dir) as img:
+        n_vols = img.shape[3] if len(img.shape) > 3 else 1
+        if not -n_vols <= index < n_vols:
+            raise ValueError('Volume %i does not exist in %s (%i volumes)' %
+                             (index, in_file, n_vols))
+        index = index % n_vols
+
+        if len(img.shape) > 3:
+            data = np.asanyarray(img.dataobj[..., index])
+        else:
+            data = np.asanyarray(img.dataobj)
+        header = img.header.copy()
+        header.set_data_shape(data.shape)
+
+        roi_file = os.path.abspath(
+            os.path.basename(in_file).split('.')[0] + '_roi.nii.gz')
+        nib.save(nib.Nifti1Image(data, img.affine, header), roi_file)
+        return roi_file
+
+
+Extract_volume = Function(function=extract_volume,
+                          input_names=['in_file', 'index', 'cache_dir'],
+                          output_names=['roi_file'])
+
+
+def save_regressors(out_file, regressors, names=None, **metadata):
+    """ Writes regressors to a packed regressor file: an uncompressed .npz
+    with 'regressors' (slices x regressors x time), 'names' and 'metadata'
+    (a JSON string). Per-volume regressors are stored with a single slice,
+    which applies to all slices.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to .npz file.
+    regressors : np.ndarray
+        Array of shape (slices, regressors, time), or (regressors, time)
+        for per-volume regressors.
+    names : list
+        Name of each regressor; defaults to regressor_<i>.
+    **metadata
+        JSON-serialisable information, e.g. the producer and its settings.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to packed regressor file.
+    """
+    import os
+    import json
+    import numpy as np
+
+    regressors = np.asarray(regressors, dtype=np.float32)
+    if regressors.ndim == 2:
+        regressors = regressors[np.newaxis]
+    if names is None:
+        names = ['regressor_%i' % i for i in range(regressors.shape[1])]
+    if len(names) != regressors.shape[1]:
+        raise ValueError('Got %i names for %i regressors' %
+                         (len(names), regressors.shape[1]))
+
+    out_file = os.path.abspath(out_file)
+    np.savez(out_file, regressors=np.ascontiguousarray(regressors),
+             names=np.array(names, dtype=str),
+             metadata=np.array(json.dumps(metadata)))
+    return out_file
+
+
+def load_regressors(in_file, mmap=True):
+    """ Reads a packed regressor file (see save_regressors).
+
+    Parameters
+    ----------
+    in_file : str
+        Absolute path to packed regressor file.
+    mmap : bool (default: True)
+        Whether to memory-map the regressors rather than read them.
+
+    Returns
+    -------
+    regressors : np.ndarray
+        Array (or read-only memory-map) of shape (slices, regressors, time).
+    names : list
+        Regressor names.
+    metadata : dict
+        Metadata stored with the regressors.
+    """
+    import json
+    import struct
+    import zipfile
+    import numpy as np
+
+    with np.load(in_file) as packed:
+        names = [str(n) for n in packed['names']]
+        metadata = json.loads(str(packed['metadata'])) \
+            if 'metadata' in packed else {}
+        if not mmap:
+            return packed['regressors'], names, metadata
+
+    with zipfile.ZipFile(in_file) as zf:
+        info = zf.getinfo('regressors.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(in_file) as packed:
+            return packed['regressors'], names, metadata
+
+    # the stored .npy starts after the zip member's local header
+    with open(in_file, 'rb') as f:
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(name_length + extra_length, 1)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    shape, fortran_order, dtype = header
+    regressors = np.memmap(in_file, dtype=dtype, mode='r', offset=offset,
+                           shape=shape, order='F' if fortran_order else 'C')
+    return regressors, names, metadata
+
+
+def pack_regressors(slice_regressor_list=[], vol_regressors='',
+                    out_file=None, n_vols=None):
+    """ Packs per-slice regressor nifti-files (e.g., from PNMtoEVs) and a
+    per-TR regressor file into a single packed regressor file.
+
+    Parameters
+    ----------
+    slice_regressor_list : list
+        Absolute paths to per-slice regressor nifti-files (slices along the
+        last spatial dimension, time last) or packed regressor files.
+    vol_regressors : str
+        Absolute path to per-TR regressor file, repeated for every slice:
+        a tsv-file with a header (one named column per regressor, e.g.,
+        extended motion parameters or compcor components) or a text file
+        (time x regressors, as .par files, or regressors x time).
+    out_file : str
+        Filename of the packed regressor file; defaults to the name of the
+        first input with suffix '_packed.npz'.
+    n_vols : int
+        Number of volumes of the run, which orients a text vol_regressors
+        file; defaults to the length of the slice regressors or, without
+        these, rows are taken to be volumes.
+
+    Returns
+    -------
+    out_file : str
+        Absolute path to packed regressor file.
+    """
+    import os
+    import numpy as np
+    import pandas as pd
+    import nibabel as nib
+    from spynoza.utils import save_regressors, load_regressors
+
+    blocks, names = [], []
+    for f in slice_regressor_list:
+        if f.endswith('.npz'):
+            regressors, reg_names, _ = load_regressors(f)
+            blocks.append(regressors)
+            names += reg_names
+        else:
+            data = np.asanyarray(nib.load(f).dataobj).squeeze()
+            blocks.append(data[:, np.newaxis, :])
+            names.append(os.path.basename(f).split('.')[0])
+
+    if n_vols is None and blocks:
+        n_vols = blocks[0].shape[-1]
+    if vol_regressors != '':
+        base = os.path.basename(vol_regressors).split('.')[0]
+        if vol_regressors.endswith('.tsv'):
+            vol_df = pd.read_csv(vol_regressors, sep=str('\t'))
+            vol_data = vol_df.values.T
+            vol_names = [str(c) for c in vol_df.columns]
+        else:
+            vol_data = np.loadtxt(vol_regressors, ndmin=2)
+            # rows are volumes, unless only the columns match the run
+            if n_vols is None or vol_data.shape[0] == n_vols:
+                vol_data = vol_data.T
+            vol_names = ['%s_%i' % (base, i) for i in range(vol_data.shape[0])]
+        if n_vols is not None and vol_data.shape[1] != n_vols:
+            raise ValueError('%s does not have %i volumes' %
+                             (vol_regressors, n_vols))
+        blocks.append(vol_data[np.newaxis])
+        names += vol_names
+
+    if not blocks:
+        raise ValueError('No regressors to pack')
+    if out_file is None:
+        sources = list(slice_regressor_list) + [vol_regressors]
+        out_file = os.path.basename(sources[0]).split('.')[0] + '_packed.npz'
+
+    n_slices = max(b.shape[0] for b in blocks)
+    regressors = np.concatenate(
+        [np.broadcast_to(b, (n_slices,) + b.shape[1:]) for b in blocks], axis=1)
+    return save_regressors(out_file, regressors, names,
+                           sources=list(slice_regressor_list) +
+                           ([vol_regressors] if vol_regressors else []))
+
+
+Pack_regressors = Function(function=pack_regressors,
+                           input_names=['slice_regressor_list',
+                                        'vol_regressors', 'out_file',
+                                        'n_vols'],
+                           output_names=['out_file'])
+
+
+def load_fsl_matrices(in_files):
+    """ Loads FSL (FLIRT/MCFLIRT) matrices into a single array.
+
+    Parameters
+    ----------
+    in_files : str or list
+        A single matrix file, a list of matrix files or a directory (e.g.
+        MCFLIRT's .mat directory) with one matrix file per volume.
+
+    Returns
+    -------
+    mats : np.ndarray
+        Array of shape (T, 4, 4) with the matrices, sorted by filename if
+        a directory is given.
+    """
+    import os
+    import numpy as np
+
+    if not isinstance(in_files, list):
+        if os.path.isdir(in_files):
+            in_files = [os.path.join(in_files, f)
+                        for f in sorted(os.listdir(in_files))]
+        else:
+            in_files = [in_files]
+
+    mats = np.empty((len(in_files), 4, 4))
+    for i, f in enumerate(in_files):
+        mats[i] = np.loadtxt(f)
+
+    return mats
+
+
+def fsl_voxel_to_mm(shape, zooms, affine):
+    """ Returns the matrix mapping voxel indices to FSL's scaled-mm space.
+
+    FSL matrices are defined in 'scaled voxel' coordinates: voxel indices
+    multiplied by the voxel sizes, with the x-axis flipped if the image has a
+    positive (neurological) qform/sform determinant.
+
+    Parameters
+    ----------
+    shape : tuple
+        Spatial shape (x, y, z) of the image.
+    zooms : tuple
+        Voxel sizes (x, y, z) of the image.
+    affine : np.ndarray
+        Voxel-to-world affine of the image.
+
+    Returns
+    -------
+    vox2fsl : np.ndarray
+        4x4 matrix mapping voxel indices to scaled-mm coordinates.
+    """
+    import numpy as np
+
+    vox2fsl = np.diag(list(zooms[:3]) + [1.])
+    if np.linalg.det(affine[:3, :3]) > 0:
+        vox2fsl[0, 0] = -zooms[0]
+        vox2fsl[0, 3] = (shape[0] - 1) * zooms[0]
+
+    return vox2fsl
+
+
+def params_to_fsl_matrix(params, centre=(0, 0, 0)):
+    """ Converts rigid-body parameters to an FSL matrix.
+
+    Follows FSL's (MCFLIRT) conventions: params are (rot_x, rot_y, rot_z,
+    trans_x, trans_y, trans_z), in radians and mm, with the rotation
+    R = Rz * Ry * Rx applied around `centre` (in scaled-mm coordinates).
+
+    Parameters
+    ----------
+    params : array-like
+        Array of shape (6,) or (T, 6) with rigid-body parameters.
+    centre : array-like
+        Centre of rotation in scaled-mm coordinates.
+
+    Returns
+    -------
+    mats : np.ndarray
+        Array of shape (4, 4) or (T, 4, 4).
+    """
+    import numpy as np
+
+    params = np.asarray(params, dtype=np.float64)
+    p = np.atleast_2d(params)
+    ca, cb, cc = np.cos(p[:, 0]), np.cos(p[:, 1]), np.cos(p[:, 2])
+    sa, sb, sc = np.sin(p[:, 0]), np.sin(p[:, 1]), np.sin(p[:, 2])
+
+    mats = np.zeros((p.shape[0], 4, 4))
+    mats[:, 0, 0] = cc * cb
+    mats[:, 0, 1] = cc * sb * sa + sc * ca
+    mats[:, 0, 2] = sc * sa - cc * sb * ca
+    mats[:, 1, 0] = -sc * cb
+    mats[:, 1, 1] = cc * ca - sc * sb * sa
+    mats[:, 1, 2] = sc * sb * ca + cc * sa
+    mats[:, 2, 0] = sb
+    mats[:, 2, 1] = -cb * sa
+    mats[:, 2, 2] = cb * ca
+    mats[:, 3, 3] = 1
+
+    centre = np.asarray(centre, dtype=np.float64)
+    mats[:, :3, 3] = centre - mats[:, :3, :3].dot(centre) + p[:, 3:6]
+
+    return mats[0] if params.ndim == 1 else mats
+
+
+def fsl_matrix_to_params(mats, centre=(0, 0, 0)):
+    """ Converts (rigid) FSL matrices to rigid-body parameters; the inverse
+    of params_to_fsl_matrix. """
+    import numpy as np
+
+    mats = np.asarray(mats, dtype=np.float64)
+    m = mats.reshape((-1, 4, 4))
+    params = np.empty((m.shape[0], 6))
+    params[:, 0] = np.arctan2(-m[:, 2, 1], m[:, 2, 2])
+    params[:, 1] = np.arcsin(np.clip(m[:, 2, 0], -1, 1))
+    params[:, 2] = np.arctan2(-m[:, 1, 0], m[:, 0, 0])
+
+    centre = np.asarray(centre, dtype=np.float64)
+    params[:, 3:] = m[:, :3, 3] - centre + m[:, :3, :3].dot(centre)
+
+    return params[0] if mats.ndim == 2 else params